@@ -78,7 +78,10 @@ setup(
     scripts=["bin/run-fitly-prod"],
     entry_points={
         "console_scripts": [
-            "run-fitly-dev=fitly.dev_cli:main"
+            "run-fitly-dev=fitly.dev_cli:main",
+            "run-fitly-reprocess=fitly.reprocess_cli:main",
+            "run-fitly-strava-event=fitly.strava_event_cli:main",
+            "run-fitly-mmp-benchmark=fitly.mmp_benchmark_cli:main"
         ]
     },
 )
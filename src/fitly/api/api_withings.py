@@ -1,12 +1,12 @@
 from withings_api import WithingsApi
-from withings_api.common import get_measure_value, MeasureType, Credentials, CredentialsType
+from withings_api.common import MeasureType, Credentials, CredentialsType
 from ..api.sqlalchemy_declarative import apiTokens, withings
 from ..api.database import engine
-from sqlalchemy import func, delete
+from ..api.sync_cursors import get_sync_cursor, save_sync_cursor
+from sqlalchemy import delete
 from datetime import datetime
 import ast
 import pandas as pd
-import numpy as np
 from ..app import app
 from ..utils import config
 import pickle
@@ -44,7 +44,8 @@ def load_credentials() -> CredentialsType:
 def withings_connected():
     try:
         client = WithingsApi(credentials=load_credentials(), refresh_cb=save_withings_token)
-        measures = client.measure_get_meas()
+        # Only ask for measures updated from now on, so checking the connection doesn't download the whole history
+        client.measure_get_meas(lastupdate=datetime.utcnow())
         app.server.logger.debug('Withings Connected')
         return True
     except BaseException as e:
@@ -59,36 +60,59 @@ def connect_withings_link(auth_client):
     return url
 
 
+# Measure types stored in the withings table
+measure_columns = {MeasureType.WEIGHT: 'weight', MeasureType.FAT_RATIO: 'fat_ratio', MeasureType.HYDRATION: 'hydration'}
+
+
+def get_measure_groups(client, lastupdate=None):
+    '''
+    Measure groups created or edited since lastupdate, following withings' pagination
+    :param lastupdate: utc datetime, None for the entire history
+    :return: list of measure groups, server time of the request to use as the next lastupdate
+    '''
+    response = client.measure_get_meas(lastupdate=lastupdate)
+    groups, updatetime = list(response.measuregrps), response.updatetime
+    while response.more:
+        response = client.measure_get_meas(lastupdate=lastupdate, offset=response.offset)
+        groups.extend(response.measuregrps)
+    return groups, updatetime
+
+
+def parse_measure_groups(groups):
+    # One pass over each group's measures, same values as get_measure_value() (first measure of each type)
+    records = []
+    for group in groups:
+        # Same timestamps as stored by earlier versions, the group's time with its offset dropped
+        record = {'date_utc': group.date.datetime.replace(tzinfo=None)}
+        for measure in group.measures:
+            column = measure_columns.get(measure.type)
+            if column and column not in record:
+                record[column] = measure.value * pow(10, measure.unit)
+        records.append(record)
+    df = pd.DataFrame.from_records(records, columns=['date_utc', 'weight', 'fat_ratio', 'hydration'])
+    # Only keep weigh ins with a body composition reading
+    df = df[df['weight'].fillna(0).astype(bool) & df['fat_ratio'].fillna(0).astype(bool)]
+    df = df.drop_duplicates(subset='date_utc', keep='last').set_index('date_utc')
+    # Convert to lbs
+    df['weight'] *= 2.20462
+    return df
+
+
 def pull_withings_data():
     # UTC dates will get sampled into daily
     if withings_connected():
         client = WithingsApi(load_credentials(), refresh_cb=save_withings_token)
-        df = pd.DataFrame(columns=['date_utc', 'weight', 'fat_ratio', 'hydration'])
-        meas_result = client.measure_get_meas(startdate=None, enddate=None, lastupdate=None)
-        for x in meas_result.measuregrps:
-            date = pd.to_datetime(str(x.date))
-            weight = get_measure_value(x, with_measure_type=MeasureType.WEIGHT)
-            fat_ratio = get_measure_value(x, with_measure_type=MeasureType.FAT_RATIO)
-            hydration = get_measure_value(x, with_measure_type=MeasureType.HYDRATION)
-
-            if weight and fat_ratio:
-                df = df.append({'date_utc': date, 'weight': weight, 'fat_ratio': fat_ratio, 'hydration': hydration},
-                               ignore_index=True)
-
-        df = df.set_index(df['date_utc'].apply(lambda x: x.replace(tzinfo=None)))
-
-        df = df[['weight', 'fat_ratio', 'hydration']]
-        # Convert to lbs
-        df['weight'] *= 2.20462
-
-        # Filter to days later than what is already in db
-        withings_max_date = app.session.query(func.max(withings.date_utc)).first()[0]
-        withings_max_date = datetime.strptime('1991-08-30 00:00:00',
-                                              '%Y-%m-%d %H:%M:%S') if not withings_max_date else withings_max_date
-
-        app.session.remove()
+        # Only measures added or edited since the last sync are requested, the first sync pulls the entire history
+        lastupdate = get_sync_cursor('withings')
+        app.server.logger.debug(f'Pulling withings measures updated since {lastupdate}')
+        groups, updatetime = get_measure_groups(client, lastupdate=lastupdate)
+        df = parse_measure_groups(groups)
 
-        df = df[(df.index > withings_max_date) & (~np.isnan(df['weight'])) & (~np.isnan(df['fat_ratio']))]
         if len(df) > 0:
             app.server.logger.info('New withings measurements found!')
+            # Edited measures replace what is stored for the same time
+            app.session.execute(delete(withings).where(withings.date_utc.in_(df.index.to_pydatetime().tolist())))
+            app.session.commit()
+            app.session.remove()
             df.to_sql('withings', engine, if_exists='append', index=True)
+        save_sync_cursor('withings', updatetime.to('utc').datetime.replace(tzinfo=None))
@@ -0,0 +1,71 @@
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+import pandas as pd
+from ..api.sqlalchemy_declarative import athlete, ouraSleepSummary, withings, strydSummary, stravaSummary
+from ..app import app
+from .database import engine
+from ..utils import stryd_credentials_supplied
+
+
+class AsOfSeries:
+    '''Values sorted by date, looked up "as of" a date with a binary search'''
+
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda row: row[0])
+        self.dates = [date for date, value in rows]
+        self.values = [value for date, value in rows]
+
+    def as_of(self, date, inclusive=True):
+        '''
+        :param date: date to look up
+        :param inclusive: whether a value on the date itself counts, otherwise only values strictly before it are used
+        :return: latest value on or before date, None if there isn't one
+        '''
+        i = bisect_right(self.dates, date) if inclusive else bisect_left(self.dates, date)
+        return self.values[i - 1] if i else None
+
+    def first(self):
+        return self.values[0] if self.values else None
+
+    def insert(self, date, value):
+        i = bisect_right(self.dates, date)
+        self.dates.insert(i, date)
+        self.values.insert(i, value)
+
+
+class AthleteContext:
+    '''
+    Athlete settings and the history FitlyActivity needs to score a workout (resting hr, weight, stryd workouts and
+    ride ftp tests), loaded once per refresh so a batch of activities doesn't query the db for each one
+    '''
+
+    def __init__(self, athlete_id):
+        self.athlete = app.session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
+        self.rest_hr = AsOfSeries(
+            app.session.query(ouraSleepSummary.report_date, ouraSleepSummary.hr_lowest).filter(
+                ouraSleepSummary.hr_lowest.isnot(None)).all())
+        self.weight = AsOfSeries(
+            app.session.query(withings.date_utc, withings.weight).filter(withings.weight.isnot(None)).all())
+        self.ride_ftp_tests = AsOfSeries(
+            app.session.query(stravaSummary.start_date_local, stravaSummary.average_watts).filter(
+                stravaSummary.type.ilike('%ride%'),
+                stravaSummary.name.ilike('%ftp test%')).all())
+        if stryd_credentials_supplied:
+            self.stryd = pd.read_sql(sql=app.session.query(strydSummary).statement, con=engine).sort_values(
+                'start_date_local', kind='stable').reset_index(drop=True)
+        else:
+            self.stryd = None
+
+        app.session.remove()
+
+    def stryd_workouts(self, start_date_local, window=timedelta(minutes=5)):
+        '''Stryd workouts starting within window of start_date_local, latest loaded first'''
+        dates = self.stryd['start_date_local']
+        lo = dates.searchsorted(start_date_local - window, side='left')
+        hi = dates.searchsorted(start_date_local + window, side='right')
+        return self.stryd.iloc[lo:hi].iloc[::-1]
+
+    def record_activity(self, activity):
+        # Keep ftp test history current for activities later in the same batch
+        if 'ride' in activity.type.lower() and 'ftp test' in str(activity.name).lower():
+            self.ride_ftp_tests.insert(activity.start_date_local, activity.average_watts)
@@ -1,4 +1,4 @@
-from ..api.stravaApi import get_strava_client, strava_connected
+from ..api.stravaApi import get_strava_client, strava_connected, rate_limit_message
 from ..api.ouraAPI import pull_oura_data
 from ..api.api_withings import pull_withings_data
 from ..api.fitbodAPI import pull_fitbod_data
@@ -6,11 +6,18 @@ from ..api.pelotonApi import get_peloton_class_names
 from ..api.strydAPI import pull_stryd_data
 from ..api.sqlalchemy_declarative import *
 from sqlalchemy import func, delete
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import datetime
 from ..api.fitlyAPI import *
+from ..api.power_curves import rebuild_power_envelopes
+from ..api.strava_queue import enqueue_activities, process_strava_queue
+from ..api.jobs import job_progress
+from ..api.locks import RefreshLease, lock_owner, PROVIDERS
+from stravalib.exc import RateLimitExceeded
 import pandas as pd
 from ..app import app
-from ..utils import config, withings_credentials_supplied, oura_credentials_supplied, nextcloud_credentials_supplied
+from ..utils import config, withings_credentials_supplied, oura_credentials_supplied, nextcloud_credentials_supplied, \
+    stryd_credentials_supplied, peloton_credentials_supplied
 
 
 def latest_refresh():
@@ -20,227 +27,334 @@ def latest_refresh():
     return latest_date
 
 
+def run_task_graph(tasks, max_workers=None):
+    '''
+    Run tasks concurrently, starting each one as soon as all of its dependencies have finished
+    :param tasks: dict of {name: (task_func, [dependency names])}. Each task_func is called with a dict of its
+                  dependencies' results, and should handle its own errors by returning a status
+    :param max_workers: max number of tasks running at once, defaults to running every ready task
+    :return: dict of {name: result}
+    '''
+    results, running = {}, {}
+    remaining = dict(tasks)
+    with ThreadPoolExecutor(max_workers=max_workers or len(tasks)) as executor:
+        while remaining or running:
+            for name, (task, dependencies) in list(remaining.items()):
+                if all(dependency in results for dependency in dependencies):
+                    running[executor.submit(run_task, task, {d: results[d] for d in dependencies})] = name
+                    del remaining[name]
+            if not running:
+                raise ValueError('Unresolvable task dependencies: {}'.format(list(remaining)))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                job_progress(f'{len(results)} of {len(tasks)} complete ({name}: {results[name]})')
+    return results
+
+
+def run_task(task_func, upstream):
+    try:
+        return task_func(upstream)
+    finally:
+        # Each worker thread gets its own scoped session
+        app.session.remove()
+
+
+def sync_withings(upstream):
+    # If withings credentials in config.ini, populate withings table
+    if not withings_credentials_supplied:
+        return 'No Credentials'
+    try:
+        app.server.logger.info('Pulling withings data...')
+        pull_withings_data()
+        return 'Successful'
+    except BaseException as e:
+        app.server.logger.error('Error pulling withings data: {}'.format(e))
+        return str(e)
+
+
+def sync_fitbod(upstream):
+    # If nextcloud credentials in config.ini, pull fitbod data from nextcloud location
+    if not nextcloud_credentials_supplied:
+        return 'No Credentials'
+    try:
+        app.server.logger.info('Pulling fitbod data...')
+        pull_fitbod_data()
+        return 'Successful'
+    except BaseException as e:
+        app.server.logger.error('Error pulling fitbod data: {}'.format(e))
+        return str(e)
+
+
+def sync_oura(upstream):
+    if not oura_credentials_supplied:
+        return 'No Credentials'
+    try:
+        app.server.logger.info('Pulling oura data...')
+        return 'Successful' if pull_oura_data() else 'Oura cloud not yet updated'
+    except BaseException as e:
+        app.server.logger.error('Error pulling oura data: {}'.format(e))
+        return str(e)
+
+
+def sync_stryd(upstream):
+    if not stryd_credentials_supplied:
+        return 'No Credentials'
+    try:
+        app.server.logger.info('Pulling stryd data...')
+        pull_stryd_data()
+        return 'Successful'
+    except Exception as e:
+        app.server.logger.error(f'Error puling stryd data {e}')
+        return str(e)
+
+
+def sync_peloton_classes(upstream):
+    # Refresh peloton class types local json file
+    if not peloton_credentials_supplied:
+        return 'No Credentials'
+    try:
+        get_peloton_class_names()
+        return 'Successful'
+    except Exception as e:
+        app.server.logger.error(f'Error pulling peloton class names {e}')
+        return str(e)
+
+
+def strava_sync_cursor(athlete_id):
+    '''
+    Date to list strava activities after. Once activities have been ingested this is the latest activity start date
+    minus an overlap window (to catch workouts uploaded late), so only new activities are listed from the api.
+    Falls back to [strava] activities_after_date for the first backfill.
+    '''
+    after = pd.to_datetime(config.get('strava', 'activities_after_date'), utc=True).tz_convert(None).to_pydatetime()
+    latest = app.session.query(func.max(stravaSummary.start_date_utc)).filter(
+        stravaSummary.athlete_id == athlete_id).scalar()
+    # Activities already queued for download don't need to be listed again
+    latest_queued = app.session.query(func.max(stravaDownloadQueue.start_date_utc)).filter(
+        stravaDownloadQueue.athlete_id == athlete_id).scalar()
+    app.session.remove()
+    latest = max([d for d in [latest, latest_queued] if d], default=None)
+    if latest:
+        overlap = timedelta(days=float(config.get('strava', 'sync_overlap_days', fallback=7)))
+        after = max(after, pd.to_datetime(latest).to_pydatetime() - overlap)
+    return after
+
+
+def sync_strava(upstream):
+    oura_status = upstream['oura']
+    # Only pull strava data if oura cloud has been updated with latest day, or no oura credentials so strava will use athlete static resting hr
+    if oura_status != 'Successful' and oura_status != 'No Credentials':
+        app.server.logger.info('Oura cloud not yet updated. Waiting to pull Strava data')
+        return 'Awaiting oura cloud update'
+    try:
+        app.server.logger.info('Pulling strava data...')
+
+        if strava_connected():
+            athlete_id = 1  # TODO: Make this dynamic if ever expanding to more users
+            # Leave part of each rate limit window free for pages that call the api while a refresh is running
+            client = get_strava_client(reserve=int(config.get('strava', 'rate_limit_reserve', fallback=10)))
+            after = strava_sync_cursor(athlete_id)
+            app.server.logger.debug(f'Listing strava activities after {after}')
+
+            athlete_info = app.session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
+            min_non_warmup_workout_time = athlete_info.min_non_warmup_workout_time
+            # Only activities inside the cursor window can be listed again
+            db_activities = {activity_id for activity_id, in app.session.query(stravaSummary.activity_id).filter(
+                stravaSummary.athlete_id == athlete_id, stravaSummary.start_date_utc >= after).distinct()}
+            app.session.remove()
+
+            new_activities = []
+            try:
+                # Use after to sort from oldest to newest
+                for act in client.get_activities(after=after, limit=0):
+                    # If not already in db, queue for download
+                    if act.id not in db_activities:
+                        new_activities.append(act)
+                        app.server.logger.info('New Workout found: "{}"'.format(act.name))
+            except RateLimitExceeded as e:
+                # Keep what was listed, the cursor picks up from the latest queued activity next refresh
+                app.server.logger.info(f'{rate_limit_message(e)} while listing strava activities')
+            if len(new_activities) > 0:
+                enqueue_activities(new_activities, athlete_id=athlete_id)
+            # Download everything queued, including activities left over from a rate limited refresh
+            remaining = process_strava_queue(athlete_id, client=client)
+
+            # Only run hrv training workflow if oura connection available to use hrv data or readiness score
+            if oura_status == 'Successful':
+                training_workflow(min_non_warmup_workout_time=min_non_warmup_workout_time,
+                                  metric=app.session.query(athlete).filter(
+                                      athlete.athlete_id == 1).first().recovery_metric)
+            if remaining:
+                return f'Rate limited, {remaining} activities queued'
+
+        app.server.logger.debug('stravaScrape() complete...')
+        return 'Successful'
+    except BaseException as e:
+        app.server.logger.error('Error pulling strava data: {}'.format(e))
+        return str(e)
+
+
+def locked_task(name, task_func, owner, held=()):
+    '''
+    Wrap a provider sync so it runs under that provider's lease. A refresh that overlaps another one (i.e. the cron
+    and a manual refresh) only skips the providers the other refresh is still pulling.
+    :param held: locks the caller already holds for the whole refresh (truncating), these aren't taken again
+    '''
+
+    def run(upstream):
+        if name in held:
+            return task_func(upstream)
+        lease = RefreshLease([name], owner=owner)
+        if not lease.acquire():
+            app.server.logger.info(f'{name} is already being refreshed')
+            return 'Already running'
+        try:
+            return task_func(upstream)
+        finally:
+            lease.release()
+
+    return run
+
+
 def refresh_database(refresh_method='system', truncate=False, truncateDate=None):
     run_time = datetime.utcnow()
     athlete_info = app.session.query(athlete).filter(athlete.athlete_id == 1).first()
-    processing = app.session.query(dbRefreshStatus).filter(dbRefreshStatus.refresh_method == 'processing').first()
     # Add record for refresh audit trail
     refresh_record = dbRefreshStatus(timestamp_utc=run_time, refresh_method=refresh_method,
                                      truncate=True if truncate or truncateDate else False)
     app.session.add(refresh_record)
     app.session.commit()
+    app.session.remove()
 
-    if not processing:
-        try:
-            # If athlete settings are defined
-            if athlete_info.name and athlete_info.birthday and athlete_info.sex and athlete_info.weight_lbs and athlete_info.resting_hr and athlete_info.run_ftp and athlete_info.ride_ftp:
-                # Insert record into table for 'processing'
-                db_process_flag(flag=True)
-
-                # If either truncate parameter is passed
-                if truncate or truncateDate:
-
-                    # If only truncating past a certain date
-                    if truncateDate:
-                        try:
-                            app.server.logger.debug('Truncating strava_summary')
-                            app.session.execute(
-                                delete(stravaSummary).where(stravaSummary.start_date_utc >= truncateDate))
-                            app.server.logger.debug('Truncating strava_samples')
-                            app.session.execute(
-                                delete(stravaSamples).where(stravaSamples.timestamp_local >= truncateDate))
-                            app.server.logger.debug('Truncating strava_best_samples')
-                            app.session.execute(
-                                delete(stravaBestSamples).where(stravaBestSamples.timestamp_local >= truncateDate))
-                            app.server.logger.debug('Truncating stryd_summary')
-                            app.session.execute(
-                                delete(strydSummary).where(strydSummary.start_date_local >= truncateDate))
-                            app.server.logger.debug('Truncating oura_readiness_summary')
-                            app.session.execute(
-                                delete(ouraReadinessSummary).where(ouraReadinessSummary.report_date >= truncateDate))
-                            app.server.logger.debug('Truncating oura_sleep_summary')
-                            app.session.execute(
-                                delete(ouraSleepSummary).where(ouraSleepSummary.report_date >= truncateDate))
-                            app.server.logger.debug('Truncating oura_sleep_samples')
-                            app.session.execute(
-                                delete(ouraSleepSamples).where(ouraSleepSamples.report_date >= truncateDate))
-                            app.server.logger.debug('Truncating oura_activity_summary')
-                            app.session.execute(
-                                delete(ouraActivitySummary).where(ouraActivitySummary.summary_date >= truncateDate))
-                            app.server.logger.debug('Truncating oura_activity_samples')
-                            app.session.execute(
-                                delete(ouraActivitySamples).where(ouraActivitySamples.timestamp_local >= truncateDate))
-                            app.server.logger.debug('Truncating hrv_workout_step_log')
-                            # Delete extra day back so hrv workflow can recalculate the 'completed_yesterday' flag
-                            app.session.execute(delete(workoutStepLog).where(
-                                workoutStepLog.date >= (truncateDate - timedelta(days=1))))
-                            app.server.logger.debug('Truncating withings')
-                            app.session.execute(delete(withings).where(withings.date_utc >= truncateDate))
-                            app.session.commit()
-                        except BaseException as e:
-                            app.session.rollback()
-                            app.server.logger.error(e)
-                    else:
-                        try:
-                            app.server.logger.debug('Truncating strava_summary')
-                            app.session.execute(delete(stravaSummary))
-                            app.server.logger.debug('Truncating strava_samples')
-                            app.session.execute(delete(stravaSamples))
-                            app.server.logger.debug('Truncating strava_best_samples')
-                            app.session.execute(delete(stravaBestSamples))
-                            app.server.logger.debug('Truncating oura_readiness_summary')
-                            app.session.execute(delete(ouraReadinessSummary))
-                            app.server.logger.debug('Truncating oura_sleep_summary')
-                            app.session.execute(delete(ouraSleepSummary))
-                            app.server.logger.debug('Truncating oura_sleep_samples')
-                            app.session.execute(delete(ouraSleepSamples))
-                            app.server.logger.debug('Truncating oura_activity_summary')
-                            app.session.execute(delete(ouraActivitySummary))
-                            app.server.logger.debug('Truncating oura_activity_samples')
-                            app.session.execute(delete(ouraActivitySamples))
-                            app.server.logger.debug('Truncating hrv_workout_step_log')
-                            app.session.execute(delete(workoutStepLog))
-                            app.server.logger.debug('Truncating withings')
-                            app.session.execute(delete(withings))
-                            app.server.logger.debug('Truncating fitbod')
-                            app.session.execute(delete(fitbod))
-                            app.session.commit()
-                        except BaseException as e:
-                            app.session.rollback()
-                            app.server.logger.error(e)
-
-                    app.session.remove()
-
-                ### Pull Weight Data ###
-
-                # If withings credentials in config.ini, populate withings table
-                if withings_credentials_supplied:
-                    try:
-                        app.server.logger.info('Pulling withings data...')
-                        pull_withings_data()
-                        withings_status = 'Successful'
-                    except BaseException as e:
-                        app.server.logger.error('Error pulling withings data: {}'.format(e))
-                        withings_status = str(e)
-                else:
-                    withings_status = 'No Credentials'
-
-                ### Pull Fitbod Data ###
-
-                # If nextcloud credentials in config.ini, pull fitbod data from nextcloud location
-                if nextcloud_credentials_supplied:
-                    try:
-                        app.server.logger.info('Pulling fitbod data...')
-                        pull_fitbod_data()
-                        fitbod_status = 'Successful'
-                    except BaseException as e:
-                        app.server.logger.error('Error pulling fitbod data: {}'.format(e))
-                        fitbod_status = str(e)
-                else:
-                    fitbod_status = 'No Credentials'
-
-                ### Pull Oura Data ###
-
-                if oura_credentials_supplied:
-                    # Pull Oura Data before strava because resting heart rate used in strava sample heart rate zones
-                    try:
-                        app.server.logger.info('Pulling oura data...')
-                        oura_status = pull_oura_data()
-                        oura_status = 'Successful' if oura_status else 'Oura cloud not yet updated'
-                    except BaseException as e:
-                        app.server.logger.error('Error pulling oura data: {}'.format(e))
-                        oura_status = str(e)
-                else:
-                    oura_status = 'No Credentials'
-
-                ### Pull Stryd Data ###
-                if stryd_credentials_supplied:
-                    try:
-                        app.server.logger.info('Pulling stryd data...')
-                        pull_stryd_data()
-                    except Exception as e:
-                        app.server.logger.error(f'Error puling stryd data {e}')
-
-                ### This has been moved to crontab as spotify refresh is required more frequently than hourly ###
-                # ### Pull Spotify Data ###
-                # if spotify_credentials_supplied:
-                #     app.server.logger.info('Pulling spotify play history...')
-                #     save_spotify_play_history()
-
-                ### Pull Strava Data ###
-
-                # Only pull strava data if oura cloud has been updated with latest day, or no oura credentials so strava will use athlete static resting hr
-                if oura_status == 'Successful' or oura_status == 'No Credentials':
-                    try:
-                        app.server.logger.info('Pulling strava data...')
-
-                        if strava_connected():
-                            athlete_id = 1  # TODO: Make this dynamic if ever expanding to more users
-                            client = get_strava_client()
-                            after = config.get('strava', 'activities_after_date')
-                            activities = client.get_activities(after=after,
-                                                               limit=0)  # Use after to sort from oldest to newest
-
-                            athlete_info = app.session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
-                            min_non_warmup_workout_time = athlete_info.min_non_warmup_workout_time
-                            # Loop through the activities, and create a dict of the dataframe stream data of each activity
-                            db_activities = pd.read_sql(
-                                sql=app.session.query(stravaSummary.activity_id).filter(
-                                    stravaSummary.athlete_id == athlete_id).distinct(
-                                    stravaSummary.activity_id).statement,
-                                con=engine)
-
-                            app.session.remove()
-                            new_activities = []
-                            for act in activities:
-                                # If not already in db, parse and insert
-                                if act.id not in db_activities['activity_id'].unique():
-                                    new_activities.append(FitlyActivity(act))
-                                    app.server.logger.info('New Workout found: "{}"'.format(act.name))
-                            # If new workouts found, analyze and insert
-                            if len(new_activities) > 0:
-                                for fitly_act in new_activities:
-                                    fitly_act.stravaScrape(athlete_id=athlete_id)
-                            # Only run hrv training workflow if oura connection available to use hrv data or readiness score
-                            if oura_status == 'Successful':
-                                training_workflow(min_non_warmup_workout_time=min_non_warmup_workout_time,
-                                                  metric=app.session.query(athlete).filter(
-                                                      athlete.athlete_id == 1).first().recovery_metric)
-
-                        app.server.logger.debug('stravaScrape() complete...')
-                        strava_status = 'Successful'
-                    except BaseException as e:
-                        app.server.logger.error('Error pulling strava data: {}'.format(e))
-                        strava_status = str(e)
-                else:
-                    app.server.logger.info('Oura cloud not yet updated. Waiting to pull Strava data')
-                    strava_status = 'Awaiting oura cloud update'
-
-                app.server.logger.debug('Updating db refresh record with status...')
-                refresh_record = app.session.query(dbRefreshStatus).filter(
-                    dbRefreshStatus.timestamp_utc == run_time).first()
-                refresh_record.oura_status = oura_status
-                refresh_record.fitbod_status = fitbod_status
-                refresh_record.strava_status = strava_status
-                refresh_record.withings_status = withings_status
-                refresh_record.refresh_method = refresh_method
-                app.session.commit()
-
-                # Refresh peloton class types local json file
-                if peloton_credentials_supplied:
-                    get_peloton_class_names()
-
-                db_process_flag(flag=False)
-                app.server.logger.info('Refresh Complete')
-                app.session.remove()
+    # If athlete settings are not defined
+    if not (athlete_info.name and athlete_info.birthday and athlete_info.sex and athlete_info.weight_lbs and
+            athlete_info.resting_hr and athlete_info.run_ftp and athlete_info.ride_ftp):
+        app.server.logger.info('Please define all athlete settings prior to refreshing data')
+        return
+
+    owner = lock_owner()
+    # Truncating holds every provider's lock until the reload is done, so nothing is written while tables are emptied
+    truncate_lease = RefreshLease(PROVIDERS, owner=owner) if truncate or truncateDate else None
+    if truncate_lease and not truncate_lease.acquire():
+        app.server.logger.info('Database is already running a refresh job')
+        return
 
+    try:
+        # If either truncate parameter is passed
+        if truncate_lease:
+            job_progress('Truncating tables')
+
+            # If only truncating past a certain date
+            if truncateDate:
+                try:
+                    app.server.logger.debug('Truncating strava_summary')
+                    app.session.execute(
+                        delete(stravaSummary).where(stravaSummary.start_date_utc >= truncateDate))
+                    app.server.logger.debug('Truncating strava_samples')
+                    app.session.execute(
+                        delete(stravaSamples).where(stravaSamples.timestamp_local >= truncateDate))
+                    app.server.logger.debug('Truncating strava_power_curves')
+                    app.session.execute(
+                        delete(stravaPowerCurve).where(stravaPowerCurve.timestamp_local >= truncateDate))
+                    app.server.logger.debug('Truncating strava_download_queue')
+                    app.session.execute(delete(stravaDownloadQueue).where(
+                        stravaDownloadQueue.start_date_utc >= truncateDate))
+                    app.server.logger.debug('Truncating stryd_summary')
+                    app.session.execute(
+                        delete(strydSummary).where(strydSummary.start_date_local >= truncateDate))
+                    app.server.logger.debug('Truncating oura_readiness_summary')
+                    app.session.execute(
+                        delete(ouraReadinessSummary).where(ouraReadinessSummary.report_date >= truncateDate))
+                    app.server.logger.debug('Truncating oura_sleep_summary')
+                    app.session.execute(
+                        delete(ouraSleepSummary).where(ouraSleepSummary.report_date >= truncateDate))
+                    app.server.logger.debug('Truncating oura_sleep_samples')
+                    app.session.execute(
+                        delete(ouraSleepSamples).where(ouraSleepSamples.report_date >= truncateDate))
+                    app.server.logger.debug('Truncating oura_activity_summary')
+                    app.session.execute(
+                        delete(ouraActivitySummary).where(ouraActivitySummary.summary_date >= truncateDate))
+                    app.server.logger.debug('Truncating oura_activity_samples')
+                    app.session.execute(
+                        delete(ouraActivitySamples).where(ouraActivitySamples.timestamp_local >= truncateDate))
+                    app.server.logger.debug('Truncating oura_day_hashes')
+                    # Readiness/sleep are reported the day after their summary_date, so clear an extra day of hashes
+                    app.session.execute(delete(ouraDayHash).where(
+                        ouraDayHash.summary_date >= (truncateDate - timedelta(days=1))))
+                    app.server.logger.debug('Truncating hrv_workout_step_log')
+                    # Delete extra day back so hrv workflow can recalculate the 'completed_yesterday' flag
+                    app.session.execute(delete(workoutStepLog).where(
+                        workoutStepLog.date >= (truncateDate - timedelta(days=1))))
+                    app.server.logger.debug('Truncating withings')
+                    app.session.execute(delete(withings).where(withings.date_utc >= truncateDate))
+                    # Withings only sends measures updated since its cursor, start it over to re-pull the truncated dates
+                    app.session.execute(delete(syncCursor).where(syncCursor.service == 'withings'))
+                    app.session.commit()
+                except BaseException as e:
+                    app.session.rollback()
+                    app.server.logger.error(e)
             else:
-                app.server.logger.info('Please define all athlete settings prior to refreshing data')
-        except:
-            # Just in case the job fails, remove any processing records that may have been added to audit log as to not lock the next job
-            db_process_flag(flag=False)
-    else:
-        if refresh_method == 'manual':
-            app.server.logger.info('Database is already running a refresh job')
+                try:
+                    app.server.logger.debug('Truncating strava_summary')
+                    app.session.execute(delete(stravaSummary))
+                    app.server.logger.debug('Truncating strava_samples')
+                    app.session.execute(delete(stravaSamples))
+                    app.server.logger.debug('Truncating strava_power_curves')
+                    app.session.execute(delete(stravaPowerCurve))
+                    app.server.logger.debug('Truncating strava_download_queue')
+                    app.session.execute(delete(stravaDownloadQueue))
+                    app.server.logger.debug('Truncating oura_readiness_summary')
+                    app.session.execute(delete(ouraReadinessSummary))
+                    app.server.logger.debug('Truncating oura_sleep_summary')
+                    app.session.execute(delete(ouraSleepSummary))
+                    app.server.logger.debug('Truncating oura_sleep_samples')
+                    app.session.execute(delete(ouraSleepSamples))
+                    app.server.logger.debug('Truncating oura_activity_summary')
+                    app.session.execute(delete(ouraActivitySummary))
+                    app.server.logger.debug('Truncating oura_activity_samples')
+                    app.session.execute(delete(ouraActivitySamples))
+                    app.server.logger.debug('Truncating oura_day_hashes')
+                    app.session.execute(delete(ouraDayHash))
+                    app.server.logger.debug('Truncating hrv_workout_step_log')
+                    app.session.execute(delete(workoutStepLog))
+                    app.server.logger.debug('Truncating withings')
+                    app.session.execute(delete(withings))
+                    app.session.execute(delete(syncCursor).where(syncCursor.service == 'withings'))
+                    app.server.logger.debug('Truncating fitbod')
+                    app.session.execute(delete(fitbod))
+                    app.session.commit()
+                except BaseException as e:
+                    app.session.rollback()
+                    app.server.logger.error(e)
 
-    app.session.remove()
+            app.session.remove()
+            # Power curve envelopes may hold points from truncated activities
+            rebuild_power_envelopes()
+
+        # Pull all providers, strava waits on the providers it uses to score activities
+        job_progress('Pulling data')
+        held = truncate_lease.held if truncate_lease else ()
+        statuses = run_task_graph({
+            'withings': (locked_task('withings', sync_withings, owner, held), []),
+            'fitbod': (locked_task('fitbod', sync_fitbod, owner, held), []),
+            'oura': (locked_task('oura', sync_oura, owner, held), []),
+            'stryd': (locked_task('stryd', sync_stryd, owner, held), []),
+            'peloton': (locked_task('peloton', sync_peloton_classes, owner, held), []),
+            'strava': (locked_task('strava', sync_strava, owner, held), ['oura', 'withings', 'stryd', 'fitbod']),
+        })
+
+        app.server.logger.debug('Updating db refresh record with status...')
+        refresh_record = app.session.query(dbRefreshStatus).filter(
+            dbRefreshStatus.timestamp_utc == run_time).first()
+        refresh_record.oura_status = statuses['oura']
+        refresh_record.fitbod_status = statuses['fitbod']
+        refresh_record.strava_status = statuses['strava']
+        refresh_record.withings_status = statuses['withings']
+        app.session.commit()
+        app.server.logger.info('Refresh Complete')
+    finally:
+        if truncate_lease:
+            truncate_lease.release()
+        app.session.remove()
@@ -3,11 +3,74 @@ import owncloud
 import os
 from ..api.sqlalchemy_declarative import fitbod
 from ..api.database import engine
-from sqlalchemy import func
+import re
 import pandas as pd
 from ..app import app
 from ..utils import config
 
+# Non-lifting exercises (cardio, mobility, stretching) left out of the fitbod table, matched anywhere in the name.
+# Can be replaced with a comma separated list in [nextcloud] fitbod_excluded_exercises
+excluded_exercises = ['Running', 'Cycling', 'Hiking', 'Rowing', 'Elliptical', 'Stair Stepper', 'Foam', 'Cat Cow',
+                      "Child's Pose", 'Downward Dog', 'Up Dog', 'Stretch', 'Butt Kick', 'Chest Expansion', 'Chin Drop',
+                      'Crab Pose', 'Dead Hang', 'Head Tilt', 'Pigeon Pose', 'Reach Behind and Open',
+                      'Seated Figure Four', 'Seated Forward Bend', 'Standing Forward Bend', 'Shin Box Hip Flexor',
+                      'Shin Box Quad', 'Single Leg Straight Forward Bend', 'Standing Hip Circle', 'Walkout',
+                      'Walkout to Push Up']
+
+
+def excluded_exercise_matcher():
+    # Single regex for the whole exclusion list so each chunk is only scanned once, compile it once per pull
+    exercises = config.get('nextcloud', 'fitbod_excluded_exercises', fallback='')
+    exercises = [x.strip() for x in exercises.split(',') if x.strip()] or excluded_exercises
+    return re.compile('|'.join(re.escape(exercise) for exercise in exercises))
+
+
+def clean_fitbod_sets(df, excluded=None):
+    '''
+    :param excluded: compiled regex from excluded_exercise_matcher(), pass it in when cleaning many chunks
+    '''
+    # Remove non-lifting exercises
+    excluded = excluded or excluded_exercise_matcher()
+    df = df[df['Distance(m)'] == 0]
+    df = df[~df['Exercise'].str.contains(excluded, na=False)]
+
+    # Create lbs column
+    df = df.assign(Weight=df['Weight(kg)'] * 2.20462)
+    # Modify columns in df as needed
+    df['Date_UTC'] = pd.to_datetime(df['Date']).dt.tz_localize(None)
+    # Rename duration
+    df = df.rename(columns={'Duration(s)': 'Duration'})
+    # Remove unecessary columns
+    # Date currently is not unique to exercise set - only unique to workout so should not be used as index
+    # Autogenerate index for now until (if?) fitbod updates their export to data to have a PK (timestamp)
+    return df[['Date_UTC', 'Exercise', 'Reps', 'Weight', 'Duration', 'isWarmup', 'Note']]
+
+
+def set_keys(df, counts=None):
+    '''
+    Content key of each set: its values plus the number of identical sets before it in the same workout, so repeated
+    sets (i.e. 3 x 10 at the same weight) each get their own key
+    :param counts: occurrences of each set seen so far, carried between chunks and updated in place
+    '''
+    counts = {} if counts is None else counts
+    content = zip(pd.to_datetime(df['Date_UTC']), df['Exercise'].fillna(''),
+                  *[df[col].astype(float).fillna(-1).round(3) for col in ['Reps', 'Weight', 'Duration']],
+                  df['isWarmup'].fillna(False).astype(bool))
+    keys = []
+    for set_content in content:
+        keys.append(set_content + (counts.get(set_content, 0),))
+        counts[set_content] = counts.get(set_content, 0) + 1
+    return keys
+
+
+def stored_set_keys(start, end):
+    # Keys of the sets already stored for a range of workouts
+    stored = pd.read_sql(sql=app.session.query(fitbod.date_utc, fitbod.exercise, fitbod.reps, fitbod.weight,
+                                               fitbod.duration, fitbod.iswarmup).filter(
+        fitbod.date_utc >= start, fitbod.date_utc <= end).order_by(fitbod.id).statement, con=engine)
+    app.session.remove()
+    return set(set_keys(stored.rename(columns={'date_UTC': 'Date_UTC'})))
+
 
 def pull_fitbod_data():
     app.server.logger.debug('Logging into Nextcloud')
@@ -25,68 +88,28 @@ def pull_fitbod_data():
         filename = filepath.split('/')[-1]
         # Download file
         oc.get_file(filepath)
-        # Convert file into df
-        df = pd.read_csv(filename)
-
-        # Remove non-lifting exercises
-        df = df[df['Distance(m)'] == 0]
-
-        df = df[
-            (~df['Exercise'].str.contains('Running')) &
-            (~df['Exercise'].str.contains('Cycling')) &
-            (~df['Exercise'].str.contains('Hiking')) &
-            (~df['Exercise'].str.contains('Rowing')) &
-            (~df['Exercise'].str.contains('Elliptical')) &
-            (~df['Exercise'].str.contains('Stair Stepper')) &
-            (~df['Exercise'].str.contains('Foam')) &
-            (~df['Exercise'].str.contains('Cat Cow')) &
-            (~df['Exercise'].str.contains("Child's Pose")) &
-            (~df['Exercise'].str.contains("Downward Dog")) &
-            (~df['Exercise'].str.contains("Up Dog")) &
-            (~df['Exercise'].str.contains("Stretch")) &
-            (~df['Exercise'].str.contains("Butt Kick")) &
-            (~df['Exercise'].str.contains("Chest Expansion")) &
-            (~df['Exercise'].str.contains("Chin Drop")) &
-            (~df['Exercise'].str.contains("Crab Pose")) &
-            (~df['Exercise'].str.contains("Dead Hang")) &
-            (~df['Exercise'].str.contains("Head Tilt")) &
-            (~df['Exercise'].str.contains("Pigeon Pose")) &
-            (~df['Exercise'].str.contains("Reach Behind and Open")) &
-            (~df['Exercise'].str.contains("Seated Figure Four")) &
-            (~df['Exercise'].str.contains("Seated Forward Bend")) &
-            (~df['Exercise'].str.contains("Standing Forward Bend")) &
-            (~df['Exercise'].str.contains("Shin Box Hip Flexor")) &
-            (~df['Exercise'].str.contains("Shin Box Quad")) &
-            (~df['Exercise'].str.contains("Single Leg Straight Forward Bend")) &
-            (~df['Exercise'].str.contains("Standing Hip Circle")) &
-            (~df['Exercise'].str.contains("Walkout")) &
-            (~df['Exercise'].str.contains("Walkout to Push Up"))
-            ]
-
-        # Create lbs column
-        df['Weight'] = df['Weight(kg)'] * 2.20462
-        # Modify columns in df as needed
-        df['Date_UTC'] = pd.to_datetime(df['Date']).dt.tz_localize(None)
-        # Rename duration
-        df = df.rename(columns={'Duration(s)': 'Duration'})
-        # Remove unecessary columns
-        df = df[['Date_UTC', 'Exercise', 'Reps', 'Weight', 'Duration', 'isWarmup', 'Note']]
-        # Date currently is not unique to exercise set - only unique to workout so should not be used as index
-        # Autogenerate index for now until (if?) fitbod updates their export to data to have a PK (timestamp)
-        # df = df.set_index('Date_UTC')
-
-        # DB Operations
+        # Process the export a chunk at a time, multi year exports don't need to fit in memory
+        chunk_rows = int(config.get('nextcloud', 'fitbod_chunk_rows', fallback=10000))
+        counts, inserted = {}, 0
+        excluded = excluded_exercise_matcher()
+        for chunk in pd.read_csv(filename, chunksize=chunk_rows):
+            df = clean_fitbod_sets(chunk, excluded)
+            if len(df) == 0:
+                continue
+            keys = set_keys(df, counts)
+            # Only carry occurrence counts for workouts that may continue into the next chunk
+            dates = set(df['Date_UTC'])
+            counts = {key: count for key, count in counts.items() if key[0] in dates}
 
-        max_date = app.session.query(func.max(fitbod.date_utc)).first()[0]
-        if max_date:
-            max_date = pd.to_datetime(max_date)
-            # Filter df to new workouts only for appending table
-            df = df[df['Date_UTC'] > max_date]
-        # Insert fitbod table into DB
-        df.to_sql('fitbod', engine, if_exists='append', index=False)
-        app.session.commit()
+            # Sets already in the db (by content, not date) are skipped so re-exports don't duplicate or drop sets
+            stored = stored_set_keys(df['Date_UTC'].min(), df['Date_UTC'].max())
+            df = df[[key not in stored for key in keys]]
+            if len(df) > 0:
+                # Insert fitbod table into DB
+                df.to_sql('fitbod', engine, if_exists='append', index=False)
+                inserted += len(df)
+        app.server.logger.debug(f'Inserted {inserted} fitbod sets')
 
-        app.session.remove()
         # Delete file in local folder
         os.remove(filename)
         # Empty the dir on nextcloud
@@ -1,9 +1,11 @@
 from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import numpy as np
-from ..api.sqlalchemy_declarative import ouraSleepSummary, ouraReadinessSummary, withings, athlete, stravaSummary, \
-    strydSummary, fitbod, workoutStepLog, dbRefreshStatus
-from sqlalchemy import func, cast, Date
-from sweat.io.models.dataframes import WorkoutDataFrame, Athlete
+from ..api.sqlalchemy_declarative import ouraSleepSummary, ouraReadinessSummary, athlete, stravaSummary, \
+    strydSummary, fitbod, workoutStepLog, stravaPowerCurve, stravaSamples, stravaStreams
+from sqlalchemy import func, cast, Date, delete
 from sweat.pdm import critical_power
 from sweat.metrics.core import weighted_average_power
 from sweat.metrics.power import *
@@ -11,12 +13,18 @@ import stravalib
 from ..api.stravaApi import get_strava_client
 from ..api.spotifyAPI import generate_recommendation_playlists
 from stravalib import unithelper
-from ..api.pelotonApi import peloton_mapping_df, roundTime, set_peloton_workout_recommendations
+from ..api.pelotonApi import peloton_workout_title, roundTime, set_peloton_workout_recommendations
+from ..api.athlete_context import AthleteContext
+from ..api.locks import RefreshLease
+from ..api.stream_archive import save_streams, load_streams, index_streams, stream_arrays
+from ..api.mmp import mean_max, duration_grid
+from ..api.power_curves import pack_curve_points, update_power_envelopes, rebuild_power_envelopes, envelope_sports
+from ..api.zones import classify_zones, power_zone_thresholds, heartrate_zone_thresholds, intensity_zone_map, \
+    intensity_seconds
 from dateutil.relativedelta import relativedelta
 from ..app import app
 from .database import engine
 from ..utils import peloton_credentials_supplied, stryd_credentials_supplied, config
-import os
 import pandas as pd
 from ..pages.performance import get_hrv_df, readiness_score_recommendation
 
@@ -24,53 +32,54 @@ types = ['time', 'latlng', 'distance', 'altitude', 'velocity_smooth', 'heartrate
          'moving', 'grade_smooth']
 
 
-def db_process_flag(flag):
-    if flag:
-        # Check if already processing, otherwise set flag
-        processing = app.session.query(dbRefreshStatus).filter(dbRefreshStatus.refresh_method == 'processing').first()
-        if not processing:
-            record = dbRefreshStatus(timestamp_utc=datetime.utcnow(), refresh_method='processing')
-            # Insert and commit
-            try:
-                app.session.add(record)
-                app.session.commit()
-                app.server.logger.debug('Processing started...')
-            except BaseException as e:
-                app.session.rollback()
-                app.server.logger.error('Failed to insert processing record into db_refresh: ', str(e))
-
+def samples_frame(streams, start_date_local, start_date_utc):
+    '''
+    Build the 1s samples frame from an activity's streams. Timestamps, latlng and unit conversions are done on
+    whole arrays rather than per sample.
+    :param streams: dict of stream type -> numpy array, as returned by get_streams()
+    :param start_date_local: activity start in local time
+    :param start_date_utc: activity start in utc, without tzinfo
+    :return: DataFrame indexed by timestamp_local
+    '''
+    data = {item: streams[item] for item in types if item in streams and item != 'latlng'}
+    # Split latlng pairs into columns, activities without gps still get (empty) latitude/longitude
+    latlng = streams['latlng'] if 'latlng' in streams else np.full((len(streams['time']), 2), np.nan)
+    data['latitude'] = latlng[:, 0].astype(float)
+    data['longitude'] = latlng[:, 1].astype(float)
+    df = pd.DataFrame(data, index=pd.DatetimeIndex(
+        start_date_local + pd.to_timedelta(streams['time'], unit='s'), name='timestamp_local'))
+
+    # Interpolate samples - each workout in samples data should already be at 1s intervals, calling resample fills in gaps so mean() does not matter
+    if len(df) > 1 and (np.diff(streams['time']) == 1).all():
+        # Already at 1s intervals without gaps, so resampling would only convert every column to float
+        df = df.astype(float)
     else:
-        app.session.query(dbRefreshStatus).filter(dbRefreshStatus.refresh_method == 'processing').delete()
-        app.session.commit()
-        app.server.logger.debug('Processing complete')
-
-    app.session.remove()
+        df = df.resample('1S').mean()
+    df = df.interpolate(limit_direction='both')  # TODO: Consider if interpolating of nans is skuing data too much
 
+    # Whole seconds into the activity, used for the utc timestamp and time interval
+    elapsed = df['time'].values.astype('int64')
+    df['timestamp_utc'] = start_date_utc + pd.to_timedelta(elapsed, unit='s')
 
-def calctime(time_sec, startdate):
-    try:
-        timestamp = startdate + timedelta(seconds=int(time_sec))
-    except BaseException as e:
-        timestamp = startdate
-    return timestamp
-
-
-def get_peloton_workout_summary_cache(act_start_date_utc):
-    pelton_cache_dir = os.path.join(os.getcwd(), 'peloton-cache.csv')
-    # Check if there is already a file
-    cache_exists = os.path.isfile(pelton_cache_dir)
-    # Parse through max date
-    if not cache_exists:
-        app.server.logger.debug('Fetching new peloton worokout summary cache')
-        peloton_mapping_df().to_csv(pelton_cache_dir, sep=',')
+    if 'altitude' in df.columns:  # Indoor activity samples wont have altitudes
+        df['altitude'] *= 3.28084
     else:
-        # If latest workout is more than 15 minutes newer than max workout in cache, refresh the cache
-        if (pd.to_datetime(act_start_date_utc).tz_localize(None) - pd.to_datetime(
-                pd.read_csv(pelton_cache_dir)['start']).max()).total_seconds() > (60 * 15):
-            app.server.logger.debug('Fetching new peloton cache')
-            peloton_mapping_df().to_csv(pelton_cache_dir, sep=',')
-
-    return pd.read_csv(pelton_cache_dir)
+        df['altitude'] = None
+    if 'temp' in df.columns:
+        # Convert celcius to farenheit
+        df['temp'] = (df['temp'] * (9 / 5)) + 32
+    if 'velocity_smooth' in df.columns:
+        # Convert meter per second to mph
+        df['velocity_smooth'] *= 2.23694
+    if 'distance' in df.columns:
+        # Convert meters to feet
+        df['distance'] *= 3.28084
+
+    # Add Time Interval
+    df['time_interval'] = pd.to_datetime(elapsed, unit='s')
+    # Add date column
+    df['date'] = df.index.date
+    return df
 
 
 class FitlyActivity(stravalib.model.Activity):
@@ -79,18 +88,29 @@ class FitlyActivity(stravalib.model.Activity):
         activity.__class__ = FitlyActivity
         return activity
 
-    def stravaScrape(self, athlete_id):
-        # # Set up athlete for the workout
-        app.server.logger.debug('Activity id "{}": Assigning athlete id {}'.format(self.id, athlete_id))
-        self.assign_athlete(athlete_id)
+    def stravaScrape(self, athlete_id, client=None, context=None):
+        self.fetch(client=client)
+        self.load(athlete_id, context=context)
+
+    def fetch(self, client=None):
+        # Network bound stage of the scrape, does not touch the db so it can run concurrently across activities
         # Update strava names of peloton workouts
         if peloton_credentials_supplied:
             app.server.logger.debug('Activity id "{}": Pulling peloton title'.format(self.id))
-            self.get_peloton_workout_title()
+            self.get_peloton_workout_title(client=client)
+        # Pull raw streams, from the local archive if this activity has already been downloaded
+        app.server.logger.debug('Activity id "{}": Fetching streams'.format(self.id))
+        self.get_streams(client=client)
         # Build activity samples df
         app.server.logger.debug('Activity id "{}": Building df_samples'.format(self.id))
         self.build_df_samples()
 
+    def load(self, athlete_id, context=None):
+        # Analyze the fetched streams and write them to the db
+        # # Set up athlete for the workout
+        app.server.logger.debug('Activity id "{}": Assigning athlete id {}'.format(self.id, athlete_id))
+        self.assign_athlete(athlete_id, context=context)
+
         # Only import strava workout if there is stream data
         if hasattr(self, 'df_samples'):
             # Build activity summary df
@@ -117,20 +137,24 @@ class FitlyActivity(stravalib.model.Activity):
             # Get summary analytics
             app.server.logger.debug('Activity id "{}": Calculating summary analytics'.format(self.id))
             self.get_summary_analytics()
-            # Write strava_best_samples
+            # Write strava_power_curves
             app.server.logger.debug('Activity id "{}": Writing mean max power to DB'.format(self.id))
             self.compute_mean_max_power(dbinsert=True)
             # Write df_summary and df_samples to db
             app.server.logger.debug('Activity id "{}": Writing df_summary and df_samples to DB'.format(self.id))
             self.write_dfs_to_db()
+            # Archive downloaded streams only once the activity is in the db, so a failed load leaves no archive behind
+            if self.streams_downloaded:
+                save_streams(self.id, self.streams)
+            index_streams(self.id, athlete_id, self.streams)
+            self.context.record_activity(self)
         else:
             app.server.logger.debug(f'No streams data returned for activity {self.id}')
 
-    def assign_athlete(self, athlete_id):
-
-        self.Athlete = app.session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
-
-        app.session.remove()
+    def assign_athlete(self, athlete_id, context=None):
+        # Reuse the batch's athlete context if there is one, otherwise load one just for this activity
+        self.context = context or AthleteContext(athlete_id)
+        self.Athlete = self.context.athlete
 
         self.hearrate_zones = {
             1: float(self.Athlete.hr_zone_threshold_1),
@@ -155,25 +179,15 @@ class FitlyActivity(stravalib.model.Activity):
                 4: float(self.Athlete.run_power_zone_threshold_4)
             }
 
-    def get_peloton_workout_title(self, write_to_strava=True):
+    def get_peloton_workout_title(self, write_to_strava=True, client=None):
         ## Assumes recorded ride is started within 5 minutes of peloton video
-        client = get_strava_client()
-        peloton_df = get_peloton_workout_summary_cache(self.start_date)
-        peloton_df['start'] = pd.to_datetime(peloton_df['start'])
-        peloton_df['created_at'] = pd.to_datetime(peloton_df['created_at'])
-        start = roundTime(self.start_date)
-        activity = peloton_df[
-            ((peloton_df['start'] >= (start - timedelta(minutes=10))) & (
-                    peloton_df['start'] <= (start + timedelta(minutes=10))))
-            |
-            ((peloton_df['created_at'] >= (start - timedelta(minutes=10))) & (
-                    peloton_df['created_at'] <= (start + timedelta(minutes=10))))
-            ]
-
-        if len(activity) > 0:
+        client = client or get_strava_client()
+        title = peloton_workout_title(self.start_date)
+
+        if title:
             # Remove 'Just Run/Ride' and 'Scenic' titles from being updated to strava
-            if ' Just ' not in activity.name.values[0] and ' Scenic ' not in activity.name.values[0]:
-                self.peloton_title = activity.name.values[0]
+            if ' Just ' not in title and ' Scenic ' not in title:
+                self.peloton_title = title
                 self.name = self.peloton_title if len(self.peloton_title) > 0 else self.name
                 if write_to_strava and client.get_activity(activity_id=self.id).name != self.peloton_title:
                     client.update_activity(activity_id=self.id, name=self.peloton_title)
@@ -183,18 +197,13 @@ class FitlyActivity(stravalib.model.Activity):
         # Assign rhr to activities by their start date
 
         # Try grabbing last resting heartrate from oura
-        hr_lowest = app.session.query(ouraSleepSummary.hr_lowest).filter(
-            ouraSleepSummary.report_date <= self.start_date.date()).order_by(
-            ouraSleepSummary.report_date.desc()).first()
+        hr_lowest = self.context.rest_hr.as_of(self.start_date.date())
         # If activity is prior to first oura data record, use first oura data record
-        if not hr_lowest:
-            hr_lowest = \
-                app.session.query(ouraSleepSummary.hr_lowest).order_by(ouraSleepSummary.report_date.asc()).first()
-
-        app.session.remove()
+        if hr_lowest is None:
+            hr_lowest = self.context.rest_hr.first()
 
-        if hr_lowest:
-            self.hr_lowest = hr_lowest[0]
+        if hr_lowest is not None:
+            self.hr_lowest = hr_lowest
         # Resort to manaully entered static athlete resting heartrate if no data source to pull from
         else:
             self.hr_lowest = self.Athlete.resting_hr
@@ -203,16 +212,13 @@ class FitlyActivity(stravalib.model.Activity):
         # TODO: Build this out so weight data can be pulled from other data sources
 
         # Try grabbing last weight in withings before current workout
-        weight = app.session.query(withings.weight).filter(withings.date_utc <= self.start_date).order_by(
-            withings.date_utc.desc()).first()
+        weight = self.context.weight.as_of(self.start_date.replace(tzinfo=None))
         # Else try getting most recent weight from withings
-        if not weight:
-            weight = app.session.query(withings.weight).order_by(withings.date_utc.asc()).first()
-
-        app.session.remove()
+        if weight is None:
+            weight = self.context.weight.first()
 
         if weight:
-            weight = float(weight[0])
+            weight = float(weight)
         # If no weights in withings, resort to manually entered static weight from athlete table
 
         if not weight:
@@ -222,22 +228,18 @@ class FitlyActivity(stravalib.model.Activity):
         self.kg = weight * 0.453592
 
     def get_ftp(
-            self):  # TODO: Update with auto calculated critical power so users do not have to flag (or take) FTP tests
+            self,
+            link_stryd=True):  # TODO: Update with auto calculated critical power so users do not have to flag (or take) FTP tests
         self.stryd_metrics = []
         if 'run' in self.type.lower() or 'walk' in self.type.lower():
             # If stryd credentials in config, grab ftp
             if stryd_credentials_supplied:
-                stryd_df = pd.read_sql(
-                    sql=app.session.query(strydSummary).statement,
-                    con=engine).sort_index(ascending=False)
                 start = roundTime(self.start_date_local)
                 # Save stryd df for current workout to instance to use metrics later and avoid having to hit API again
-                self.stryd_metrics = stryd_df[
-                    (stryd_df['start_date_local'] >= (start - timedelta(minutes=5))) & (
-                            stryd_df['start_date_local'] <= (start + timedelta(minutes=5)))]
+                self.stryd_metrics = self.context.stryd_workouts(start, window=timedelta(minutes=5))
 
                 # If we match a strava workout to stryd workout, insert strava activity id into stryd table
-                if len(self.stryd_metrics) > 0:
+                if link_stryd and len(self.stryd_metrics) > 0:
                     stryd_workout = app.session.query(strydSummary).filter(
                         strydSummary.start_date_local == pd.to_datetime(
                             self.stryd_metrics['start_date_local'].values[0]))
@@ -257,19 +259,13 @@ class FitlyActivity(stravalib.model.Activity):
         elif 'ride' in self.type.lower():
             # TODO: Switch over to using Critical Power for everything once we get the critical power model working
 
-            try:
-                self.ftp = float(
-                    app.session.query(stravaSummary.average_watts).order_by(
-                        stravaSummary.start_date_local.desc()).filter(
-                        stravaSummary.start_date_local < self.start_date_local,
-                        stravaSummary.type.ilike('%ride%'),
-                        stravaSummary.name.ilike('%ftp test%')).first()[0]) * .95
-            except:
+            ftp_test_watts = self.context.ride_ftp_tests.as_of(self.start_date_local, inclusive=False)
+            if ftp_test_watts is not None:
+                self.ftp = float(ftp_test_watts) * .95
+            else:
                 # If no FTP test prior to current activity
                 self.ftp = self.Athlete.ride_ftp
 
-            app.session.remove()
-
         else:
             self.ftp = None
 
@@ -384,14 +380,15 @@ class FitlyActivity(stravalib.model.Activity):
 
             return workout_tss, ri
 
-    def get_summary_analytics(self):
+    def get_summary_analytics(self, wss=None):
         self.trimp, self.hrss, self.wap, self.tss, self.ri, self.variability_index, self.efficiency_factor = None, None, None, None, None, None, None
         activity_length = self.df_samples['time'].max()
 
         trimp_weighting_factor = 1.92 if str(self.Athlete.birthday).upper() == 'M' else 1.67
         # Calculate power metrics
         if 'weighttraining' in self.type.lower():
-            self.tss, self.ri = self.wss_score()
+            # wSS can be passed in when it has already been scored (i.e. reprocessing)
+            self.tss, self.ri = wss if wss is not None else self.wss_score()
 
         elif self.max_watts is not None and self.ftp is not None:
             self.wap = weighted_average_power(self.df_samples['watts'].to_numpy())
@@ -471,80 +468,21 @@ class FitlyActivity(stravalib.model.Activity):
         self.df_summary['type'] = [self.type]
         self.df_summary.set_index(['start_date_utc'], inplace=True)
 
-    def build_df_samples(self):
-        seconds = 1
-        streams = get_strava_client().get_activity_streams(self.id, types=types)
+    def get_streams(self, client=None):
+        self.streams = load_streams(self.id)
+        self.streams_downloaded = self.streams is None
+        if self.streams_downloaded:
+            client = client or get_strava_client()
+            streams = client.get_activity_streams(self.id, types=types)
+            # Raw streams are archived by load() so the activity never has to be downloaded again
+            self.streams = stream_arrays({stream_type: stream.data for stream_type, stream in
+                                          streams.items()}) if streams else {}
+
+    def build_df_samples(self, streams=None):
+        streams = self.streams if streams is None else streams
         # Only create df_samples if there is a response from the strava streams api
         if streams:
-            self.df_samples = pd.DataFrame(columns=types)
-            # Write each row to a dataframe
-            for item in types:
-                if item in streams.keys():
-                    self.df_samples[item] = pd.Series(streams[item].data, index=None)
-            self.df_samples['start_date_local'] = self.start_date_local
-            self.df_samples['timestamp_local'] = pd.Series(
-                map(calctime, self.df_samples['time'], self.df_samples['start_date_local']))
-            self.df_samples.set_index('timestamp_local', inplace=True)
-
-            # Parse latlngs into seperate columns
-            try:
-                self.df_samples['latitude'] = self.df_samples['latlng'].apply(
-                    lambda x: x[0] if isinstance(x, list) else None).apply(
-                    pd.to_numeric,
-                    errors='coerce')
-                self.df_samples['longitude'] = self.df_samples['latlng'].apply(
-                    lambda x: x[1] if isinstance(x, list) else None).apply(
-                    pd.to_numeric,
-                    errors='coerce')
-            except KeyError:
-                self.df_samples['latitude'] = None
-                self.df_samples['longitude'] = None
-
-            # Interpolate samples - each workout in samples data should already be at 1s intervals, calling resample fills in gaps so mean() does not matter
-            self.df_samples = self.df_samples.resample(str(seconds) + 'S').mean()
-            self.df_samples = self.df_samples.interpolate(
-                limit_direction='both')  # TODO: Consider if interpolating of nans is skuing data too much
-
-            # Add Utc timestamp
-            self.df_samples.reset_index(inplace=True)
-            self.df_samples['start_date_utc'] = self.start_date.replace(tzinfo=None)
-            self.df_samples['timestamp_utc'] = pd.Series(
-                map(calctime, self.df_samples['time'], self.df_samples['start_date_utc']))
-            self.df_samples.drop(columns=['start_date_utc'], inplace=True)
-            self.df_samples.set_index('timestamp_local', inplace=True)
-
-            try:  # Indoor activity samples wont have altitudes
-                self.df_samples['altitude'] = self.df_samples['altitude'] * 3.28084
-            except KeyError:
-                self.df_samples['altitude'] = None
-
-            try:
-                # Convert celcius to farenheit
-                self.df_samples['temp'] = (self.df_samples['temp'] * (9 / 5)) + 32
-            except:
-                pass
-
-            try:
-                # Convert meter per second to mph
-                # self.df_samples['velocity_smooth'] = unithelper.mph(self.df_samples['velocity_smooth']).num
-                self.df_samples['velocity_smooth'] = self.df_samples['velocity_smooth'] * 2.23694
-            except BaseException as e:
-                pass
-
-            try:
-                # Convert meters to feet
-                # self.df_samples['distance'] = unithelper.feet(self.df_samples['distance']).num
-                self.df_samples['distance'] = self.df_samples['distance'] * 3.28084
-            except:
-                pass
-
-            # Add Time Interval
-            epoch = pd.to_datetime('1970-01-01')
-            self.df_samples['time_interval'] = self.df_samples['time'].astype('int').apply(
-                lambda x: epoch + timedelta(seconds=x))
-
-            # Add date column
-            self.df_samples['date'] = self.df_samples.index.date
+            self.df_samples = samples_frame(streams, self.start_date_local, self.start_date.replace(tzinfo=None))
             # Add activity id and name back in
             self.df_samples['activity_id'] = self.id
             self.df_samples['act_name'] = self.name
@@ -552,31 +490,9 @@ class FitlyActivity(stravalib.model.Activity):
     def calculate_power_zones(self):
         if self.max_watts is not None:
             if self.ftp is not None:
-                if 'ride' in self.type.lower():
-                    pz_5, pz_6 = self.power_zones[5], self.power_zones[6]
-                elif 'run' in self.type.lower() or 'walk' in self.type.lower():
-                    pz_5, pz_6 = 99, 99
-                self.df_samples['power_zone'] = np.nan
-
-                for i in self.df_samples.index:
-                    watts = self.df_samples.loc[i].watts
-                    if watts is not None:
-                        if watts <= round(self.ftp * self.power_zones[1]):
-                            self.df_samples.at[i, 'power_zone'] = 1
-                        elif watts <= round(self.ftp * self.power_zones[2]):
-                            self.df_samples.at[i, 'power_zone'] = 2
-                        elif watts <= round(self.ftp * self.power_zones[3]):
-                            self.df_samples.at[i, 'power_zone'] = 3
-                        elif watts <= round(self.ftp * self.power_zones[4]):
-                            self.df_samples.at[i, 'power_zone'] = 4
-                        elif watts <= round(self.ftp * pz_5):
-                            self.df_samples.at[i, 'power_zone'] = 5
-                        elif watts <= round(self.ftp * pz_6):
-                            self.df_samples.at[i, 'power_zone'] = 6
-                        else:
-                            self.df_samples.at[i, 'power_zone'] = 7
-                    else:
-                        return np.nan
+                self.df_samples['power_zone'] = classify_zones(
+                    self.df_samples['watts'].to_numpy(dtype=float),
+                    power_zone_thresholds(self.ftp, self.power_zones, self.type))
 
     def calculate_heartate_zones(self):
         if self.max_heartrate is not None:
@@ -584,27 +500,10 @@ class FitlyActivity(stravalib.model.Activity):
             self.athlete_max_hr = 220 - age
             self.rhr = self.hr_lowest
             self.hrr = self.athlete_max_hr - self.rhr
-            z1 = round((self.hrr * self.hearrate_zones[1]) + self.rhr)
-            z2 = round((self.hrr * self.hearrate_zones[2]) + self.rhr)
-            z3 = round((self.hrr * self.hearrate_zones[3]) + self.rhr)
-            z4 = round((self.hrr * self.hearrate_zones[4]) + self.rhr)
-
-            self.df_samples['hr_zone'] = np.nan
-            for i in self.df_samples.index:
-                heartrate = self.df_samples.loc[i].heartrate
-                if heartrate is not None:
-                    if heartrate <= z1:
-                        self.df_samples.at[i, 'hr_zone'] = 1
-                    elif heartrate <= z2:
-                        self.df_samples.at[i, 'hr_zone'] = 2
-                    elif heartrate <= z3:
-                        self.df_samples.at[i, 'hr_zone'] = 3
-                    elif heartrate <= z4:
-                        self.df_samples.at[i, 'hr_zone'] = 4
-                    else:
-                        self.df_samples.at[i, 'hr_zone'] = 5
-                else:
-                    return np.nan
+
+            self.df_samples['hr_zone'] = classify_zones(
+                self.df_samples['heartrate'].to_numpy(dtype=float),
+                heartrate_zone_thresholds(self.athlete_max_hr, self.rhr, self.hearrate_zones))
 
     # https://www.movescount.com/apps/app10925786-Strava_Suffer_Score
     # def strava_suffer_score(self):
@@ -626,79 +525,55 @@ class FitlyActivity(stravalib.model.Activity):
     #             return np.nan
 
     def calculate_zone_intensities(self):
-        df_zone_intensities = self.df_samples.copy()
-        df_zone_intensities = df_zone_intensities[df_zone_intensities['time'] != 0]
         # Check if power data, if not use heartrate data
         metric = 'power' if self.max_watts is not None and self.ftp is not None else 'heartrate' if self.max_heartrate is not None else 'none'
+        zone_map = intensity_zone_map(metric, self.type)
+        zones = self.df_samples.loc[self.df_samples['time'] != 0,
+                                    'power_zone' if metric == 'power' else 'hr_zone'] if zone_map else []
 
-        for i in df_zone_intensities.index:
-            # Check if power or heartrate data
-            if metric == 'power':
-                # If power data, check if run zones or ride zones should be used
-                if 'run' in self.type.lower() or 'walk' in self.type.lower():
-                    df_zone_intensities.at[i, 'intensity'] = 'low' if df_zone_intensities.at[
-                                                                          i, 'power_zone'] in [1,
-                                                                                               2] else 'med' if \
-                        df_zone_intensities.at[i, 'power_zone'] == 3 else 'high' if \
-                        df_zone_intensities.at[
-                            i, 'power_zone'] in [4, 5] else None
-                elif 'ride' in self.type.lower():
-                    df_zone_intensities.at[i, 'intensity'] = 'low' if df_zone_intensities.at[
-                                                                          i, 'power_zone'] in [1, 2,
-                                                                                               3] else 'med' if \
-                        df_zone_intensities.at[i, 'power_zone'] == 4 else 'high' if \
-                        df_zone_intensities.at[
-                            i, 'power_zone'] in [5, 6, 7] else None
-            elif metric == 'heartrate':
-                df_zone_intensities.at[i, 'intensity'] = 'low' if df_zone_intensities.at[
-                                                                      i, 'hr_zone'] in [1,
-                                                                                        2] else 'med' if \
-                    df_zone_intensities.at[i, 'hr_zone'] == 3 else 'high' if df_zone_intensities.at[
-                                                                                 i, 'hr_zone'] in [4,
-                                                                                                   5] else None
-        if 'intensity' in df_zone_intensities.columns:
-            intensity_seconds = df_zone_intensities['intensity'].value_counts()
-            try:
-                self.df_summary['low_intensity_seconds'] = [intensity_seconds.low]
-            except AttributeError:
-                self.df_summary['low_intensity_seconds'] = np.nan
-            try:
-                self.df_summary['mod_intensity_seconds'] = [intensity_seconds.med]
-            except AttributeError:
-                self.df_summary['mod_intensity_seconds'] = np.nan
-            try:
-                self.df_summary['high_intensity_seconds'] = [intensity_seconds.high]
-            except AttributeError:
-                self.df_summary['high_intensity_seconds'] = np.nan
+        if len(zones) > 0:
+            seconds = intensity_seconds(zones, zone_map)
+            self.df_summary['low_intensity_seconds'] = [seconds['low']]
+            self.df_summary['mod_intensity_seconds'] = [seconds['med']]
+            self.df_summary['high_intensity_seconds'] = [seconds['high']]
 
             self.df_summary['workout_intensity'] = self.df_summary[
                 ['low_intensity_seconds', 'mod_intensity_seconds', 'high_intensity_seconds']].idxmax(
                 axis=1).values[0].replace('_intensity_seconds', '')
 
+    def mean_max_curve(self, column='watts', grid='full'):
+        '''
+        Mean max curve of a 1s sample column (watts, heartrate, velocity_smooth...)
+        :param grid: 'full' for every second of the activity, 'log' for the durations plotted on the power curve
+        :return: Series indexed by duration in seconds
+        '''
+        durations = duration_grid(len(self.df_samples), grid=grid)
+        return pd.Series(mean_max(self.df_samples[column].values, durations), index=pd.Index(durations, name='time'))
+
     def compute_mean_max_power(self, dbinsert=False):
         if self.max_watts is not None:
-            df = self.df_samples.copy()
-            df = df.rename(columns={"watts": "power", "velocity_smooth": "speed"})
-            self.mmp_df = pd.Series(WorkoutDataFrame(df).compute_mean_max_power(), name='mmp').to_frame()
-            # Update time index so it starts at 1 second (instead of 0)
-            self.mmp_df['time'] = [x for x in range(1, len(self.mmp_df) + 1)]
-            self.mmp_df.set_index('time', inplace=True)
+            # Stored on the plotted durations, the full 1s grid is quadratic in the activity length
+            self.mmp_df = self.mean_max_curve('watts', grid='log').rename('mmp').to_frame()
             if dbinsert:
-                df = self.df_samples.copy()
-                df.rename(columns={'time': 'interval'}, inplace=True)
-                for col in ['distance', 'velocity_smooth', 'heartrate', 'cadence', 'watts', 'moving', 'grade_smooth',
-                            'latitude', 'longitude', 'altitude', 'power_zone', 'hr_zone', 'temp']:
-                    if col in df.columns:
-                        df = df.drop(columns=col)
-                df = df[df['interval'] != 0]
-                df['mmp'] = df['interval'].map(self.mmp_df['mmp'].to_dict())
-                df['watts_per_kg'] = df['mmp'] / self.kg
-                df['timestamp_local'] = df.index
-                df['type'] = self.type
-                df['athlete_id'] = self.Athlete.athlete_id
-                df['ftp'] = self.ftp
-                df.set_index(['activity_id', 'interval'], inplace=True)
-                df.to_sql('strava_best_samples', engine, if_exists='append', index=True)
+                power_curve = self.power_curve()
+                app.session.merge(stravaPowerCurve(**power_curve))
+                app.session.commit()
+                app.session.remove()
+                update_power_envelopes(power_curve)
+
+    def power_curve(self):
+        # strava_power_curves row for the activity's mean max power curve
+        return {'activity_id': self.id,
+                'athlete_id': self.Athlete.athlete_id,
+                'type': self.type,
+                'act_name': self.name,
+                'date': self.start_date_local.date(),
+                'timestamp_local': self.start_date_local,
+                'timestamp_utc': self.start_date.replace(tzinfo=None),
+                'ftp': float(self.ftp) if self.ftp is not None else None,
+                'kg': float(self.kg) if self.kg is not None else None,
+                'durations': int(self.mmp_df.index.max()) if len(self.mmp_df) else 0,
+                'mmp': pack_curve_points(self.mmp_df['mmp'])}
 
     def sweatpy_cp_model(self, model='3_parameter_non_linear'):
         # Models that can be passed = '2_parameter_non_linear', '3_parameter_non_linear', 'extended_5_3','extended_7_3'
@@ -725,6 +600,83 @@ class FitlyActivity(stravalib.model.Activity):
         self.df_samples.fillna(np.nan).to_sql('strava_samples', engine, if_exists='append', index=True)
 
 
+def delete_activity_rows(activity_id, keep_streams=False):
+    '''
+    Remove an activity's rows from the strava tables, and rebuild the power curve envelopes it may have points in
+    :param keep_streams: leave the strava_streams row, for when the stream archive is kept
+    '''
+    activity_type = app.session.query(stravaPowerCurve.type).filter(
+        stravaPowerCurve.activity_id == activity_id).scalar()
+    app.session.execute(delete(stravaSummary).where(stravaSummary.activity_id == activity_id))
+    app.session.execute(delete(stravaSamples).where(stravaSamples.activity_id == activity_id))
+    app.session.execute(delete(stravaPowerCurve).where(stravaPowerCurve.activity_id == activity_id))
+    if not keep_streams:
+        app.session.execute(delete(stravaStreams).where(stravaStreams.activity_id == activity_id))
+    app.session.commit()
+    app.session.remove()
+    sports = envelope_sports(activity_type) if activity_type else []
+    if sports:
+        rebuild_power_envelopes(sports=sports)
+
+
+def scrape_activities(activities, athlete_id, max_workers=None, client=None, on_loaded=None, on_error=None):
+    '''
+    Scrape a batch of new strava activities. Streams (and peloton titles) are fetched by a pool of workers while
+    activities are analyzed and written to the db one at a time, in the order they were passed in.
+    :param activities: list of FitlyActivity, oldest first
+    :param athlete_id: athlete to assign the activities to
+    :param max_workers: number of concurrent fetches, defaults to [strava] max_workers in config.ini
+    :param client: strava client shared by the workers, defaults to get_strava_client()
+    :param on_loaded: called with each activity once it has been written to the db
+    :param on_error: called with each activity that fails and the exception, the batch then carries on with the next
+    activity. Without it the first failure stops the batch. Rate limit errors always stop the batch
+    '''
+    max_workers = max_workers or int(config.get('strava', 'max_workers', fallback=4))
+    # Share one client across workers so tokens are only read (and refreshed) once
+    client = client or get_strava_client()
+    # Athlete settings and history are loaded once for the whole batch
+    context = AthleteContext(athlete_id)
+    activities = iter(activities)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Only fetch a couple of activities ahead of the writer so a large backfill doesn't hold every stream in memory
+        for act in islice(activities, max_workers * 2):
+            pending.append((act, executor.submit(act.fetch, client)))
+        try:
+            while pending:
+                act, fetch = pending.popleft()
+                try:
+                    fetch.result()
+                    act.load(athlete_id, context=context)
+                except stravalib.exc.RateLimitExceeded:
+                    raise
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    app.session.rollback()
+                    app.session.remove()
+                    # The power curve, envelopes, summary and samples are committed separately, so remove whatever
+                    # was written before the failure, otherwise a retry fails on the existing strava_summary row
+                    try:
+                        delete_activity_rows(act.id, keep_streams=True)
+                    except Exception as cleanup_error:
+                        app.session.rollback()
+                        app.session.remove()
+                        app.server.logger.error(f'Error removing partial rows of activity {act.id}: {cleanup_error}')
+                    on_error(act, e)
+                else:
+                    if on_loaded:
+                        on_loaded(act)
+                next_act = next(activities, None)
+                if next_act is not None:
+                    pending.append((next_act, executor.submit(next_act.fetch, client)))
+        except BaseException:
+            # Don't wait on queued fetches if an activity fails
+            for _, queued in pending:
+                queued.cancel()
+            raise
+
+
 def training_workflow(min_non_warmup_workout_time, metric='hrv_baseline', athlete_id=1):
     '''
     Query db for oura hrv data, calculate rolling 7 day average, generate recommended workout and store in db.
@@ -732,9 +684,12 @@ def training_workflow(min_non_warmup_workout_time, metric='hrv_baseline', athlet
     '''
 
     # https://www.alancouzens.com/blog/Training_prescription_guided_by_HRV_in_cycling.pdf
+    # Runs after strava syncs and from the settings page, only one can write the workout step log at a time
+    lease = RefreshLease(['hrv_workflow'])
+    if not lease.acquire():
+        app.server.logger.info('HRV workflow is already running')
+        return
     try:
-        db_process_flag(flag=True)
-
         # Check if entire table is empty, if so the earliest hrv plan can start is after 30 days of hrv readings
         # If using readiness score, just use first score available
         db_test = pd.read_sql(
@@ -761,7 +716,6 @@ def training_workflow(min_non_warmup_workout_time, metric='hrv_baseline', athlet
             except BaseException as e:
                 app.server.logger.error(f'Check enough oura data exists to generate workout recommendation: {e}')
                 oura_data_exists = False
-                db_process_flag(flag=False)
 
         if oura_data_exists:
             # Check if a step has already been inserted for today and if so check if workout has been completed yet
@@ -969,8 +923,9 @@ def training_workflow(min_non_warmup_workout_time, metric='hrv_baseline', athlet
                             time_period=athlete_info.spotify_time_period,
                             num_playlists=athlete_info.spotify_num_playlists)
 
-    except BaseException as e:  # If workflow fails be sure to turn off processing flag
+    except BaseException as e:
         app.server.logger.error(e)
-        db_process_flag(flag=False)
+    finally:
+        lease.release()
 
     app.session.remove()
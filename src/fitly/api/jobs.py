@@ -0,0 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import threading
+import uuid
+from flask import jsonify
+from ..api.sqlalchemy_declarative import fitlyJob
+from ..app import app
+
+# Long running work started from the ui (refresh, truncate, reprocess...) runs here instead of inside the dash
+# request, one job at a time per process so jobs don't compete with each other for the db or api rate limits
+job_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fitly-job')
+
+# Job the current thread is running, used by job_progress() to know which record to update
+current_job = threading.local()
+
+ACTIVE_STATUSES = ['queued', 'running']
+
+
+def update_job(job_id, **values):
+    app.session.query(fitlyJob).filter(fitlyJob.job_id == job_id).update(values)
+    app.session.commit()
+    app.session.remove()
+
+
+def submit_job(name, func, *args, **kwargs):
+    '''
+    Queue a function to run in the background job executor
+    :param name: description shown in the ui while the job is running
+    :return: job id, used to poll job_status()
+    '''
+    job_id = str(uuid.uuid4())
+    app.session.add(fitlyJob(job_id=job_id, name=name, status='queued', submitted_utc=datetime.utcnow()))
+    app.session.commit()
+    app.session.remove()
+    job_executor.submit(run_job, job_id, name, func, args, kwargs)
+    app.server.logger.debug(f'Queued job "{name}" ({job_id})')
+    return job_id
+
+
+def run_job(job_id, name, func, args, kwargs):
+    current_job.job_id = job_id
+    update_job(job_id, status='running', started_utc=datetime.utcnow())
+    try:
+        func(*args, **kwargs)
+        update_job(job_id, status='complete', stage='Complete', finished_utc=datetime.utcnow())
+    except BaseException as e:
+        app.session.rollback()
+        app.server.logger.error(f'Error running job "{name}": {e}')
+        update_job(job_id, status='error', error=str(e)[:255], finished_utc=datetime.utcnow())
+    finally:
+        current_job.job_id = None
+        app.session.remove()
+
+
+def job_progress(stage):
+    # Record the stage the current job has reached, does nothing when not called from a job (i.e. the hourly cron)
+    job_id = getattr(current_job, 'job_id', None)
+    if job_id:
+        update_job(job_id, stage=str(stage)[:255])
+
+
+def job_status(job_id):
+    job = app.session.query(fitlyJob).filter(fitlyJob.job_id == job_id).first()
+    app.session.remove()
+    if job:
+        return {'job_id': job.job_id, 'name': job.name, 'status': job.status, 'stage': job.stage,
+                'error': job.error, 'submitted_utc': job.submitted_utc, 'started_utc': job.started_utc,
+                'finished_utc': job.finished_utc}
+
+
+def latest_job():
+    # Most recently submitted job, for the settings page status line
+    job = app.session.query(fitlyJob.job_id).order_by(fitlyJob.submitted_utc.desc()).first()
+    app.session.remove()
+    return job_status(job.job_id) if job else None
+
+
+def active_job():
+    job = app.session.query(fitlyJob.job_id).filter(fitlyJob.status.in_(ACTIVE_STATUSES)).first()
+    app.session.remove()
+    return job is not None
+
+
+def fail_interrupted_jobs():
+    # Jobs run in server threads, so anything still queued or running when the server starts was killed by a restart
+    app.session.query(fitlyJob).filter(fitlyJob.status.in_(ACTIVE_STATUSES)).update(
+        {'status': 'error', 'error': 'Interrupted by server restart', 'finished_utc': datetime.utcnow()},
+        synchronize_session=False)
+    app.session.commit()
+    app.session.remove()
+
+
+@app.server.route('/jobs/<job_id>')
+def job_status_endpoint(job_id):
+    # Lightweight status endpoint that can be polled without loading a dash page
+    status = job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(status)
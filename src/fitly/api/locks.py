@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+import os
+import socket
+import threading
+import uuid
+from sqlalchemy import insert, update, delete
+from sqlalchemy.exc import IntegrityError
+from ..api.sqlalchemy_declarative import refreshLock
+from ..app import app
+from ..utils import config
+
+# Every provider refresh_database pulls from, truncating takes all of them
+PROVIDERS = ['withings', 'fitbod', 'oura', 'stryd', 'peloton', 'strava']
+
+
+class LockHeld(Exception):
+    pass
+
+
+def lock_owner():
+    # Unique per job, the host/pid make it easy to see who holds a lock when looking at the table
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class RefreshLease:
+    '''
+    Lease on one or more named locks in the refresh_locks table. Leases expire unless they are renewed by the
+    heartbeat thread, so a job that crashes (or a server that is killed) releases its locks automatically.
+    Acquiring is race free: a lock is either inserted, or taken over with a single conditional update that only
+    matches if the existing lease has expired or is already ours.
+    :param names: locks to take, all or nothing (i.e. a provider name, or PROVIDERS for a truncate)
+    :param owner: owner id, leases with the same owner can re-take each other's locks
+    :param ttl: seconds the lease lasts without a heartbeat, defaults to [cron] lock_ttl_seconds in config.ini
+    '''
+
+    def __init__(self, names, owner=None, ttl=None):
+        self.names = list(names)
+        self.owner = owner or lock_owner()
+        self.ttl = ttl or float(config.get('cron', 'lock_ttl_seconds', fallback=120))
+        self.held = []
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat_thread = None
+
+    def take(self, name):
+        now = datetime.utcnow()
+        values = {'owner': self.owner, 'acquired_utc': now, 'heartbeat_utc': now,
+                  'expires_utc': now + timedelta(seconds=self.ttl)}
+        try:
+            app.session.execute(insert(refreshLock).values(name=name, **values))
+            app.session.commit()
+            return True
+        except IntegrityError:
+            app.session.rollback()
+        result = app.session.execute(update(refreshLock).where(
+            refreshLock.name == name, (refreshLock.expires_utc < now) | (refreshLock.owner == self.owner)).values(
+            **values))
+        app.session.commit()
+        return result.rowcount == 1
+
+    def acquire(self):
+        self.stop_heartbeat.clear()
+        try:
+            for name in self.names:
+                if not self.take(name):
+                    app.server.logger.debug(f'Lock "{name}" is held by another job')
+                    self.release()
+                    return False
+                self.held.append(name)
+        finally:
+            app.session.remove()
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+        return True
+
+    def heartbeat(self):
+        while not self.stop_heartbeat.wait(self.ttl / 3):
+            try:
+                now = datetime.utcnow()
+                result = app.session.execute(update(refreshLock).where(
+                    refreshLock.name.in_(self.held), refreshLock.owner == self.owner).values(
+                    heartbeat_utc=now, expires_utc=now + timedelta(seconds=self.ttl)))
+                app.session.commit()
+                if result.rowcount < len(self.held):
+                    app.server.logger.warning(f'Lost lease on {self.held}')
+            except BaseException as e:
+                app.session.rollback()
+                app.server.logger.error(f'Error renewing lease on {self.held}: {e}')
+            finally:
+                app.session.remove()
+
+    def release(self):
+        self.stop_heartbeat.set()
+        if self.heartbeat_thread and self.heartbeat_thread is not threading.current_thread():
+            self.heartbeat_thread.join()
+        if self.held:
+            app.session.execute(delete(refreshLock).where(refreshLock.name.in_(self.held),
+                                                          refreshLock.owner == self.owner))
+            app.session.commit()
+            app.session.remove()
+        self.held = []
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockHeld(f'Already running: {", ".join(self.names)}')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def locks_held(names=None):
+    # Names of unexpired locks, optionally limited to some names
+    query = app.session.query(refreshLock.name).filter(refreshLock.expires_utc >= datetime.utcnow())
+    if names:
+        query = query.filter(refreshLock.name.in_(names))
+    held = [name for name, in query]
+    app.session.remove()
+    return held
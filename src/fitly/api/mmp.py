@@ -0,0 +1,63 @@
+import math
+import numpy as np
+
+
+def log_durations(max_duration):
+    '''
+    Durations (seconds) plotted on the power curve, and stored at ingest: every second up to 1 min, every 5 seconds
+    up to 20 mins, every 30 seconds up to 1 hour, then steps growing by ~2% (rounded to the minute). The number of
+    durations grows with the log of the activity length, so evaluating a curve on them is not quadratic.
+    :param max_duration: longest duration available, e.g. max(strava_power_curves.durations)
+    '''
+    limit = int(math.floor(max_duration / 10.0)) * 10
+    durations = list(range(1, 61))
+    durations += list(range(65, 1201, 5))
+    durations += list(range(1230, min(limit, 3600) + 1, 30))
+    duration = 3600
+    while True:
+        duration = int(round(duration * 1.02 / 60)) * 60
+        if duration > limit:
+            break
+        durations.append(duration)
+    return durations
+
+
+def duration_grid(samples, grid='full'):
+    '''
+    Durations a mean max curve is evaluated at for an activity with a number of 1s samples
+    :param grid: 'full' for every second, 'log' for the durations plotted on the power curve
+    '''
+    if grid == 'full':
+        return np.arange(1, samples)
+    elif grid == 'log':
+        return np.array([d for d in log_durations(samples) if d < samples], dtype=int)
+    raise ValueError(f'Unknown duration grid: {grid}')
+
+
+def mean_max(values, durations=None):
+    '''
+    Best average of a 1s stream over each duration, computed from differences of the cumulative sum so each
+    duration is a single vectorized pass. Matches sweat's mean_max(), including skipping windows that touch a NaN
+    and only evaluating durations shorter than the stream.
+    :param values: 1s samples (watts, heartrate, speed...)
+    :param durations: durations in seconds, defaults to every second (1 to len(values) - 1)
+    :return: float array of mean max values, one per duration
+    '''
+    values = np.asarray(values, dtype=float)
+    if durations is None:
+        durations = duration_grid(len(values))
+    durations = np.asarray(durations, dtype=int)
+
+    # Cumulative sum that carries on past NaNs but keeps them NaN, same as pandas' cumsum
+    energy = np.cumsum(np.where(np.isnan(values), 0, values))
+    energy[np.isnan(values)] = np.nan
+
+    curve = np.full(len(durations), np.nan)
+    # Window sums are written into one buffer so long activities don't allocate an array per duration
+    window_sums = np.empty(len(energy))
+    for i, t in enumerate(durations):
+        if 0 < t < len(energy):
+            sums = np.subtract(energy[t:], energy[:-t], out=window_sums[:len(energy) - t])
+            # fmax ignores NaN windows, and returns NaN when every window has one
+            curve[i] = np.fmax.reduce(sums) / t
+    return curve
@@ -1,8 +1,8 @@
 from oura import OuraClient
 from ..api.sqlalchemy_declarative import ouraReadinessSummary, ouraActivitySummary, \
-    ouraActivitySamples, ouraSleepSamples, ouraSleepSummary, apiTokens
+    ouraActivitySamples, ouraSleepSamples, ouraSleepSummary, ouraDayHash, apiTokens
 from ..api.database import engine
-from sqlalchemy import func, delete
+from sqlalchemy import func, delete, insert
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
@@ -10,7 +10,10 @@ from ..app import app
 import ast
 from ..utils import config
 from functools import reduce
+from itertools import chain
 import pickle
+import hashlib
+import json
 
 client_id = config.get('oura', 'client_id')
 client_secret = config.get('oura', 'client_secret')
@@ -79,6 +82,111 @@ def connect_oura_link(auth_client):
     return url[0]
 
 
+def day_hashes(oura_data):
+    '''
+    Hash each day's raw api payload, so days that haven't changed since the last pull can be skipped
+    :param oura_data: list of readiness/activity/sleep records, records for the same day (naps) are hashed together
+    :return: dict of summary_date -> sha256 hex digest
+    '''
+    days = {}
+    for record in oura_data:
+        days.setdefault(pd.to_datetime(record['summary_date']).date(), []).append(record)
+    return {day: hashlib.sha256(json.dumps(records, sort_keys=True, default=str).encode()).hexdigest()
+            for day, records in days.items()}
+
+
+def changed_days(dataset, hashes):
+    stored = dict(app.session.query(ouraDayHash.summary_date, ouraDayHash.content_hash).filter(
+        ouraDayHash.dataset == dataset, ouraDayHash.summary_date.in_(list(hashes))).all())
+    app.session.remove()
+    return sorted(day for day, content_hash in hashes.items() if stored.get(day) != content_hash)
+
+
+def rewrite_changed_days(dataset, hashes, tables):
+    '''
+    Replace the rows of days whose payload changed since the last pull, in one transaction with their new hashes.
+    Unchanged days aren't written at all.
+    :param dataset: 'readiness', 'activity' or 'sleep'
+    :param hashes: dict from day_hashes()
+    :param tables: list of (model, df), each df has a summary_date column or index
+    '''
+    days = changed_days(dataset, hashes)
+    if not days:
+        app.server.logger.debug(f'No changes to oura {dataset} data')
+        return
+    app.server.logger.debug(f'Rewriting oura {dataset} data for {len(days)} changed days')
+    with engine.begin() as conn:
+        for model, df in tables:
+            summary_dates = df.index if df.index.name == 'summary_date' else df['summary_date']
+            changed = pd.to_datetime(pd.Series(summary_dates)).dt.date.isin(days).to_numpy()
+            conn.execute(delete(model).where(model.summary_date.in_(days)))
+            df[changed].to_sql(model.__tablename__, conn, if_exists='append', index=True)
+        conn.execute(delete(ouraDayHash).where(ouraDayHash.dataset == dataset, ouraDayHash.summary_date.in_(days)))
+        conn.execute(insert(ouraDayHash), [
+            {'dataset': dataset, 'summary_date': day, 'content_hash': hashes[day], 'timestamp_utc': datetime.utcnow()}
+            for day in days])
+
+
+def flatten_stream(oura_data, stream, digits=False):
+    '''
+    Flatten one sample stream of every day's payload into a single array
+    :param digits: stream is a string of single digit classes (class_5min, hypnogram_5min)
+    :return: values, number of values per day
+    '''
+    days = [x.get(stream) or ('' if digits else []) for x in oura_data]
+    lengths = np.array([len(day) for day in days], dtype=np.int64)
+    if digits:
+        values = np.frombuffer(''.join(days).encode('ascii'), dtype=np.uint8).astype(np.int64) - ord('0')
+    else:
+        values = np.array(list(chain.from_iterable(days)))
+        # Gaps come back as None, same as pandas store those as nan
+        if values.dtype == object:
+            values = np.array(list(chain.from_iterable(days)), dtype=float)
+    return values, lengths
+
+
+def local_timestamp(timestamp):
+    # Drop the timezone, we are just storing whatever the local time was, where the person was
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_localize(None) if timestamp.tzinfo else timestamp
+
+
+def expand_samples(oura_data, start_field, minutes, streams=(), digit_streams=()):
+    '''
+    Expand the sample streams of every day's payload in one pass. Streams are flattened into contiguous arrays and
+    timestamps are generated from each day's local start time plus the sample's offset within its day.
+    :param start_field: time of each day's first sample (day_start, bedtime_start)
+    :param minutes: minutes between samples
+    :param streams: list streams (met_1min, hr_5min...), digit_streams: digit string streams (class_5min...)
+    :return: df indexed by timestamp_local with a column per stream and summary_date. Days whose streams have
+             different lengths are padded with nan, as if each day's streams were concatenated side by side
+    '''
+    flat = {stream: flatten_stream(oura_data, stream) for stream in streams}
+    flat.update({stream: flatten_stream(oura_data, stream, digits=True) for stream in digit_streams})
+    day_lengths = np.max([lengths for _, lengths in flat.values()], axis=0) if oura_data else np.array([], np.int64)
+    day_offsets = np.cumsum(day_lengths) - day_lengths
+    total = int(day_lengths.sum())
+
+    columns = {}
+    for stream, (values, lengths) in flat.items():
+        if (lengths == day_lengths).all():
+            columns[stream] = values
+        else:
+            # Row of each value is its day's first row plus its position within the day
+            rows = np.repeat(day_offsets, lengths) + np.arange(lengths.sum()) - np.repeat(
+                np.cumsum(lengths) - lengths, lengths)
+            columns[stream] = np.full(total, np.nan)
+            columns[stream][rows] = values
+
+    starts = np.array([local_timestamp(x.get(start_field)).value for x in oura_data], dtype=np.int64)
+    sample_numbers = np.arange(total) - np.repeat(day_offsets, day_lengths)
+    timestamps = np.repeat(starts, day_lengths) + sample_numbers * minutes * 60 * 10 ** 9
+    df = pd.DataFrame(columns, index=pd.DatetimeIndex(timestamps, name='timestamp_local'))
+    df['summary_date'] = np.repeat(
+        np.array([pd.to_datetime(x.get('summary_date')).date() for x in oura_data], dtype=object), day_lengths)
+    return df
+
+
 def pull_readiness_data(oura, days_back=7):
     # Get latest date in db and pull everything after
     start = app.session.query(func.max(ouraReadinessSummary.report_date))
@@ -103,27 +211,19 @@ def pull_readiness_data(oura, days_back=7):
 
         df_readiness_summary.set_index('report_date', inplace=True)
 
-        return df_readiness_summary
+        return df_readiness_summary, day_hashes(oura_data)
     else:
-        return []
-
-
-def insert_readiness_data(df_readiness_summary, days_back=7):
-    start = app.session.query(func.max(ouraReadinessSummary.report_date))
-    start = '1999-01-01' if start[0][0] is None else datetime.strftime(start[0][0] - timedelta(days=days_back),
-                                                                       '%Y-%m-%d')
-    # Delete latest dates records from db to ensure values are being overridden from api pull
-    try:
-        app.server.logger.debug('Deleting >= {} records from oura_readiness_summary'.format(start))
-        app.session.execute(delete(ouraReadinessSummary).where(ouraReadinessSummary.summary_date >= start))
-        app.session.commit()
-    except BaseException as e:
-        app.server.logger.error(e)
+        return [], {}
 
-    app.session.remove()
 
-    app.server.logger.debug('Inserting oura readiness summary')
-    df_readiness_summary.to_sql('oura_readiness_summary', engine, if_exists='append', index=True)
+def insert_readiness_data(df_readiness_summary, hashes):
+    # Only days whose payload changed are deleted and re-inserted
+    if hashes:
+        app.server.logger.debug('Inserting oura readiness summary')
+        try:
+            rewrite_changed_days('readiness', hashes, [(ouraReadinessSummary, df_readiness_summary)])
+        except BaseException as e:
+            app.server.logger.error(e)
 
 
 def pull_activity_data(oura, days_back=7):
@@ -151,75 +251,29 @@ def pull_activity_data(oura, days_back=7):
         df_activity_summary = df_activity_summary.drop(columns=['met_1min', 'day_end', 'day_start'], axis=1)
 
         # Generate Activity Samples
-        df_1min_list, df_5min_list = [], []
-        for x in oura_data:
-            # build 1 min metrics df
-            df_1min = pd.Series(x.get('met_1min'), name='met_1min').to_frame()
-            df_1min['timestamp_local'] = pd.to_datetime(x.get('day_start')) + pd.to_timedelta(df_1min.index, unit='m')
-            df_1min = df_1min.set_index('timestamp_local')
-            # Remove timezone info from date, we are just storing whatever the local time was, where the person was
-            df_1min.index = df_1min.index.tz_localize(None)
-            df_1min['summary_date'] = pd.to_datetime(x.get('summary_date')).date()
-            df_1min_list.append(df_1min)
-
-            # build 5 min metrics df
-            df_5min = pd.Series([int(y) for y in x.get('class_5min')], name='class_5min').to_frame()
-            df_5min['class_5min_desc'] = df_5min['class_5min'].fillna('5').astype('str').map(
-                {'0': 'Rest', '1': 'Inactive', '2': 'Low', '3': 'Medium', '4': 'High', '5': 'Non-Wear'})
-            df_5min.index += 1
-            df_5min['timestamp_local'] = (pd.to_datetime(x.get('day_start')) + pd.to_timedelta(df_5min.index * 5,
-                                                                                               unit='m')) - pd.to_timedelta(
-                5, unit='m')
-            df_5min = df_5min.set_index('timestamp_local')
-            # Remove timezone info from date, we are just storing whatever the local time was, where the person was
-            df_5min.index = df_5min.index.tz_localize(None)
-            df_5min['summary_date'] = pd.to_datetime(x.get('summary_date')).date()
-            df_5min_list.append(df_5min)
-
-        df_1min = pd.concat(df_1min_list)
-        df_5min = pd.concat(df_5min_list)
+        df_1min = expand_samples(oura_data, 'day_start', 1, streams=['met_1min'])
+        df_5min = expand_samples(oura_data, 'day_start', 5, digit_streams=['class_5min'])
+        df_5min.insert(1, 'class_5min_desc', df_5min['class_5min'].map(
+            {0: 'Rest', 1: 'Inactive', 2: 'Low', 3: 'Medium', 4: 'High', 5: 'Non-Wear'}))
 
         df_activity_samples = df_1min.merge(df_5min, how='left', left_index=True, right_index=True)
         df_activity_samples['summary_date'] = df_activity_samples['summary_date_x']
         df_activity_samples = df_activity_samples.drop(columns=['summary_date_x', 'summary_date_y'], axis=1)
 
-        return df_activity_summary, df_activity_samples
+        return df_activity_summary, df_activity_samples, day_hashes(oura_data)
     else:
-        return [], []
-
-
-def insert_activity_data(df_activity_summary, df_activity_samples, days_back=7):
-    start = app.session.query(func.max(ouraActivitySummary.summary_date))[0][0]
-    start = '1999-01-01' if start is None else datetime.strftime(start - timedelta(days=days_back), '%Y-%m-%d')
-
-    # Delete latest dates records from db to ensure values are being overridden from api pull
-    try:
-        app.server.logger.debug('Deleting >= {} records from oura_activity_summary'.format(start))
-        app.session.execute(delete(ouraActivitySummary).where(ouraActivitySummary.summary_date >= start))
-        app.server.logger.debug('Deleting >= {} records from oura_activity_samples'.format(start))
-        app.session.execute(delete(ouraActivitySamples).where(ouraActivitySamples.timestamp_local >= start))
-        app.session.commit()
-    except BaseException as e:
-        app.server.logger.error(e)
-
-    app.session.remove()
-
-    # Insert Activity Summary
-    app.server.logger.debug('Inserting oura activity summary')
-    try:
-        df_activity_summary.to_sql('oura_activity_summary', engine, if_exists='append', index=True)
-
+        return [], [], {}
 
-    except BaseException as e:
-        app.server.logger.error(e)
 
-    # Insert Activity Samples
-    app.server.logger.debug('Inserting oura activity samples')
-    try:
-        df_activity_samples.to_sql('oura_activity_samples', engine, if_exists='append', index=True)
-
-    except BaseException as e:
-        app.server.logger.error(e)
+def insert_activity_data(df_activity_summary, df_activity_samples, hashes):
+    # Only days whose payload changed are deleted and re-inserted, including their 1 min samples
+    if hashes:
+        app.server.logger.debug('Inserting oura activity summary and samples')
+        try:
+            rewrite_changed_days('activity', hashes, [(ouraActivitySummary, df_activity_summary),
+                                                      (ouraActivitySamples, df_activity_samples)])
+        except BaseException as e:
+            app.server.logger.error(e)
 
 
 def pull_sleep_data(oura, days_back=7):
@@ -249,65 +303,26 @@ def pull_sleep_data(oura, days_back=7):
                                                  axis=1)
 
         # Sleep Samples
-        df_samples_list = []
-        for x in oura_data:
-            df = pd.concat(
-                [pd.Series(x.get('hr_5min'), name='hr_5min'), pd.Series(x.get('rmssd_5min'), name='rmssd_5min'),
-                 pd.Series([int(y) for y in x.get('hypnogram_5min')], name='hypnogram_5min')],
-                axis=1)
-            df['hypnogram_5min_desc'] = df['hypnogram_5min'].map(
-                {1: 'Deep', 2: 'Light', 3: 'REM', 4: 'Awake'})
-
-            df.index += 1
-            df['timestamp_local'] = (pd.to_datetime(x.get('bedtime_start')) + pd.to_timedelta(df.index * 5,
-                                                                                              unit='m')) - pd.to_timedelta(
-                5, unit='m')
-
-            df['summary_date'] = pd.to_datetime(x.get('summary_date')).date()
-            df['report_date'] = df['summary_date'] + timedelta(days=1)
-            df = df.set_index('timestamp_local')
-            # Remove timezone info from date, we are just storing whatever the local time was, where the person was
-            df.index = df.index.tz_localize(None)
-            df_samples_list.append(df)
-
-        df_sleep_samples = pd.concat(df_samples_list)
-
-        return df_sleep_summary, df_sleep_samples
-    else:
-        return [], []
-
-
-def insert_sleep_data(df_sleep_summary, df_sleep_samples, days_back=7):
-    start = app.session.query(func.max(ouraSleepSummary.report_date))[0][0]
-    start = '1999-01-01' if start is None else datetime.strftime(start - timedelta(days=days_back), '%Y-%m-%d')
-
-    # Delete latest dates records from db to ensure values are being overridden from api pull
-    try:
-        app.server.logger.debug('Deleting >= {} records from oura_sleep_summary'.format(start))
-        app.session.execute(delete(ouraSleepSummary).where(ouraSleepSummary.summary_date >= start))
-        app.server.logger.debug('Deleting >= {} records from oura_sleep_samples'.format(start))
-        app.session.execute(delete(ouraSleepSamples).where(ouraSleepSamples.summary_date >= start))
-        app.session.commit()
-    except BaseException as e:
-        app.server.logger.error(e)
-
-    app.session.remove()
+        df_sleep_samples = expand_samples(oura_data, 'bedtime_start', 5, streams=['hr_5min', 'rmssd_5min'],
+                                          digit_streams=['hypnogram_5min'])
+        df_sleep_samples.insert(3, 'hypnogram_5min_desc', df_sleep_samples['hypnogram_5min'].map(
+            {1: 'Deep', 2: 'Light', 3: 'REM', 4: 'Awake'}))
+        df_sleep_samples['report_date'] = df_sleep_samples['summary_date'] + timedelta(days=1)
 
-    # Insert Sleep Summary
-    app.server.logger.debug('Inserting oura sleep summary')
-    try:
-        df_sleep_summary.to_sql('oura_sleep_summary', engine, if_exists='append', index=True)
+        return df_sleep_summary, df_sleep_samples, day_hashes(oura_data)
+    else:
+        return [], [], {}
 
-    except BaseException as e:
-        app.server.logger.error(e)
 
-    # Insert Sleep Samples
-    # app.server.logger.debug('Inserting oura sleep samples')
-    try:
-        df_sleep_samples.to_sql('oura_sleep_samples', engine, if_exists='append', index=True)
-
-    except BaseException as e:
-        app.server.logger.error(e)
+def insert_sleep_data(df_sleep_summary, df_sleep_samples, hashes):
+    # Only days whose payload changed are deleted and re-inserted
+    if hashes:
+        app.server.logger.debug('Inserting oura sleep summary and samples')
+        try:
+            rewrite_changed_days('sleep', hashes, [(ouraSleepSummary, df_sleep_summary),
+                                                   (ouraSleepSamples, df_sleep_samples)])
+        except BaseException as e:
+            app.server.logger.error(e)
 
 
 def generate_oura_correlations(lookback_days=180):
@@ -428,14 +443,13 @@ def pull_oura_data():
         token_dict = current_token_dict()
         oura = OuraClient(client_id=client_id, client_secret=client_secret, access_token=token_dict['access_token'],
                           refresh_token=token_dict['refresh_token'], refresh_callback=save_oura_token)
-        df_readiness_summary = pull_readiness_data(oura, days_back)
-        df_readiness_summary.to_csv('readiness.csv', sep=',')
-        df_activity_summary, df_activity_samples = pull_activity_data(oura, days_back)
-        df_sleep_summary, df_sleep_samples = pull_sleep_data(oura, days_back)
-
-        insert_readiness_data(df_readiness_summary, days_back)
-        insert_activity_data(df_activity_summary, df_activity_samples, days_back)
-        insert_sleep_data(df_sleep_summary, df_sleep_samples, days_back)
+        df_readiness_summary, readiness_hashes = pull_readiness_data(oura, days_back)
+        df_activity_summary, df_activity_samples, activity_hashes = pull_activity_data(oura, days_back)
+        df_sleep_summary, df_sleep_samples, sleep_hashes = pull_sleep_data(oura, days_back)
+
+        insert_readiness_data(df_readiness_summary, readiness_hashes)
+        insert_activity_data(df_activity_summary, df_activity_samples, activity_hashes)
+        insert_sleep_data(df_sleep_summary, df_sleep_samples, sleep_hashes)
 
         # # Generate correlation table - Depricated, no longer storing in table
         # generate_oura_correlations(lookback_days=9999)
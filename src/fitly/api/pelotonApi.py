@@ -3,11 +3,16 @@
 
 import requests
 import decimal
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from datetime import datetime, timezone, date, timedelta
 from ..utils import config
 import pandas as pd
-from .sqlalchemy_declarative import workoutStepLog, athlete, stravaSummary
+from sqlalchemy import func
+from .sqlalchemy_declarative import workoutStepLog, athlete, stravaSummary, pelotonWorkout
 from ..app import app
 import json
 import os
@@ -24,6 +29,15 @@ PELOTON_PASSWORD = config.get('peloton', 'password')
 
 _USER_AGENT = "Mozilla/5.0"
 
+# Pages of a paginated endpoint fetched at once, and retries (with exponential backoff) for throttled/failed requests
+PAGE_WORKERS = int(config.get('peloton', 'page_workers', fallback=4))
+MAX_RETRIES = int(config.get('peloton', 'max_retries', fallback=3))
+RETRY_BACKOFF = float(config.get('peloton', 'retry_backoff_seconds', fallback=1))
+REQUEST_TIMEOUT = float(config.get('peloton', 'request_timeout_seconds', fallback=30))
+
+# Activities are fetched concurrently, only let one of them sync the workout index at a time
+peloton_index_lock = threading.Lock()
+
 
 # Whether or not to verify SSL connections (defaults to True)
 # try:
@@ -185,6 +199,7 @@ class PelotonAPI:
 
     # Hold a request.Session instance that we're going to rely on to make API calls
     peloton_session = None
+    session_lock = threading.Lock()
 
     # Being friendly (by default), use the same page size that the Peloton website uses
     page_size = 10
@@ -207,13 +222,36 @@ class PelotonAPI:
 
         # Create a session if we don't have one yet
         if cls.peloton_session is None:
-            cls._create_api_session()
+            with cls.session_lock:
+                if cls.peloton_session is None:
+                    cls._create_api_session()
+
+        # Only gets are retried, a post that timed out may already have been applied
+        retries = MAX_RETRIES if call == 'get' else 0
+        for attempt in range(retries + 1):
+            # app.server.logger.debug("Request {} [{}]".format(_BASE_URL + uri, params))
+            try:
+                if call == 'get':
+                    resp = cls.peloton_session.get(_BASE_URL + uri, headers=cls.headers, params=params,
+                                                   timeout=REQUEST_TIMEOUT)
+                elif call == 'post':
+                    resp = cls.peloton_session.post(_BASE_URL + uri, headers=cls.headers, json=params,
+                                                    timeout=REQUEST_TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == retries:
+                    raise
+                wait = RETRY_BACKOFF * 2 ** attempt
+                app.server.logger.debug('Peloton request failed ({}), retrying in {}s'.format(e, wait))
+                time.sleep(wait)
+                continue
 
-        # app.server.logger.debug("Request {} [{}]".format(_BASE_URL + uri, params))
-        if call == 'get':
-            resp = cls.peloton_session.get(_BASE_URL + uri, headers=cls.headers, params=params)
-        elif call == 'post':
-            resp = cls.peloton_session.post(_BASE_URL + uri, headers=cls.headers, json=params)
+            # Retry throttled requests and server errors
+            if (resp.status_code != 429 and resp.status_code < 500) or attempt == retries:
+                break
+            retry_after = resp.headers.get('Retry-After', '')
+            wait = float(retry_after) if retry_after.isdigit() else RETRY_BACKOFF * 2 ** attempt
+            app.server.logger.debug('Peloton returned {}, retrying in {}s'.format(resp.status_code, wait))
+            time.sleep(wait)
 
         # app.server.logger.debug("Response {}: [{}]".format(resp.status_code, resp._content))
 
@@ -233,6 +271,36 @@ class PelotonAPI:
 
         return resp
 
+    @classmethod
+    def _api_pages(cls, uri, params):
+        """ Generator over the pages of a paginated endpoint, in order
+
+        Page 0 gives the number of pages, after that up to PAGE_WORKERS pages are requested concurrently ahead of
+        the page being consumed. Stop iterating early and the pages not yet requested are never fetched
+        """
+
+        params = dict(params, page=params.get('page', 0))
+        res = cls._api_request(uri, params).json()
+        yield res
+
+        pages = iter(range(params['page'] + 1, res.get('page_count', 0)))
+        executor = ThreadPoolExecutor(max_workers=PAGE_WORKERS, thread_name_prefix='peloton-page')
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < PAGE_WORKERS:
+                    page = next(pages, None)
+                    if page is None:
+                        break
+                    pending.append(executor.submit(cls._api_request, uri, dict(params, page=page)))
+                if not pending:
+                    break
+                yield pending.popleft().result().json()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
     @classmethod
     def _create_api_session(cls):
         """ Create a session instance for communicating with the API
@@ -253,8 +321,10 @@ class PelotonAPI:
             'password': cls.peloton_password
         }
 
-        cls.peloton_session = requests.Session()
-        resp = cls.peloton_session.post(_BASE_URL + '/auth/login', json=payload, headers=cls.headers)
+        session = requests.Session()
+        # Enough pooled connections for every concurrent page request to reuse one
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max(PAGE_WORKERS, 10)))
+        resp = session.post(_BASE_URL + '/auth/login', json=payload, headers=cls.headers, timeout=REQUEST_TIMEOUT)
         message = resp._content
 
         if 300 <= resp.status_code < 400:
@@ -268,6 +338,7 @@ class PelotonAPI:
 
         # Set our User ID on our class
         cls.user_id = resp.json()['user_id']
+        cls.peloton_session = session
 
 
 class PelotonUser(PelotonObject):
@@ -541,18 +612,32 @@ class PelotonWorkoutFactory(PelotonAPI):
             'joins': 'ride,ride.instructor'
         }
 
-        # Get our first page, which includes number of successive pages
-        res = cls._api_request(uri, params).json()
+        # Page 0 includes number of successive pages, which are then fetched concurrently
+        return [PelotonWorkout(**workout) for res in cls._api_pages(uri, params) for workout in res['data']]
 
-        # Add this pages data to our return list
-        ret = [PelotonWorkout(**workout) for workout in res['data']]
+    @classmethod
+    def list_new(cls, known_ids, results_per_page=10):
+        """ Return a list of PelotonWorkout instances not in known_ids, newest first. Stops paging at the first page
+        that contains a known workout, so only workouts taken since the last call are requested
+        """
+
+        if cls.user_id is None:
+            cls._create_api_session()
 
-        # We've got page 0, so start with page 1
-        for i in range(1, res['page_count']):
-            params['page'] += 1
-            res = cls._api_request(uri, params).json()
-            [ret.append(PelotonWorkout(**workout)) for workout in res['data']]
+        uri = '/api/user/{}/workouts'.format(cls.user_id)
+        params = {
+            'page': 0,
+            'limit': results_per_page,
+            'sort_by': '-created',
+            'joins': 'ride,ride.instructor'
+        }
 
+        ret = []
+        for res in cls._api_pages(uri, params):
+            workouts = [PelotonWorkout(**workout) for workout in res['data']]
+            ret.extend(workout for workout in workouts if workout.id not in known_ids)
+            if any(workout.id in known_ids for workout in workouts):
+                break
         return ret
 
     @classmethod
@@ -616,23 +701,65 @@ def roundTime(dt=None, roundTo=60):
     return (dt + timedelta(0, rounding - seconds, -dt.microsecond)).replace(tzinfo=None)
 
 
-def peloton_mapping_df():
-    workouts = PelotonWorkout.list()
-    df = pd.DataFrame()
-    for workout in workouts:
-        try:
-            instructor = ' with {}'.format(workout.ride.instructor)
-        except:
-            instructor = ''
-        # Round activity to nerest minute to then align with strava data rounded to nearest minute
-        df = df.append({
-            'created_at': roundTime(pd.to_datetime(workout.created_at)),
-            'start': roundTime(pd.to_datetime(workout.start_time)),
-            'end': roundTime(pd.to_datetime(workout.end_time)),
-            'type': workout.fitness_discipline,
-            'name': workout.ride.title + instructor
-        }, ignore_index=True)
-    return df
+def sync_peloton_workouts():
+    '''
+    Add workouts taken since the last sync to the local peloton workout index
+    :return: number of workouts added
+    '''
+    with peloton_index_lock:
+        known_ids = {workout_id for workout_id, in app.session.query(pelotonWorkout.workout_id)}
+        app.session.remove()
+        workouts = PelotonWorkoutFactory.list_new(known_ids)
+        timestamp_utc = datetime.utcnow()
+        for workout in workouts:
+            ride = workout.ride if isinstance(workout.ride, PelotonRide) else None
+            try:
+                instructor = ' with {}'.format(ride.instructor)
+            except AttributeError:
+                instructor = ''
+            # Round activity to nerest minute to then align with strava data rounded to nearest minute
+            app.session.merge(pelotonWorkout(workout_id=workout.id,
+                                             start_utc=roundTime(workout.start_time),
+                                             created_at_utc=roundTime(workout.created_at),
+                                             end_utc=roundTime(workout.end_time),
+                                             fitness_discipline=workout.fitness_discipline,
+                                             ride_id=ride.id if ride else None,
+                                             name=ride.title + instructor if ride and ride.title else None,
+                                             timestamp_utc=timestamp_utc))
+        app.session.commit()
+        app.session.remove()
+    app.server.logger.debug('Added {} workouts to the peloton workout index'.format(len(workouts)))
+    return len(workouts)
+
+
+def peloton_workout_title(start_date_utc, window_minutes=10):
+    '''
+    Title of the peloton class started within window_minutes of an activity, looked up in the local workout index.
+    Peloton is only asked for new workouts when nothing matches and the activity is newer than every indexed workout.
+    :param start_date_utc: activity start date (utc)
+    :return: class title, or None if no class matches
+    '''
+    start = roundTime(start_date_utc)
+    window = timedelta(minutes=window_minutes)
+
+    def indexed_title():
+        title = app.session.query(pelotonWorkout.name).filter(
+            pelotonWorkout.start_utc.between(start - window, start + window) |
+            pelotonWorkout.created_at_utc.between(start - window, start + window),
+            pelotonWorkout.name.isnot(None)).order_by(
+            pelotonWorkout.start_utc.desc()).first()
+        app.session.remove()
+        return title.name if title else None
+
+    title = indexed_title()
+    if title is None:
+        latest = app.session.query(func.max(pelotonWorkout.start_utc)).scalar()
+        app.session.remove()
+        # If activity is more than 15 minutes newer than the latest indexed workout, pull new workouts
+        if latest is None or (start - latest).total_seconds() > (60 * 15):
+            if sync_peloton_workouts():
+                title = indexed_title()
+    return title
 
 
 def get_schedule(fitness_discipline, class_names=['all'], taken_class_ids=[], limit=10, is_favorite_ride=False,
@@ -691,16 +818,15 @@ def get_schedule(fitness_discipline, class_names=['all'], taken_class_ids=[], li
             params['difficulty'] = difficulty
 
     # Get our first page, which includes number of successive pages
-    res = PelotonAPI._api_request(uri=uri, params=params).json()
+    pages = PelotonAPI._api_pages(uri=uri, params=params)
+    res = next(pages)
 
     # if there are workouts to parse through...
     if len(res['data']) > 0:
         # If is_favorite_ride was passed, we are getting all bookmarked classes to delete, so ignore limit and loop through all pages
         if is_favorite_ride:
             ret = [workout for workout in res['data']]
-            for i in range(1, res['page_count']):
-                params['page'] += 1
-                res = PelotonAPI._api_request(uri=uri, params=params).json()
+            for res in pages:
                 [ret.append(workout) for workout in res['data']]
 
         else:
@@ -710,10 +836,10 @@ def get_schedule(fitness_discipline, class_names=['all'], taken_class_ids=[], li
                            workout['title'] == next_workout or class_names == ['all'])]
             taken_classes = []
             # If there are not enough workouts in our list, go to next page
-            while len(ret) < limit and params['page'] < res['page_count']:
-                # We've got page 0, so add page at beginning of loop
-                params['page'] += 1
-                res = PelotonAPI._api_request(uri=uri, params=params).json()
+            while len(ret) < limit:
+                res = next(pages, None)
+                if res is None:
+                    break
                 [taken_classes.append(workout) for workout in res['data'] if
                  workout['id'] in taken_class_ids and workout['title'] == next_workout]
                 [ret.append(workout) for workout in res['data'] if
@@ -826,7 +952,10 @@ def set_peloton_workout_recommendations():
     app.session.remove()
 
     fitness_disciplines = athlete_bookmarks.keys()
-    taken_class_ids = [x.ride.id for x in PelotonWorkout.list()]
+    sync_peloton_workouts()
+    taken_class_ids = [ride_id for ride_id, in app.session.query(pelotonWorkout.ride_id).filter(
+        pelotonWorkout.ride_id.isnot(None))]
+    app.session.remove()
 
     # Loop through each workout type to delete all current bookmarks
     for fitness_discipline in fitness_disciplines:
@@ -0,0 +1,353 @@
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect, text
+from ..api.sqlalchemy_declarative import stravaPowerCurve, stravaPowerEnvelope, stravaSummary
+from ..app import app
+from .database import engine
+
+# Envelopes are packed as little endian float32, element i holds the best power for i + 1 seconds
+CURVE_DTYPE = '<f4'
+# Activity curves only hold the durations they were evaluated at (see log_durations()), so they are packed as
+# (seconds, mean max power) points and expanded to one value per second when read
+CURVE_POINT_DTYPE = np.dtype([('duration', '<u4'), ('mmp', CURVE_DTYPE)])
+
+# Best power envelopes kept up to date at ingest, per sport and window (days back, None for all time)
+ENVELOPE_SPORTS = ['ride', 'run']
+ENVELOPE_WINDOWS = {'all': None, 'L90D': 90, 'L6W': 42, 'L30D': 30}
+# Envelope activity ids and activity start times (epoch seconds, local time) for every point on the curve
+ENVELOPE_INT_DTYPE = '<i8'
+# Envelopes are read, merged and written back, so only let one thread update them at a time
+envelope_lock = threading.Lock()
+
+
+def pack_curve(values):
+    return np.asarray(values, dtype=CURVE_DTYPE).tobytes()
+
+
+def unpack_curve(blob):
+    return np.frombuffer(blob, dtype=CURVE_DTYPE).astype(float)
+
+
+def pack_curve_points(curve):
+    # Pack a curve evaluated on some durations (Series indexed by seconds), durations without a value are left out
+    curve = curve.dropna()
+    points = np.empty(len(curve), dtype=CURVE_POINT_DTYPE)
+    points['duration'] = curve.index.values
+    points['mmp'] = curve.values
+    return points.tobytes()
+
+
+def unpack_curve_points(blob):
+    # One value per second up to the longest duration, NaN for durations the curve was not evaluated at
+    points = np.frombuffer(blob, dtype=CURVE_POINT_DTYPE)
+    curve = np.full(int(points['duration'].max()) if len(points) else 0, np.nan)
+    curve[points['duration'].astype(int) - 1] = points['mmp']
+    return curve
+
+
+def load_power_curves(activity_type=None, since=None, activity_id=None, intensity=None):
+    '''
+    Read strava_power_curves rows with their curves unpacked into the 'mmp' column
+    :param activity_type: ilike pattern on activity type, e.g. '%ride%'
+    :param since: only activities starting on or after this (local) datetime
+    :param activity_id: only this activity
+    :param intensity: only activities with this strava_summary.workout_intensity
+    '''
+    query = app.session.query(stravaPowerCurve)
+    if activity_type:
+        query = query.filter(stravaPowerCurve.type.ilike(activity_type))
+    if since:
+        query = query.filter(stravaPowerCurve.timestamp_local >= since)
+    if activity_id:
+        query = query.filter(stravaPowerCurve.activity_id == activity_id)
+    if intensity:
+        query = query.join(stravaSummary, stravaPowerCurve.activity_id == stravaSummary.activity_id).filter(
+            stravaSummary.workout_intensity == intensity)
+    curves = pd.read_sql(sql=query.statement, con=engine)
+    app.session.remove()
+    curves['mmp'] = curves['mmp'].apply(unpack_curve_points)
+    return curves
+
+
+def interval_values(curves, interval):
+    '''
+    Each activity's best power for a single interval, activities shorter than the interval are dropped
+    :return: one row per activity with mmp and watts_per_kg for the interval
+    '''
+    curves = curves[curves['durations'] >= interval]
+    df = curves.drop(columns='mmp')
+    df['interval'] = interval
+    df['mmp'] = [curve[interval - 1] for curve in curves['mmp']]
+    df['watts_per_kg'] = df['mmp'] / df['kg']
+    # Curves are only stored at the durations in log_durations()
+    return df[df['mmp'].notnull()]
+
+
+def best_intervals(curves, intervals=None):
+    '''
+    Best power across activities for each interval, along with the activity it came from
+    :param curves: DataFrame returned by load_power_curves()
+    :param intervals: durations in seconds, defaults to every second of the longest activity
+    :return: DataFrame indexed by interval, intervals no activity is long enough for are dropped
+    '''
+    if intervals is None:
+        intervals = np.arange(1, curves['durations'].max() + 1) if len(curves) else []
+    intervals = np.asarray(intervals, dtype=int)
+    columns = ['activity_id', 'ftp', 'act_name', 'date', 'timestamp_local', 'time_interval', 'mmp', 'watts_per_kg']
+    if len(curves) == 0 or len(intervals) == 0:
+        return pd.DataFrame(columns=columns, index=pd.Index([], name='interval'))
+
+    matrix = np.full((len(curves), len(intervals)), np.nan)
+    for row, curve in enumerate(curves['mmp']):
+        available = intervals <= len(curve)
+        matrix[row, available] = curve[intervals[available] - 1]
+    has_value = ~np.isnan(matrix).all(axis=0)
+    matrix, intervals = matrix[:, has_value], intervals[has_value]
+
+    best = np.nanargmax(matrix, axis=0)
+    df = curves.iloc[best].drop(columns='mmp').reset_index(drop=True)
+    df['mmp'] = matrix[best, np.arange(len(intervals))]
+    df['watts_per_kg'] = df['mmp'] / df['kg']
+    df['time_interval'] = pd.to_datetime(intervals, unit='s')
+    df.index = pd.Index(intervals, name='interval')
+    return df
+
+
+def migrate_best_samples():
+    '''
+    One time conversion of the legacy strava_best_samples table (one row per second of every activity) into
+    strava_power_curves, the legacy table is dropped once every activity has been converted
+    '''
+    if not inspect(engine).has_table('strava_best_samples'):
+        return
+
+    activity_ids = [row[0] for row in
+                    app.session.execute(text('SELECT DISTINCT activity_id FROM strava_best_samples')).fetchall()]
+    app.session.remove()
+    app.server.logger.info(f'Converting strava_best_samples for {len(activity_ids)} activities to strava_power_curves')
+
+    for activity_id in activity_ids:
+        df = pd.read_sql(sql=text('SELECT * FROM strava_best_samples WHERE activity_id = :activity_id'), con=engine,
+                         params={'activity_id': activity_id}, parse_dates=['timestamp_local', 'timestamp_utc'])
+        df = df.sort_values('interval')
+        curve = pd.Series(df['mmp'].values, index=df['interval'].values)
+        first = df.iloc[0]
+        kg = (df['mmp'] / df['watts_per_kg']).dropna()
+        start = pd.Timedelta(seconds=int(first['interval']))
+        app.session.merge(stravaPowerCurve(
+            activity_id=int(activity_id),
+            athlete_id=int(first['athlete_id']) if pd.notnull(first['athlete_id']) else None,
+            type=first['type'],
+            act_name=first['act_name'],
+            timestamp_local=(first['timestamp_local'] - start).to_pydatetime(),
+            timestamp_utc=(first['timestamp_utc'] - start).to_pydatetime(),
+            date=(first['timestamp_local'] - start).date(),
+            ftp=float(first['ftp']) if pd.notnull(first['ftp']) else None,
+            kg=float(kg.iloc[0]) if len(kg) else None,
+            durations=int(df['interval'].max()),
+            mmp=pack_curve_points(curve)))
+        app.session.commit()
+
+    app.session.execute(text('DROP TABLE strava_best_samples'))
+    app.session.commit()
+    app.session.remove()
+    app.server.logger.info('strava_best_samples conversion complete')
+
+
+def envelope_sports(activity_type):
+    # Envelopes an activity counts towards, same matching as filtering on type ilike '%ride%' / '%run%'
+    return [sport for sport in ENVELOPE_SPORTS if sport in str(activity_type).lower()]
+
+
+def window_start(window, now=None):
+    days = ENVELOPE_WINDOWS[window]
+    return None if days is None else (now or datetime.now()) - timedelta(days=days)
+
+
+def epoch_seconds(timestamp):
+    return pd.Timestamp(timestamp).value // 10 ** 9
+
+
+def empty_envelope():
+    return {'mmp': np.array([], dtype=float), 'activity_ids': np.array([], dtype=ENVELOPE_INT_DTYPE),
+            'timestamps': np.array([], dtype=ENVELOPE_INT_DTYPE)}
+
+
+def merge_curve(envelope, curve, activity_id, timestamp_local):
+    '''
+    Merge an activity's curve into an envelope, points the activity beats take its id and start time
+    :return: True if the envelope changed
+    '''
+    curve = np.asarray(curve, dtype=float)
+    if len(curve) > len(envelope['mmp']):
+        pad = len(curve) - len(envelope['mmp'])
+        envelope['mmp'] = np.concatenate([envelope['mmp'], np.full(pad, np.nan)])
+        envelope['activity_ids'] = np.concatenate([envelope['activity_ids'], np.zeros(pad, ENVELOPE_INT_DTYPE)])
+        envelope['timestamps'] = np.concatenate([envelope['timestamps'], np.zeros(pad, ENVELOPE_INT_DTYPE)])
+    current = envelope['mmp'][:len(curve)]
+    # Ties keep the activity already on the curve
+    beats = (curve > current) | (np.isnan(current) & ~np.isnan(curve))
+    if not beats.any():
+        return False
+    current[beats] = curve[beats]
+    envelope['activity_ids'][:len(curve)][beats] = activity_id
+    envelope['timestamps'][:len(curve)][beats] = epoch_seconds(timestamp_local)
+    return True
+
+
+def read_envelope(sport, window):
+    row = app.session.query(stravaPowerEnvelope).filter(stravaPowerEnvelope.type == sport,
+                                                        stravaPowerEnvelope.period == window).first()
+    if not row:
+        return empty_envelope()
+    return {'mmp': unpack_curve(row.mmp),
+            'activity_ids': np.frombuffer(row.activity_ids, dtype=ENVELOPE_INT_DTYPE).copy(),
+            'timestamps': np.frombuffer(row.timestamps, dtype=ENVELOPE_INT_DTYPE).copy()}
+
+
+def write_envelope(sport, window, envelope):
+    app.session.merge(stravaPowerEnvelope(type=sport, period=window,
+                                          durations=len(envelope['mmp']),
+                                          mmp=pack_curve(envelope['mmp']),
+                                          activity_ids=envelope['activity_ids'].astype(ENVELOPE_INT_DTYPE).tobytes(),
+                                          timestamps=envelope['timestamps'].astype(ENVELOPE_INT_DTYPE).tobytes(),
+                                          timestamp_utc=datetime.utcnow()))
+
+
+def build_envelope(curves):
+    envelope = empty_envelope()
+    for curve in curves.itertuples():
+        merge_curve(envelope, curve.mmp, curve.activity_id, curve.timestamp_local)
+    return envelope
+
+
+def update_power_envelopes(power_curve):
+    '''
+    Merge a newly written strava_power_curves row into the envelopes of every window the activity falls in
+    :param power_curve: dict as returned by FitlyActivity.power_curve()
+    '''
+    curve = unpack_curve_points(power_curve['mmp'])
+    with envelope_lock:
+        for sport in envelope_sports(power_curve['type']):
+            for window in ENVELOPE_WINDOWS:
+                start = window_start(window)
+                if start and power_curve['timestamp_local'] < start:
+                    continue
+                envelope = read_envelope(sport, window)
+                if merge_curve(envelope, curve, power_curve['activity_id'], power_curve['timestamp_local']):
+                    write_envelope(sport, window, envelope)
+        app.session.commit()
+        app.session.remove()
+
+
+def rebuild_power_envelopes(sports=ENVELOPE_SPORTS, windows=ENVELOPE_WINDOWS):
+    # Recompute envelopes from strava_power_curves, used when activities are removed or reprocessed
+    with envelope_lock:
+        for sport in sports:
+            for window in windows:
+                curves = load_power_curves(activity_type=f'%{sport}%', since=window_start(window))
+                write_envelope(sport, window, build_envelope(curves))
+        app.session.commit()
+        app.session.remove()
+
+
+def expire_power_envelopes(sport, now=None):
+    '''
+    Rebuild rolling windows that hold a point from an activity that has aged out of the window.
+    Only the activities inside the window are read, so the cost doesn't grow with history.
+    '''
+    expired = []
+    for window, days in ENVELOPE_WINDOWS.items():
+        if days is None:
+            continue
+        envelope = read_envelope(sport, window)
+        valid = ~np.isnan(envelope['mmp'])
+        if (envelope['timestamps'][valid] < epoch_seconds(window_start(window, now))).any():
+            expired.append(window)
+    app.session.remove()
+    if expired:
+        app.server.logger.debug(f'Expiring {sport} power curve windows: {", ".join(expired)}')
+        rebuild_power_envelopes(sports=[sport], windows=expired)
+
+
+def load_power_envelope(sport, window, intervals):
+    '''
+    Envelope points for a set of intervals, in the same shape as best_intervals()
+    :param intervals: durations in seconds, usually log_durations()
+    '''
+    envelope = read_envelope(sport, window)
+    app.session.remove()
+    intervals = np.asarray(intervals, dtype=int)
+    intervals = intervals[intervals <= len(envelope['mmp'])]
+    mmp = envelope['mmp'][intervals - 1]
+    intervals, mmp = intervals[~np.isnan(mmp)], mmp[~np.isnan(mmp)]
+    activity_ids = envelope['activity_ids'][intervals - 1]
+
+    # Activity details for the few activities on the curve
+    activities = pd.read_sql(
+        sql=app.session.query(stravaPowerCurve.activity_id, stravaPowerCurve.ftp, stravaPowerCurve.kg,
+                              stravaPowerCurve.act_name, stravaPowerCurve.date,
+                              stravaPowerCurve.timestamp_local).filter(
+            stravaPowerCurve.activity_id.in_([int(x) for x in np.unique(activity_ids)])).statement,
+        con=engine, index_col='activity_id')
+    app.session.remove()
+
+    df = activities.reindex(activity_ids).reset_index()
+    df['mmp'] = mmp
+    df['watts_per_kg'] = df['mmp'] / df['kg']
+    df['time_interval'] = pd.to_datetime(intervals, unit='s')
+    df.index = pd.Index(intervals, name='interval')
+    return df
+
+
+def init_power_envelopes():
+    # Build envelopes for databases that have power curves from before envelopes were kept
+    if app.session.query(stravaPowerEnvelope).first() is None and app.session.query(stravaPowerCurve).first():
+        app.session.remove()
+        app.server.logger.info('Building power curve envelopes')
+        rebuild_power_envelopes()
+    app.session.remove()
+
+
+def envelope_window(activity_type, days=None):
+    # Envelope window kept for an activity type and number of days back, None if the curves need to be read
+    if str(activity_type).lower() not in ENVELOPE_SPORTS:
+        return None
+    return next((window for window, window_days in ENVELOPE_WINDOWS.items() if window_days == days), None)
+
+
+def max_duration(activity_type, curves=None):
+    # Longest duration on the power curve for an activity type
+    if curves is None:
+        durations = len(read_envelope(str(activity_type).lower(), 'all')['mmp'])
+        app.session.remove()
+        return durations
+    return curves['durations'].max() if len(curves) > 0 else 0
+
+
+def best_power(activity_type, intervals=None, days=None, curves=None):
+    '''
+    Best power per interval for an activity type over the last number of days. Read from the envelopes when they are
+    kept for the sport and window and no curves are passed, otherwise computed from the activities' curves.
+    :param activity_type: 'ride', 'run' or a strava activity type
+    :param intervals: durations in seconds, defaults to every second
+    :param days: days back from today, None for all time
+    :param curves: curves already read for the activity type, so each window doesn't read them again. These may be
+    filtered (e.g. by intensity), so the envelopes, which hold every activity, are never used in their place
+    :return: DataFrame indexed by interval, see best_intervals()
+    '''
+    window = envelope_window(activity_type, days) if curves is None else None
+    if window:
+        sport = str(activity_type).lower()
+        if intervals is None:
+            intervals = np.arange(1, len(read_envelope(sport, window)['mmp']) + 1)
+        return load_power_envelope(sport, window, intervals)
+
+    since = datetime.now() - timedelta(days=days) if days is not None else None
+    if curves is None:
+        curves = load_power_curves(activity_type='%' + activity_type + '%', since=since)
+    elif since:
+        curves = curves[curves['timestamp_local'] >= since]
+    return best_intervals(curves, intervals)
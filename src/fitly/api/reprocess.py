@@ -0,0 +1,168 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+import pandas as pd
+import pytz
+import stravalib
+from sqlalchemy import delete
+from ..api.sqlalchemy_declarative import stravaSummary, stravaSamples, stravaPowerCurve
+from ..api.athlete_context import AthleteContext
+from ..api.power_curves import rebuild_power_envelopes
+from ..api.fitlyAPI import FitlyActivity
+from ..api.jobs import job_progress
+from ..api.locks import RefreshLease
+from .database import engine
+from ..app import app
+
+# strava_samples columns as they were built at ingest, before zones were assigned
+sample_columns = ['timestamp_local', 'timestamp_utc', 'time_interval', 'activity_id', 'date', 'act_name', 'time',
+                  'distance', 'velocity_smooth', 'temp', 'altitude', 'latitude', 'longitude', 'heartrate', 'cadence',
+                  'watts', 'moving', 'grade_smooth']
+
+# Athlete context for the worker process, set once by the pool initializer instead of being sent with every activity
+worker_context = None
+
+
+def init_reprocess_worker(context):
+    global worker_context
+    worker_context = context
+
+
+def db_value(value):
+    # Convert numpy scalars / nans to values sqlalchemy can bind
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def reprocess_activity(payload):
+    '''
+    Recompute an activity's zones, stress scores, intensity seconds and mean max power from its stored samples.
+    Runs in a worker process, so nothing here reads from or writes to the db.
+    :param payload: dict built by reprocess_payloads()
+    :return: dict of the activity's summary metrics, sample zones and strava_power_curves row
+    '''
+    act = FitlyActivity(stravalib.model.Activity(**payload['activity']))
+    act.assign_athlete(payload['athlete_id'], context=worker_context)
+    act.df_samples = payload['samples']
+    act.df_summary = pd.DataFrame(index=pd.Index([payload['start_date_utc']], name='start_date_utc'))
+
+    act.get_ftp(link_stryd=False)
+    act.get_rest_hr()
+    act.get_weight()
+    act.calculate_power_zones()
+    act.calculate_heartate_zones()
+    act.calculate_zone_intensities()
+    act.get_summary_analytics(wss=payload['wss'])
+    act.compute_mean_max_power()
+
+    summary = {'ftp': act.ftp, 'trimp': act.trimp, 'hrss': act.hrss, 'relative_intensity': act.ri,
+               'efficiency_factor': act.efficiency_factor, 'tss': act.tss,
+               'variability_index': act.variability_index, 'weighted_average_power': act.wap, 'weight': act.weight}
+    for col in ['low_intensity_seconds', 'mod_intensity_seconds', 'high_intensity_seconds', 'workout_intensity']:
+        summary[col] = act.df_summary[col].iloc[0] if col in act.df_summary.columns else None
+
+    zones = pd.DataFrame(index=act.df_samples.index)
+    for col in ['power_zone', 'hr_zone']:
+        zones[col] = act.df_samples[col] if col in act.df_samples.columns else np.nan
+
+    return {'activity_id': act.id,
+            'start_date_utc': payload['start_date_utc'],
+            'summary': summary,
+            'zones': zones,
+            'power_curve': act.power_curve() if act.max_watts is not None else None}
+
+
+def reprocess_payloads(activities, athlete_id):
+    # Load the stored samples for a chunk of strava_summary rows in one query, and package them up for the workers
+    samples = pd.read_sql(
+        sql=app.session.query(*[stravaSamples.__table__.c[col] for col in sample_columns]).filter(
+            stravaSamples.activity_id.in_([act.activity_id for act in activities])).statement,
+        con=engine, index_col='timestamp_local').sort_index()
+    app.session.remove()
+    samples = dict(tuple(samples.groupby('activity_id')))
+
+    payloads = []
+    for act in activities:
+        if act.activity_id not in samples:
+            app.server.logger.debug(f'No samples stored for activity {act.activity_id}, skipping reprocess')
+            continue
+        payloads.append({
+            'athlete_id': athlete_id,
+            'start_date_utc': act.start_date_utc,
+            'activity': {'id': act.activity_id, 'name': act.name, 'type': act.type,
+                         'start_date': act.start_date_utc.replace(tzinfo=pytz.utc),
+                         'start_date_local': act.start_date_local,
+                         'max_watts': db_value(act.max_watts), 'average_watts': db_value(act.average_watts),
+                         'max_heartrate': db_value(act.max_heartrate)},
+            'samples': samples[act.activity_id],
+            # wSS doesn't depend on zones or ftp, keep what was scored at ingest
+            'wss': (act.tss, act.relative_intensity) if 'weighttraining' in act.type.lower() else None})
+    return payloads
+
+
+def write_reprocessed(results):
+    if not results:
+        return
+    app.session.bulk_update_mappings(stravaSummary, [
+        dict({'start_date_utc': result['start_date_utc']},
+             **{col: db_value(value) for col, value in result['summary'].items()}) for result in results])
+
+    zones = pd.concat([result['zones'] for result in results])
+    app.session.bulk_update_mappings(stravaSamples, [
+        {'timestamp_local': timestamp_local.to_pydatetime(), 'power_zone': db_value(power_zone),
+         'hr_zone': db_value(hr_zone)} for timestamp_local, power_zone, hr_zone in
+        zones[['power_zone', 'hr_zone']].itertuples()])
+
+    # Replace power curves, activities that no longer have power data shouldn't keep their old curve
+    app.session.execute(delete(stravaPowerCurve).where(
+        stravaPowerCurve.activity_id.in_([result['activity_id'] for result in results])))
+    app.session.bulk_insert_mappings(stravaPowerCurve, [result['power_curve'] for result in results
+                                                        if result['power_curve'] is not None])
+    app.session.commit()
+    app.session.remove()
+
+
+def reprocess_activities(start_date=None, end_date=None, athlete_id=1, max_workers=None, chunk_size=50):
+    '''
+    Recompute zones, TRIMP/HRSS/TSS, intensity seconds and mean max power for stored activities using the samples
+    already in the db, without calling the strava api. Used to apply changes to zones, ftp or resting hr.
+    :param start_date: first local day to reprocess, defaults to the first activity
+    :param end_date: last local day to reprocess, defaults to the latest activity
+    :param max_workers: number of worker processes, defaults to the number of cpus
+    :param chunk_size: number of activities loaded, processed and written at a time
+    :return: number of activities reprocessed
+    '''
+    # Rewrites strava tables, so hold the same lock as a strava sync
+    lease = RefreshLease(['strava'])
+    if not lease.acquire():
+        app.server.logger.info('Database is already running a refresh job')
+        return 0
+
+    reprocessed = 0
+    try:
+        query = app.session.query(stravaSummary).filter(stravaSummary.athlete_id == athlete_id)
+        if start_date:
+            query = query.filter(stravaSummary.start_day_local >= start_date)
+        if end_date:
+            query = query.filter(stravaSummary.start_day_local <= end_date)
+        activities = query.order_by(stravaSummary.start_date_utc).all()
+        app.session.remove()
+        app.server.logger.info(f'Reprocessing {len(activities)} activities...')
+
+        context = AthleteContext(athlete_id)
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=init_reprocess_worker,
+                                 initargs=(context,)) as executor:
+            for i in range(0, len(activities), chunk_size):
+                payloads = reprocess_payloads(activities[i:i + chunk_size], athlete_id)
+                write_reprocessed(list(executor.map(reprocess_activity, payloads)))
+                reprocessed += len(payloads)
+                app.server.logger.debug(f'Reprocessed {reprocessed} of {len(activities)} activities')
+                job_progress(f'Reprocessed {reprocessed} of {len(activities)} activities')
+        job_progress('Rebuilding power curves')
+        rebuild_power_envelopes()
+        app.server.logger.info('Reprocess Complete')
+    finally:
+        lease.release()
+
+    return reprocessed
@@ -4,7 +4,7 @@ import json
 from ..utils import config
 from ..app import app
 from ..api.database import engine
-from ..api.sqlalchemy_declarative import apiTokens, spotifyPlayHistory, stravaSummary
+from ..api.sqlalchemy_declarative import apiTokens, spotifyPlayHistory, spotifyTrackFeatures, stravaSummary
 from sqlalchemy import delete, func, extract
 from datetime import datetime, timedelta
 import ast
@@ -29,6 +29,7 @@ import random
 import threading
 import queue
 import pickle
+import atexit
 
 client_id = config.get('spotify', 'client_id')
 client_secret = config.get('spotify', 'client_secret')
@@ -37,12 +38,19 @@ min_secs_listened = int(config.get('spotify', 'min_secs_listened'))
 skip_min_threshold = float(config.get('spotify', 'skip_min_threshold'))
 skip_max_threshold = float(config.get('spotify', 'skip_max_threshold'))
 poll_interval_seconds = float(config.get('spotify', 'poll_interval_seconds'))
+paused_poll_interval_seconds = float(config.get('spotify', 'paused_poll_interval_seconds', fallback=2))
+idle_poll_interval_seconds = float(config.get('spotify', 'idle_poll_interval_seconds', fallback=10))
+write_batch_size = int(config.get('spotify', 'write_batch_size', fallback=5))
+write_flush_seconds = float(config.get('spotify', 'write_flush_seconds', fallback=300))
 
-# Main queue that stream will add playback feeds to
+# Main queue that the poller will add playback feeds to
 q = queue.Queue(maxsize=0)
-current_state = None
-last_state = None
-playback_feed = []
+
+# Audio features stored with each play, and cached per track in spotify_track_features
+feature_columns = ['acousticness', 'danceability', 'energy', 'instrumentalness', 'key', 'liveness', 'loudness', 'mode',
+                   'speechiness', 'tempo', 'time_signature', 'valence']
+# Max ids spotify accepts in one audio features request
+features_batch_size = 100
 
 
 # Retrieve current tokens from db
@@ -112,6 +120,54 @@ def get_spotify_client():
     return client
 
 
+def get_track_features(track_ids, spotify=None):
+    '''
+    Audio features of tracks, from the local spotify_track_features cache where possible. Tracks played before the
+    cache existed are copied over from the play history, the rest are fetched from spotify in batches of 100 ids
+    :param track_ids: spotify track ids
+    :param spotify: tekore client, only needed when tracks have to be fetched
+    :return: df of audio features indexed by track_id
+    '''
+    track_ids = set(track_ids)
+    cached = pd.read_sql(sql=app.session.query(spotifyTrackFeatures.track_id, *[
+        getattr(spotifyTrackFeatures, c) for c in feature_columns]).filter(
+        spotifyTrackFeatures.track_id.in_(track_ids)).statement, con=engine, index_col='track_id')
+    missing = track_ids - set(cached.index)
+
+    new = []
+    if missing:
+        history = pd.read_sql(sql=app.session.query(spotifyPlayHistory.track_id, *[
+            getattr(spotifyPlayHistory, c) for c in feature_columns]).filter(
+            spotifyPlayHistory.track_id.in_(missing), spotifyPlayHistory.danceability.isnot(None)).statement,
+                              con=engine).drop_duplicates(subset='track_id', keep='last').set_index('track_id')
+        new.append(history)
+        missing -= set(history.index)
+    app.session.remove()
+
+    if missing:
+        missing = sorted(missing)
+        spotify = spotify or get_spotify_client()
+        try:
+            for i in range(0, len(missing), features_batch_size):
+                features = [x for x in spotify.tracks_audio_features(missing[i:i + features_batch_size]) if x]
+                if features:
+                    new.append(pd.DataFrame([json.loads(x.json()) for x in features]).rename(
+                        columns={'id': 'track_id'}).set_index('track_id')[feature_columns])
+        except BaseException as e:
+            # Plays are still stored without features rather than lost
+            app.server.logger.error(f'Error fetching spotify audio features: {e}')
+
+    new = [df for df in new if len(df) > 0]
+    if new:
+        new = pd.concat(new)
+        new = new[~new.index.duplicated(keep='last')]
+        app.server.logger.debug(f'Caching audio features of {len(new)} tracks')
+        new.assign(timestamp_utc=datetime.utcnow()).to_sql('spotify_track_features', engine, if_exists='append',
+                                                           index=True)
+        cached = pd.concat([cached, new])
+    return cached
+
+
 # def save_spotify_play_history():
 ### Replaced with live stream() function
 #     '''
@@ -202,19 +258,25 @@ def get_played_tracks(workout_intensity='all', sport='all', pop_time_period='all
     df_summary['end_date_utc'] = df_summary['start_date_utc'] + pd.to_timedelta(df_summary['elapsed_time'], 's')
     df_summary.drop(columns=['elapsed_time'], inplace=True)
 
-    # Full Cross Join
-    df_tracks = df_tracks.assign(join_key=1)
-    df_summary = df_summary.assign(join_key=1)
-    df_merge = pd.merge(df_summary, df_tracks, on='join_key').drop('join_key', axis=1)
-    # Filter only on tracks performed during workout times
-    df_merge = df_merge.query('timestamp_utc >= start_date_utc and timestamp_utc <= end_date_utc')
-    # Join back to original date range table and drop key column
-    df = df_tracks.merge(df_merge, on=['timestamp_utc'], how='left').fillna('').drop('join_key', axis=1)
+    # Match tracks performed during workout times (start <= track <= end). Tracks are sorted once and each workout's
+    # tracks are found with a binary search, rather than filtering a full cross join of tracks and workouts
+    play_times = df_tracks['timestamp_utc'].sort_values()
+    first, last = np.zeros(len(df_summary), dtype=int), np.zeros(len(df_summary), dtype=int)
+    valid = (df_summary['start_date_utc'].notnull() & df_summary['end_date_utc'].notnull()).values
+    if len(play_times) > 0 and valid.any():
+        first[valid] = play_times.searchsorted(df_summary['start_date_utc'][valid], side='left')
+        last[valid] = play_times.searchsorted(df_summary['end_date_utc'][valid], side='right')
+    counts = last - first
+    # One row per (workout, track) pair, workouts in their original order like the cross join
+    workout_rows = np.repeat(np.arange(len(df_summary)), counts)
+    play_rows = np.arange(counts.sum()) + np.repeat(first - (np.cumsum(counts) - counts), counts)
+    df_merge = df_summary.iloc[workout_rows].reset_index(drop=True)
+    df_merge['timestamp_utc'] = play_times.iloc[play_rows].reset_index(drop=True)
+    # Join back to original date range table
+    df = df_tracks.merge(df_merge, on=['timestamp_utc'], how='left').fillna('')
     # Days with no workout_intensity are rest days
     df.at[df['start_date_utc'] == '', 'workout_intensity'] = 'rest'
     # Cleanup the end resulting df
-    df = df[[c for c in df.columns if '_y' not in c]]
-    df.columns = [c.replace('_x', '') for c in df.columns]
     df = df.rename(columns={'type': 'workout_type', 'name': 'workout_name'})
     # Filter on workout intensity/rest day
     if workout_intensity == 'workout':
@@ -510,50 +572,97 @@ def predict_songs(df_tracks, df_train):
 
 
 ### Spotify Stream ###
-def stream():
+class SpotifyPoller(threading.Thread):
     '''
-    Captures live activity of spotify web player and adds list of states (playback feed) to queue after each song finishes
-    :param tekoreClient: tekoreClient obejct
-    :return: none
+    Captures live activity of spotify web player and adds list of (state, seconds) samples (playback feed) to queue
+    after each song finishes. The client and token are kept in memory and only refreshed when close to expiring.
+    Polls every poll_interval_seconds while a song is playing, and backs off while paused or when nothing is playing.
     '''
-    global current_state
-    global last_state
-    global playback_feed
-    tekoreClient = get_spotify_client()
-    # current_state = tekoreClient.playback()
 
-    try:
+    def __init__(self, queue):
+        threading.Thread.__init__(self, name='spotify-poller')
+        self.daemon = True
+        self.q = queue
+        self.client = None
+        self.token_dict = None
+        self.current_state = None
+        self.last_state = None
+        self.playback_feed = []
+        self.last_poll = None
+        self.stopped = threading.Event()
+        # The parser thread uses the same client for audio features
+        self.client_lock = threading.Lock()
+
+    def spotify(self):
+        with self.client_lock:
+            if self.client is None:
+                self.token_dict = current_token_dict()
+                self.client = tk.Spotify(self.token_dict['access_token'])
+            # Refresh a minute early so polls never go out with an expired token
+            if int(time.time()) > self.token_dict['expires_at'] - 60:
+                app.server.logger.debug('Spotify tokens expired, refreshing...')
+                new_token = tk.Credentials(client_id=client_id, client_secret=client_secret,
+                                           redirect_uri=redirect_uri).refresh_user_token(
+                    self.token_dict['refresh_token'])
+                save_spotify_token(new_token)
+                self.token_dict = current_token_dict()
+                self.client.token = self.token_dict['access_token']
+            return self.client
+
+    def poll_interval(self, state):
+        if not hasattr(state, 'item'):
+            return idle_poll_interval_seconds
+        return poll_interval_seconds if state.is_playing else paused_poll_interval_seconds
+
+    def poll(self):
         # Do not overwrite last_state until next state that is pulled below is not none
-        if hasattr(current_state, 'item'):
-            last_state = current_state
+        if hasattr(self.current_state, 'item'):
+            self.last_state = self.current_state
+
+        self.current_state = self.spotify().playback_currently_playing()
 
-        current_state = tekoreClient.playback_currently_playing()
+        # Seconds this sample accounts for, at most one poll interval so the first sample after idling doesn't count
+        # the time nothing was playing
+        now = time.monotonic()
+        seconds = min(now - self.last_poll, self.poll_interval(self.current_state)) if self.last_poll else 0
+        self.last_poll = now
 
-        if hasattr(current_state, 'item'):
+        if hasattr(self.current_state, 'item'):
             try:
-                last_song = last_state.item.id
+                last_song = self.last_state.item.id
             except:
                 last_song = 'No Stream Detected'
-            current_song = current_state.item.id
+            current_song = self.current_state.item.id
 
             # If song changed add feed to queue for parsing, otherwise continue appending feed
             # If song is on repeat will show as 'rewind'
-            if last_song != current_song and len(playback_feed) > 0:
-                # app.server.logger.debug(
-                #     'Song changed from "{}" to "{}"'.format(last_state.item.name, current_state.item.name))
+            if last_song != current_song and len(self.playback_feed) > 0:
                 # Add to queue for parsing
-                q.put(playback_feed)
+                self.q.put(self.playback_feed)
                 # Clear out feed for next track
-                playback_feed = []
-            elif current_state.item.type == 'track':
-                playback_feed.append(current_state)
+                self.playback_feed = []
+            elif self.current_state.item.type == 'track':
+                self.playback_feed.append((self.current_state, seconds))
 
                 # If the song has not been changed for longer than 5x the length of current song, listening
                 # session is probably over. Clear out current/last state
-                if len(playback_feed) > 5 * (float(current_state.item.duration_ms / 1000)):
-                    current_state, last_state = None, None
-    except BaseException as e:
-        app.server.logger.error(f'Error with spotify stream: {e}')
+                if sum(secs for state, secs in self.playback_feed) > 5 * (
+                        float(self.current_state.item.duration_ms / 1000)):
+                    self.current_state, self.last_state = None, None
+
+    def run(self):
+        app.server.logger.debug('Spotify poller started')
+        while not self.stopped.wait(self.poll_interval(self.current_state)):
+            try:
+                self.poll()
+            except tk.Unauthorised as e:
+                # Tokens may have been replaced by reconnecting spotify on the settings page, reload them from the db
+                app.server.logger.error(f'Error with spotify stream: {e}')
+                self.client = None
+                self.stopped.wait(idle_poll_interval_seconds)
+            except BaseException as e:
+                app.server.logger.error(f'Error with spotify stream: {e}')
+                self.stopped.wait(idle_poll_interval_seconds)
 
 
 class Parser(threading.Thread):
@@ -561,33 +670,79 @@ class Parser(threading.Thread):
         app.server.logger.debug('Parser thread started')
         threading.Thread.__init__(self)
         self.q = queue
+        # Parsed plays waiting to be written
+        self.plays = []
+        self.write_lock = threading.Lock()
 
     def run(self):
         while True:
-            playback_feed = self.q.get()
-            # Parse feed
-            parse_stream(playback_feed)
-            # Mark task complete
-            self.q.task_done()
+            try:
+                playback_feed = self.q.get(timeout=write_flush_seconds)
+            except queue.Empty:
+                # No songs finished for a while, write whatever has been parsed
+                self.write_plays()
+                continue
+            try:
+                # Parse feed
+                play = parse_stream(playback_feed)
+                if play is not None:
+                    self.plays.append(play)
+                if len(self.plays) >= write_batch_size:
+                    self.write_plays()
+            except BaseException as e:
+                app.server.logger.error(f'Error parsing spotify stream: {e}')
+            finally:
+                # Mark task complete
+                self.q.task_done()
+
+    def write_plays(self):
+        with self.write_lock:
+            if not self.plays:
+                return
+            plays, self.plays = pd.concat(self.plays), []
+            # Look up features for the whole batch, so tracks missing from the cache are fetched in one request
+            try:
+                features = get_track_features(plays['track_id'], spotify=spotify_poller.spotify())
+                plays = plays.join(features, on='track_id')
+            except BaseException as e:
+                app.server.logger.error(f'Error looking up spotify audio features: {e}')
+            try:
+                # Insert into DB
+                plays.to_sql('spotify_play_history', engine, if_exists='append', index=True)
+            except BaseException as e:
+                # Don't lose the whole batch to one bad row
+                app.server.logger.error(f'Error writing {len(plays)} spotify plays, writing one at a time: {e}')
+                for i in range(len(plays)):
+                    try:
+                        plays.iloc[[i]].to_sql('spotify_play_history', engine, if_exists='append', index=True)
+                    except BaseException as e:
+                        app.server.logger.error(f'Error writing spotify play: {e}')
 
 
 # Thread for parsing into db while stream is running
 parser = Parser(queue=q)
 parser.daemon = True
 parser.start()
+# Write plays still waiting on a batch when the server stops
+atexit.register(parser.write_plays)
+
+spotify_poller = SpotifyPoller(queue=q)
 
 
 def parse_stream(playback_feed):
+    '''
+    :param playback_feed: list of (state, seconds) samples of one song from SpotifyPoller
+    :return: df of the play (without audio features) to insert into spotify_play_history, None if the song was not
+    listened to long enough
+    '''
     # Check that song was listened to for longer than threshold
     secs_playing, secs_paused = 0, 0
-    for x in playback_feed:
+    for x, seconds in playback_feed:
         if x.is_playing:
-            secs_playing += 1
+            secs_playing += seconds
         else:
-            secs_paused += 1
-
-    secs_playing *= poll_interval_seconds
-    secs_paused *= poll_interval_seconds
+            secs_paused += seconds
+    playback_feed = [x for x, seconds in playback_feed]
 
     # Check if song was listened to for longer than config threshold
     if int(secs_playing) >= int(min_secs_listened):
@@ -658,13 +813,4 @@ def parse_stream(playback_feed):
             "secs_paused": secs_paused
         }])
 
-        spotify = get_spotify_client()
-        track_features = pd.DataFrame(
-            json.loads(spotify.tracks_audio_features([playback_feed[0].item.id]).json())).drop(
-            columns=['duration_ms', 'type', 'analysis_url', 'uri', 'track_href'])
-
-        # Merge trackinfo with track features
-        track_table = pd.merge(track_info_df, track_features, how='left', left_on='track_id', right_on='id').set_index(
-            'timestamp_utc').drop(columns=['id'])
-        # Insert into DB
-        track_table.to_sql('spotify_play_history', engine, if_exists='append', index=True)
+        return track_info_df.set_index('timestamp_utc')
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Date, Float, BigInteger, PickleType
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Date, Float, BigInteger, PickleType, LargeBinary, Text
 from .database import Base
 
 
@@ -107,20 +107,54 @@ class stravaSamples(Base):
     hr_lowest = Column('hr_lowest', Integer())
 
 
-class stravaBestSamples(Base):
-    __tablename__ = 'strava_best_samples'
+class stravaPowerCurve(Base):
+    __tablename__ = 'strava_power_curves'
     activity_id = Column('activity_id', BigInteger(), index=True, primary_key=True)
-    interval = Column('interval', Integer, index=True, primary_key=True)
-    mmp = Column('mmp', Float())
+    athlete_id = Column('athlete_id', BigInteger())
+    type = Column('type', String(255), index=True)
+    act_name = Column('act_name', String(255))
+    date = Column('date', Date())
+    timestamp_local = Column('timestamp_local', DateTime(), index=True)
+    timestamp_utc = Column('timestamp_utc', DateTime())
     ftp = Column('ftp', Float())
-    watts_per_kg = Column('watts_per_kg', Float())
-    timestamp_local = Column('timestamp_local', DateTime())
+    kg = Column('kg', Float())
+    durations = Column('durations', Integer())
+    # Packed (seconds, float32 mean max power) points, durations is the longest one, see api/power_curves.py
+    mmp = Column('mmp', LargeBinary())
+
+
+class stravaPowerEnvelope(Base):
+    __tablename__ = 'strava_power_envelopes'
+    type = Column('type', String(255), primary_key=True)
+    period = Column('period', String(255), primary_key=True)
+    durations = Column('durations', Integer())
+    # Packed best mean max power for every second, with the activity id and start time each point came from
+    mmp = Column('mmp', LargeBinary())
+    activity_ids = Column('activity_ids', LargeBinary())
+    timestamps = Column('timestamps', LargeBinary())
     timestamp_utc = Column('timestamp_utc', DateTime())
-    time_interval = Column('time_interval', DateTime())
-    type = Column('type', String(255))
-    date = Column('date', Date())
-    act_name = Column('act_name', String(255))
+
+
+class stravaStreams(Base):
+    __tablename__ = 'strava_streams'
+    activity_id = Column('activity_id', BigInteger(), index=True, primary_key=True)
     athlete_id = Column('athlete_id', BigInteger())
+    file_name = Column('file_name', String(255))
+    stream_types = Column('stream_types', String(255))
+    samples = Column('samples', Integer())
+    file_bytes = Column('file_bytes', Integer())
+    timestamp_utc = Column('timestamp_utc', DateTime())
+
+
+class stravaDownloadQueue(Base):
+    __tablename__ = 'strava_download_queue'
+    activity_id = Column('activity_id', BigInteger(), index=True, primary_key=True)
+    athlete_id = Column('athlete_id', BigInteger())
+    start_date_utc = Column('start_date_utc', DateTime(), index=True)
+    activity = Column('activity', Text())
+    attempts = Column('attempts', Integer(), default=0)
+    last_error = Column('last_error', String(255))
+    queued_utc = Column('queued_utc', DateTime())
 
 
 class stravaSummary(Base):
@@ -324,6 +358,14 @@ class ouraSleepSamples(Base):
     hypnogram_5min_desc = Column('hypnogram_5min_desc', String(8))
 
 
+class ouraDayHash(Base):
+    __tablename__ = 'oura_day_hashes'
+    dataset = Column('dataset', String(255), primary_key=True)
+    summary_date = Column('summary_date', Date(), primary_key=True)
+    content_hash = Column('content_hash', String(64))
+    timestamp_utc = Column('timestamp_utc', DateTime())
+
+
 # class correlations(Base):
 #     __tablename__ = 'correlations'
 #     Metric = Column('Metric', String(), index=True, primary_key=True)
@@ -486,6 +528,24 @@ class spotifyPlayHistory(Base):
     secs_paused = Column('secs_paused', Integer())
 
 
+class spotifyTrackFeatures(Base):
+    __tablename__ = 'spotify_track_features'
+    track_id = Column('track_id', String(255), primary_key=True)
+    acousticness = Column('acousticness', Float())
+    danceability = Column('danceability', Float())
+    energy = Column('energy', Float())
+    instrumentalness = Column('instrumentalness', Float())
+    key = Column('key', Integer())
+    liveness = Column('liveness', Float())
+    loudness = Column('loudness', Float())
+    mode = Column('mode', Integer())
+    speechiness = Column('speechiness', Float())
+    tempo = Column('tempo', Float())
+    time_signature = Column('time_signature', Integer())
+    valence = Column('valence', Float())
+    timestamp_utc = Column('timestamp_utc', DateTime())
+
+
 class apiTokens(Base):
     __tablename__ = 'api_tokens'
     date_utc = Column('date_utc', DateTime(), index=True, primary_key=True)
@@ -504,6 +564,27 @@ class dbRefreshStatus(Base):
     fitbod_status = Column('fitbod_status', String(255))
 
 
+class refreshLock(Base):
+    __tablename__ = 'refresh_locks'
+    name = Column('name', String(255), primary_key=True)
+    owner = Column('owner', String(255))
+    acquired_utc = Column('acquired_utc', DateTime())
+    heartbeat_utc = Column('heartbeat_utc', DateTime())
+    expires_utc = Column('expires_utc', DateTime(), index=True)
+
+
+class fitlyJob(Base):
+    __tablename__ = 'fitly_jobs'
+    job_id = Column('job_id', String(36), primary_key=True)
+    name = Column('name', String(255))
+    status = Column('status', String(255), index=True)
+    stage = Column('stage', String(255))
+    error = Column('error', String(255))
+    submitted_utc = Column('submitted_utc', DateTime(), index=True)
+    started_utc = Column('started_utc', DateTime())
+    finished_utc = Column('finished_utc', DateTime())
+
+
 class withings(Base):
     __tablename__ = 'withings'
     date_utc = Column('date_utc', DateTime(), index=True, primary_key=True)
@@ -512,6 +593,25 @@ class withings(Base):
     hydration = Column('hydration', Float())
 
 
+class syncCursor(Base):
+    __tablename__ = 'sync_cursors'
+    service = Column('service', String(255), primary_key=True)
+    cursor_utc = Column('cursor_utc', DateTime())
+    timestamp_utc = Column('timestamp_utc', DateTime())
+
+
+class pelotonWorkout(Base):
+    __tablename__ = 'peloton_workouts'
+    workout_id = Column('workout_id', String(255), primary_key=True)
+    start_utc = Column('start_utc', DateTime(), index=True)
+    created_at_utc = Column('created_at_utc', DateTime(), index=True)
+    end_utc = Column('end_utc', DateTime())
+    fitness_discipline = Column('fitness_discipline', String(255))
+    ride_id = Column('ride_id', String(255))
+    name = Column('name', String(255))
+    timestamp_utc = Column('timestamp_utc', DateTime())
+
+
 class fitbod(Base):
     __tablename__ = 'fitbod'
     id = Column('id', Integer(), index=True, primary_key=True, autoincrement=True)
@@ -1,10 +1,14 @@
 from stravalib.client import Client
+from stravalib import exc
+from stravalib.util.limiter import get_rates_from_response_headers
 import datetime
 from datetime import datetime
 from sqlalchemy import delete
 from ..api.sqlalchemy_declarative import apiTokens
 from ..utils import config
 from ..app import app
+import requests
+import threading
 import time
 import pickle
 
@@ -12,6 +16,103 @@ client_id = config.get('strava', 'client_id')
 client_secret = config.get('strava', 'client_secret')
 redirect_uri = config.get('strava', 'redirect_uri')
 
+# Strava's default read budgets, replaced by the limits on the first response's rate limit headers
+SHORT_WINDOW_SECONDS = 15 * 60
+LONG_WINDOW_SECONDS = 24 * 60 * 60
+
+
+class StravaRateLimiter:
+    '''
+    Token bucket for strava's 15 minute and daily request budgets, shared by every client in the process.
+    Each window's bucket is refilled when the window resets (every quarter hour / utc midnight), requests take a
+    token before they are sent and the usage strava reports on every response corrects the count.
+    '''
+
+    def __init__(self, short_limit=100, long_limit=1000):
+        self.lock = threading.Lock()
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.short_usage = 0
+        self.long_usage = 0
+        self.short_window = None
+        self.long_window = None
+
+    def roll_windows(self, now):
+        # Usage resets when strava's windows do
+        short_window, long_window = int(now // SHORT_WINDOW_SECONDS), int(now // LONG_WINDOW_SECONDS)
+        if short_window != self.short_window:
+            self.short_window, self.short_usage = short_window, 0
+        if long_window != self.long_window:
+            self.long_window, self.long_usage = long_window, 0
+
+    def acquire(self, reserve=0):
+        '''
+        Take a token for one request, waiting for the 15 minute window to reset if its budget is spent
+        :param reserve: requests to leave in each window for other callers (pages, webhooks...)
+        :raises RateLimitExceeded: if the daily budget is spent, with the seconds until it resets as timeout
+        '''
+        while True:
+            with self.lock:
+                now = time.time()
+                self.roll_windows(now)
+                if self.long_usage >= self.long_limit - reserve:
+                    raise exc.RateLimitExceeded('Strava daily rate limit reached', limit=self.long_limit,
+                                                timeout=LONG_WINDOW_SECONDS - now % LONG_WINDOW_SECONDS)
+                if self.short_usage < self.short_limit - reserve:
+                    self.short_usage += 1
+                    self.long_usage += 1
+                    return
+                wait = SHORT_WINDOW_SECONDS - now % SHORT_WINDOW_SECONDS + 1
+            app.server.logger.info(f'Strava 15 minute rate limit reached, waiting {wait:.0f} seconds')
+            time.sleep(wait)
+
+    def update(self, headers, status_code=None):
+        # Take usage and limits from strava's rate limit headers
+        rates = get_rates_from_response_headers(headers)
+        with self.lock:
+            self.roll_windows(time.time())
+            if rates:
+                self.short_limit, self.long_limit = rates.short_limit, rates.long_limit
+                # Other requests may have been sent since this one was counted, never lower the local count
+                self.short_usage = max(self.short_usage, rates.short_usage)
+                self.long_usage = max(self.long_usage, rates.long_usage)
+            if status_code == 429:
+                self.short_usage = max(self.short_usage, self.short_limit)
+
+
+strava_rate_limiter = StravaRateLimiter()
+
+
+def rate_limit_message(e):
+    # stravalib's RateLimitExceeded doesn't keep its message, so describe it from the limit and timeout
+    message = 'Strava rate limit reached'
+    if e.limit:
+        message += f' ({e.limit} requests)'
+    if e.timeout:
+        message += f', resets in {e.timeout:.0f} seconds'
+    return message
+
+
+class RateLimitedSession(requests.Session):
+    '''
+    requests session for stravalib that paces requests through the shared StravaRateLimiter, requests that still
+    hit a 429 are retried once the window resets
+    '''
+
+    def __init__(self, reserve=0, max_retries=3):
+        super().__init__()
+        self.reserve = reserve
+        self.max_retries = max_retries
+
+    def request(self, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            strava_rate_limiter.acquire(reserve=self.reserve)
+            response = super().request(*args, **kwargs)
+            strava_rate_limiter.update(response.headers, response.status_code)
+            if response.status_code != 429:
+                break
+        return response
+
 
 # Retrieve current tokens from db
 def current_token_dict():
@@ -37,10 +138,14 @@ def save_strava_token(token_dict):
     app.session.remove()
 
 
-def get_strava_client():
+def get_strava_client(reserve=0):
+    '''
+    :param reserve: requests to leave in each rate limit window, set for background jobs so pages can still use the api
+    '''
     token_dict = current_token_dict()
     if token_dict:
-        client = Client()
+        # Rate limiting is handled by the shared session rather than stravalib's limiter, which raises instead of waiting
+        client = Client(rate_limit_requests=False, requests_session=RateLimitedSession(reserve=reserve))
         client.access_token = token_dict['access_token']
         client.refresh_token = token_dict['refresh_token']
         # If token is old, refresh it
@@ -0,0 +1,109 @@
+from datetime import datetime
+import json
+import stravalib
+from stravalib import exc
+from stravalib.attributes import LocationAttribute, TimeIntervalAttribute
+from ..api.sqlalchemy_declarative import stravaDownloadQueue
+from ..api.fitlyAPI import FitlyActivity, scrape_activities
+from ..api.stravaApi import rate_limit_message
+from ..app import app
+from ..utils import config
+
+
+def activity_to_json(activity):
+    '''
+    Serialize a listed strava activity so it can be scraped later without listing it again
+    :param activity: stravalib Activity from client.get_activities()
+    '''
+    d = activity.to_dict()
+    for cls in activity.__class__.__mro__:
+        for attrname, attr in cls.__dict__.items():
+            value = getattr(activity, attrname, None) if attrname in d else None
+            if value is None:
+                continue
+            # to_dict() writes these in formats from_dict() can't read back (lat/lon as a string, intervals without days)
+            if isinstance(attr, LocationAttribute):
+                d[attrname] = [value.lat, value.lon]
+            elif isinstance(attr, TimeIntervalAttribute):
+                d[attrname] = int(value.total_seconds())
+    return json.dumps(d, default=str)
+
+
+def activity_from_json(activity_json):
+    return FitlyActivity(stravalib.model.Activity.deserialize(json.loads(activity_json)))
+
+
+def enqueue_activities(activities, athlete_id):
+    # Record listed activities before downloading them, so a restart picks up where the last refresh stopped
+    queued_utc = datetime.utcnow()
+    for act in activities:
+        app.session.merge(stravaDownloadQueue(activity_id=act.id, athlete_id=athlete_id,
+                                              start_date_utc=act.start_date.replace(tzinfo=None),
+                                              activity=activity_to_json(act), queued_utc=queued_utc))
+    app.session.commit()
+    app.session.remove()
+
+
+def queued_activities(athlete_id, activity_ids=None):
+    max_attempts = int(config.get('strava', 'queue_max_attempts', fallback=3))
+    query = app.session.query(stravaDownloadQueue).filter(stravaDownloadQueue.athlete_id == athlete_id,
+                                                          stravaDownloadQueue.attempts < max_attempts)
+    if activity_ids is not None:
+        query = query.filter(stravaDownloadQueue.activity_id.in_(activity_ids))
+    queue = query.order_by(stravaDownloadQueue.start_date_utc).all()
+    app.session.remove()
+    return queue
+
+
+def dequeue_activity(act):
+    app.session.query(stravaDownloadQueue).filter(stravaDownloadQueue.activity_id == act.id).delete()
+    app.session.commit()
+    app.session.remove()
+
+
+def record_queue_error(activity_id, error):
+    # Count the failed attempt, activities that are out of attempts are dropped from the queue
+    max_attempts = int(config.get('strava', 'queue_max_attempts', fallback=3))
+    row = app.session.query(stravaDownloadQueue).filter(stravaDownloadQueue.activity_id == activity_id).first()
+    if row:
+        row.attempts = (row.attempts or 0) + 1
+        row.last_error = str(error)[:255]
+        if row.attempts >= max_attempts:
+            app.server.logger.error(f'Giving up on strava activity {activity_id} after {row.attempts} attempts: {error}')
+            app.session.delete(row)
+        app.session.commit()
+    app.session.remove()
+
+
+def process_strava_queue(athlete_id, client=None, activity_ids=None):
+    '''
+    Scrape queued strava activities oldest first, removing each one from the queue once it is in the db.
+    Stops when strava's daily rate limit is reached, leaving the remaining activities queued for the next refresh.
+    An activity that fails is left queued for the next refresh and the rest of the batch carries on, activities
+    that keep failing are removed from the queue after [strava] queue_max_attempts.
+    :param activity_ids: only scrape these queued activities, defaults to the whole queue
+    :return: number of activities left queued because the rate limit was reached
+    '''
+    queue = queued_activities(athlete_id, activity_ids=activity_ids)
+    if not queue:
+        return 0
+    activities = [activity_from_json(row.activity) for row in queue]
+    app.server.logger.info(f'Downloading {len(activities)} queued strava activities...')
+    loaded, failed = set(), set()
+
+    def on_loaded(act):
+        dequeue_activity(act)
+        loaded.add(act.id)
+
+    def on_error(act, e):
+        app.server.logger.error(f'Error loading strava activity {act.id}: {e}')
+        record_queue_error(act.id, e)
+        failed.add(act.id)
+
+    try:
+        scrape_activities(activities, athlete_id=athlete_id, client=client, on_loaded=on_loaded, on_error=on_error)
+    except exc.RateLimitExceeded as e:
+        remaining = len(activities) - len(loaded) - len(failed)
+        app.server.logger.info(f'{rate_limit_message(e)}, {remaining} activities left in the download queue')
+        return remaining
+    return 0
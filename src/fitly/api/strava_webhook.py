@@ -0,0 +1,165 @@
+import os
+import time
+import requests
+from flask import request, jsonify
+from sqlalchemy import delete
+from stravalib import exc
+from ..api.sqlalchemy_declarative import stravaSummary, stravaSamples, stravaPowerCurve, stravaDownloadQueue
+from ..api.stream_archive import stream_archive_path
+from ..api.stravaApi import get_strava_client, strava_connected
+from ..api.strava_queue import enqueue_activities, process_strava_queue
+from ..api.fitlyAPI import delete_activity_rows
+from ..api.locks import RefreshLease
+from ..api.jobs import submit_job
+from ..app import app
+from ..utils import config
+
+# Callback url to register with strava's push subscription api, i.e. https://<your domain>/strava/webhook
+WEBHOOK_PATH = '/strava/webhook'
+
+athlete_id = 1  # TODO: Make this dynamic if ever expanding to more users
+
+
+def webhook_config():
+    # The webhook is disabled unless the verify token, subscription id and owner id are all configured
+    settings = {key: config.get('strava', key, fallback='').strip() for key in
+                ['webhook_verify_token', 'webhook_subscription_id', 'webhook_owner_id']}
+    return settings if all(settings.values()) else None
+
+
+def wait_for_strava_lock():
+    # Webhook events are handled one at a time by the job runner, so waiting for a running refresh is fine
+    wait = float(config.get('strava', 'webhook_lock_wait_seconds', fallback=300))
+    lease = RefreshLease(['strava'])
+    deadline = time.time() + wait
+    while not lease.acquire():
+        if time.time() > deadline:
+            raise TimeoutError(f'Strava refresh still running after {wait:.0f} seconds')
+        time.sleep(5)
+    return lease
+
+
+def activity_loaded(activity_id):
+    loaded = app.session.query(stravaSummary.activity_id).filter(stravaSummary.activity_id == activity_id).first()
+    app.session.remove()
+    return loaded is not None
+
+
+def delete_activity(activity_id, dequeue=True, keep_streams=False):
+    # Remove an activity from every strava table, its stream archive, and the power curve envelopes it may have
+    # points in. keep_streams leaves the archive (and its index row) so a reload doesn't download the streams again
+    if dequeue:
+        app.session.execute(delete(stravaDownloadQueue).where(stravaDownloadQueue.activity_id == activity_id))
+        app.session.commit()
+        app.session.remove()
+    delete_activity_rows(activity_id, keep_streams=keep_streams)
+    path = stream_archive_path(activity_id)
+    if not keep_streams and os.path.isfile(path):
+        os.remove(path)
+
+
+def rename_activity(activity_id, name):
+    # Title changes don't affect any metrics, so update the name in place instead of downloading the activity
+    app.session.query(stravaSummary).filter(stravaSummary.activity_id == activity_id).update({'name': name})
+    app.session.query(stravaSamples).filter(stravaSamples.activity_id == activity_id).update({'act_name': name})
+    app.session.query(stravaPowerCurve).filter(stravaPowerCurve.activity_id == activity_id).update({'act_name': name})
+    app.session.commit()
+    app.session.remove()
+
+
+def handle_strava_event(event):
+    '''
+    Apply a strava webhook event to the db, only touching the activity in the event. Other queued activities are
+    left for the next refresh
+    :param event: webhook event body, see https://developers.strava.com/docs/webhooks/
+    '''
+    activity_id, aspect_type = int(event['object_id']), event['aspect_type']
+    updates = event.get('updates') or {}
+    if not strava_connected():
+        app.server.logger.info(f'Strava webhook: strava not connected, ignoring event for activity {activity_id}')
+        return
+    client = get_strava_client(reserve=int(config.get('strava', 'rate_limit_reserve', fallback=10)))
+    if aspect_type == 'delete':
+        # Events aren't signed, so only delete activities strava no longer has
+        try:
+            client.get_activity(activity_id)
+            app.server.logger.warning(f'Strava webhook: activity {activity_id} still exists, ignoring delete event')
+            return
+        except exc.ObjectNotFound:
+            pass
+    if aspect_type == 'create' and activity_loaded(activity_id):
+        app.server.logger.debug(f'Strava webhook: activity {activity_id} already loaded')
+        return
+    rename = aspect_type == 'update' and not set(updates) - {'title'}
+    if aspect_type != 'delete':
+        # Read the activity from strava rather than trusting the event body, which isn't signed
+        activity = client.get_activity(activity_id)
+        if not rename:
+            # Queue before waiting on the lock, so the activity is picked up by the next refresh if this event fails
+            enqueue_activities([activity], athlete_id=athlete_id)
+
+    lease = wait_for_strava_lock()
+    try:
+        if aspect_type == 'delete':
+            app.server.logger.info(f'Strava webhook: deleting activity {activity_id}')
+            delete_activity(activity_id)
+        elif rename:
+            app.server.logger.info(f'Strava webhook: renaming activity {activity_id} to "{activity.name}"')
+            rename_activity(activity_id, activity.name)
+        else:
+            app.server.logger.info(f'Strava webhook: loading activity {activity_id}')
+            if aspect_type == 'update':
+                # Type/privacy changes can change zones and scores, reload the activity (streams come from the archive)
+                delete_activity(activity_id, dequeue=False, keep_streams=True)
+            process_strava_queue(athlete_id, client=client, activity_ids=[activity_id])
+    finally:
+        lease.release()
+
+
+@app.server.route(WEBHOOK_PATH, methods=['GET'])
+def strava_webhook_verify():
+    # Subscription validation, strava expects the challenge echoed back if the verify token matches
+    settings = webhook_config()
+    if settings is None:
+        return jsonify({'error': 'Not found'}), 404
+    if request.args.get('hub.mode') != 'subscribe' or \
+            request.args.get('hub.verify_token') != settings['webhook_verify_token']:
+        return jsonify({'error': 'Invalid verify token'}), 403
+    app.server.logger.info('Strava webhook subscription verified')
+    return jsonify({'hub.challenge': request.args.get('hub.challenge')})
+
+
+@app.server.route(WEBHOOK_PATH, methods=['POST'])
+def strava_webhook_event():
+    # Strava expects a 200 within 2 seconds, so events are handled by the job runner
+    settings = webhook_config()
+    if settings is None:
+        return jsonify({'error': 'Not found'}), 404
+    event = request.get_json(silent=True) or {}
+    if not {'object_type', 'object_id', 'aspect_type'} <= set(event):
+        return jsonify({'error': 'Invalid event'}), 400
+    if str(event.get('subscription_id')) != settings['webhook_subscription_id'] or \
+            str(event.get('owner_id')) != settings['webhook_owner_id']:
+        return jsonify({'error': 'Unknown subscription'}), 403
+
+    if event['object_type'] == 'activity':
+        submit_job(f'Strava {event["aspect_type"]} {event["object_id"]}', handle_strava_event, event)
+    elif event['object_type'] == 'athlete' and (event.get('updates') or {}).get('authorized') == 'false':
+        app.server.logger.info('Strava webhook: athlete revoked access to fitly')
+    return jsonify({}), 200
+
+
+def send_strava_event(object_id, aspect_type='create', updates=None, url=None, subscription_id=None, owner_id=None):
+    '''
+    Stand-in for strava's push api, posts an event in the same format to a running fitly server.
+    Used to test webhook ingestion locally without a public callback url.
+    :param url: webhook url, defaults to the local dev server
+    :return: requests response
+    '''
+    url = url or f'http://127.0.0.1:8050{WEBHOOK_PATH}'
+    event = {'object_type': 'activity', 'object_id': int(object_id), 'aspect_type': aspect_type,
+             'updates': updates or {},
+             'owner_id': owner_id or config.get('strava', 'webhook_owner_id', fallback=None),
+             'subscription_id': subscription_id or config.get('strava', 'webhook_subscription_id', fallback=None),
+             'event_time': int(time.time())}
+    return requests.post(url, json=event, timeout=10)
@@ -0,0 +1,72 @@
+import os
+from datetime import datetime
+import numpy as np
+from ..api.sqlalchemy_declarative import stravaStreams
+from ..app import app
+
+# Raw strava streams are kept next to the db so samples can be rebuilt without hitting the strava api
+STREAM_ARCHIVE_DIR = os.path.join('config', 'streams')
+
+
+def stream_archive_path(activity_id):
+    return os.path.join(STREAM_ARCHIVE_DIR, f'{activity_id}.npz')
+
+
+def stream_array(stream_type, values):
+    array = np.asarray(values)
+    # Streams with gaps come back with None values, store those as float with nans
+    if array.dtype == object:
+        if stream_type == 'latlng':
+            array = np.array([value if value is not None else [np.nan, np.nan] for value in values], dtype=float)
+        else:
+            array = np.array([value if value is not None else np.nan for value in values], dtype=float)
+    return array
+
+
+def stream_arrays(streams):
+    '''
+    :param streams: dict of stream type -> list of values
+    :return: dict of stream type -> numpy array, as they will be read back by load_streams()
+    '''
+    return {stream_type: stream_array(stream_type, values) for stream_type, values in streams.items()}
+
+
+def save_streams(activity_id, streams):
+    '''
+    Write an activity's streams to its compressed archive file, one array per stream type in its native dtype
+    :param streams: dict of stream type -> list of values (or arrays from stream_arrays())
+    :return: dict of stream type -> numpy array, as they will be read back by load_streams()
+    '''
+    arrays = stream_arrays(streams)
+    os.makedirs(STREAM_ARCHIVE_DIR, exist_ok=True)
+    path = stream_archive_path(activity_id)
+    # Write to a temp file first so a failed write never leaves a partial archive behind
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(path + '.tmp', path)
+    return arrays
+
+
+def load_streams(activity_id):
+    '''
+    :return: dict of stream type -> numpy array, None if the activity has not been archived
+    '''
+    path = stream_archive_path(activity_id)
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as archive:
+        return {stream_type: archive[stream_type] for stream_type in archive.files}
+
+
+def index_streams(activity_id, athlete_id, streams):
+    # Record the archive file in the db so archived activities can be found without listing the directory
+    path = stream_archive_path(activity_id)
+    app.session.merge(stravaStreams(activity_id=activity_id,
+                                    athlete_id=athlete_id,
+                                    file_name=os.path.basename(path),
+                                    stream_types=','.join(streams.keys()),
+                                    samples=len(streams['time']) if 'time' in streams else 0,
+                                    file_bytes=os.path.getsize(path),
+                                    timestamp_utc=datetime.utcnow()))
+    app.session.commit()
+    app.session.remove()
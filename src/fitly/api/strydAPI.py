@@ -1,6 +1,7 @@
 import requests
 import datetime
 import pandas as pd
+from dateutil import tz
 from ..app import app
 from ..utils import config
 from .sqlalchemy_declarative import strydSummary
@@ -31,7 +32,16 @@ def pull_stryd_data():
     sessionID = auth_stryd_session()
     today = datetime.datetime.now() + datetime.timedelta(
         days=1)  # Pass tomorrow's date to ensure no issues with timezones
-    start = today - datetime.timedelta(days=9999)
+    # Only request the calendar from the latest stored workout (minus an overlap to catch late syncs), the first pull
+    # requests the entire history
+    last_styrd_date = app.session.query(func.max(strydSummary.start_date_local)).scalar()
+    app.session.remove()
+    if last_styrd_date:
+        start = pd.to_datetime(last_styrd_date) - datetime.timedelta(
+            days=float(config.get('stryd', 'sync_overlap_days', fallback=7)))
+    else:
+        start = today - datetime.timedelta(days=9999)
+    app.server.logger.debug('Pulling stryd workouts from {}'.format(start.date()))
     headers = {'Authorization': 'Bearer: {}'.format(sessionID)}
     url = "https://www.stryd.com/b/api/v1/activities/calendar?srtDate={start}&endDate={today}&sortBy=StartDate".format(
         start=start.strftime("%m-%d-%Y"), today=today.strftime("%m-%d-%Y"))
@@ -39,14 +49,18 @@ def pull_stryd_data():
 
     responseData = requests.get(url, headers=headers, params=jsonData)
     df = pd.DataFrame(responseData.json()['activities'])  # returns summary data for each workout
+    if len(df) == 0:
+        return df
     df.rename(columns={
         "timestamp": "start_date_local",
         "ftp": "stryd_ftp",
         "stress": "rss"},
         inplace=True)
 
-    df['start_date_local'] = df['start_date_local'].apply(datetime.datetime.fromtimestamp)
-    df.set_index(pd.to_datetime(df['start_date_local']), inplace=True)
+    # Epoch seconds to the server's local time, same as datetime.fromtimestamp()
+    df['start_date_local'] = pd.to_datetime(df['start_date_local'], unit='s', utc=True).dt.tz_convert(
+        tz.tzlocal()).dt.tz_localize(None)
+    df.set_index(df['start_date_local'], inplace=True)
 
     # Specify which columns from stryd we want to bring over
     df = df[['stryd_ftp',
@@ -78,10 +92,10 @@ def pull_stryd_data():
              'windGust',
              'dewPoint']]
 
-    # Filter df for only new records not yet in DB
-    last_styrd_date = app.session.query(func.max(strydSummary.start_date_local))[0][0]
-    if last_styrd_date:
-        df = df[df.index > last_styrd_date]
+    # Filter df for only new records not yet in DB, workouts inside the overlap may already be stored
+    stored = [start_date_local for start_date_local, in app.session.query(strydSummary.start_date_local).filter(
+        strydSummary.start_date_local >= start)]
+    df = df[~df.index.isin(pd.to_datetime(stored))]
     if len(df) > 0:
         app.server.logger.info('New stryd workouts found!')
         # Insert into db
@@ -0,0 +1,20 @@
+from datetime import datetime
+from ..api.sqlalchemy_declarative import syncCursor
+from ..app import app
+
+
+def get_sync_cursor(service):
+    '''
+    Point an incremental provider sync last finished at, in the provider's own terms (i.e. withings lastupdate)
+    :return: utc datetime, None if the provider has never been synced
+    '''
+    cursor = app.session.query(syncCursor.cursor_utc).filter(syncCursor.service == service).scalar()
+    app.session.remove()
+    return cursor
+
+
+def save_sync_cursor(service, cursor_utc):
+    app.session.merge(syncCursor(service=service, cursor_utc=cursor_utc, timestamp_utc=datetime.utcnow()))
+    app.session.commit()
+    app.session.remove()
+
@@ -0,0 +1,81 @@
+import numpy as np
+
+# Zones that roll up into each workout intensity bucket
+INTENSITY_LEVELS = ['low', 'med', 'high']
+RIDE_POWER_INTENSITY_ZONES = {'low': [1, 2, 3], 'med': [4], 'high': [5, 6, 7]}
+RUN_POWER_INTENSITY_ZONES = {'low': [1, 2], 'med': [3], 'high': [4, 5]}
+HEARTRATE_INTENSITY_ZONES = {'low': [1, 2], 'med': [3], 'high': [4, 5]}
+
+# Run power only has 4 configurable thresholds, so zones 5/6 are capped at 99x ftp
+RUN_POWER_ZONE_CAP = 99
+
+
+def is_run(activity_type):
+    return 'run' in activity_type.lower() or 'walk' in activity_type.lower()
+
+
+def is_ride(activity_type):
+    return 'ride' in activity_type.lower()
+
+
+def power_zone_thresholds(ftp, power_zones, activity_type):
+    '''
+    Absolute watt thresholds for power zones 1-6 (anything above the last threshold is zone 7)
+    :param ftp: ftp used for the activity
+    :param power_zones: dict of zone number to % of ftp as defined on the athlete table
+    :param activity_type: strava activity type
+    '''
+    multipliers = [power_zones[1], power_zones[2], power_zones[3], power_zones[4]]
+    if is_ride(activity_type):
+        multipliers += [power_zones[5], power_zones[6]]
+    else:
+        multipliers += [RUN_POWER_ZONE_CAP, RUN_POWER_ZONE_CAP]
+    return [round(ftp * multiplier) for multiplier in multipliers]
+
+
+def heartrate_zone_thresholds(max_hr, rest_hr, hearrate_zones):
+    '''
+    Absolute bpm thresholds for heartrate zones 1-4 (anything above the last threshold is zone 5), using heart rate reserve
+    '''
+    hrr = max_hr - rest_hr
+    return [round((hrr * hearrate_zones[zone]) + rest_hr) for zone in range(1, 5)]
+
+
+def classify_zones(values, thresholds):
+    '''
+    Bin every sample into the first zone whose threshold it is less than or equal to.
+    Samples above every threshold (or missing) land in the zone after the last threshold.
+    :return: float array of 1-based zone numbers
+    '''
+    values = np.asarray(values, dtype=float)
+    zones = np.full(values.shape, len(thresholds) + 1, dtype=float)
+    unassigned = np.ones(values.shape, dtype=bool)
+    for zone, threshold in enumerate(thresholds, start=1):
+        in_zone = unassigned & (values <= threshold)
+        zones[in_zone] = zone
+        unassigned &= ~in_zone
+    return zones
+
+
+def intensity_zone_map(metric, activity_type):
+    # Map of intensity -> zones for the metric the activity is being scored on, None if it cannot be scored
+    if metric == 'power':
+        if is_run(activity_type):
+            return RUN_POWER_INTENSITY_ZONES
+        elif is_ride(activity_type):
+            return RIDE_POWER_INTENSITY_ZONES
+    elif metric == 'heartrate':
+        return HEARTRATE_INTENSITY_ZONES
+    return None
+
+
+def intensity_seconds(zones, zone_map):
+    '''
+    Number of (1s) samples spent at each intensity, intensities with no samples are returned as NaN
+    '''
+    zones = np.asarray(zones, dtype=float)
+    seconds = {}
+    for level in INTENSITY_LEVELS:
+        count = np.count_nonzero(np.isin(zones, zone_map[level]))
+        seconds[level] = count if count else np.nan
+    return seconds
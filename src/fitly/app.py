@@ -16,7 +16,6 @@ db_startup(app)
 import logging
 from logging.handlers import RotatingFileHandler
 from .utils import config
-from .api.sqlalchemy_declarative import dbRefreshStatus
 
 # Can also use %(pathname)s for full pathname for file instead of %(module)s
 handler = RotatingFileHandler('./config/log.log', maxBytes=10000000, backupCount=5)
@@ -32,6 +31,15 @@ with server.app_context():
     # load the rest of our Dash app
     from . import index
 
+    # Convert power curves stored by older versions (strava_best_samples) before any refresh can run
+    from .api.power_curves import migrate_best_samples, init_power_envelopes
+
+    migrate_best_samples()
+    init_power_envelopes()
+
+    # Register the strava push subscription callback on the flask server
+    from .api import strava_webhook
+
     # Enable refresh cron
     if config.get('cron', 'hourly_pull').lower() == 'true':
         try:
@@ -42,16 +50,15 @@ with server.app_context():
 
             # Add spotify job on 20 min schedule since API only allows grabbing the last 50 songs
             if spotify_credentials_supplied:
-                from .api.spotifyAPI import stream, get_spotify_client, spotify_connected
+                from .api.spotifyAPI import spotify_poller, spotify_connected
 
                 if spotify_connected():
                     app.server.logger.debug("Listening to Spotify stream...")
                     # Use this job to pull 'last 50' songs from spotify every 20 mins
                     # scheduler.add_job(func=save_spotify_play_history, trigger="cron", minute='*/20')
 
-                    # Use this job for polling every second (much more precise data with this method can detect skips, etc.)
-                    scheduler.add_job(stream, "interval", seconds=float(config.get('spotify', 'poll_interval_seconds')),
-                                      max_instances=2)
+                    # Poll currently playing in a dedicated thread (much more precise data with this method can detect skips, etc.)
+                    spotify_poller.start()
                 else:
                     app.server.logger.debug('Spotify not connected. Not listening to stream.')
             app.server.logger.info('Starting cron jobs')
@@ -59,10 +66,10 @@ with server.app_context():
         except BaseException as e:
             app.server.logger.error(f'Error starting cron jobs: {e}')
 
-    # Delete any audit logs for running processes, since restarting server would stop any processes
-    app.session.query(dbRefreshStatus).filter(dbRefreshStatus.refresh_method == 'processing').delete()
-    app.session.commit()
-    app.session.remove()
+    # Refresh locks are leases that expire on their own, only jobs need to be cleaned up after a restart
+    from .api.jobs import fail_interrupted_jobs
+
+    fail_interrupted_jobs()
     # configure the Dash instance's layout
     app.layout = main_layout_header()
     # app.layout = main_layout_sidebar()
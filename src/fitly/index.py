@@ -5,7 +5,8 @@ from .utils import DashRouter, DashNavBar
 from .pages import home, lifting, performance, power, music, settings
 from .components import fa
 from dash.dependencies import Input, Output, State
-from .api.sqlalchemy_declarative import dbRefreshStatus, athlete
+from .api.sqlalchemy_declarative import athlete
+from .api.locks import locks_held
 
 athlete_info = app.session.query(athlete).filter(athlete.athlete_id == 1).first()
 use_power = True if athlete_info.use_run_power or athlete_info.use_cycle_power else False
@@ -59,9 +60,7 @@ def toggle_navbar_collapse(n, is_open):
     [Input('db-refresh-toast-interval', 'n_intervals')]
 )
 def truncate_and_refresh(interval):
-    processing = app.session.query(dbRefreshStatus).filter(dbRefreshStatus.refresh_method == 'processing').first()
-    app.session.remove()
-    if processing:
+    if locks_held():
         return True
     else:
         return False
@@ -0,0 +1,44 @@
+"""Click command line script for timing the mean max curve engine on long synthetic activities."""
+
+import time
+
+import click
+import numpy as np
+
+from .api.mmp import mean_max, duration_grid
+
+
+def synthetic_stream(samples, seed=0):
+    # Power-like 1s stream with a few dropouts, so NaN windows are exercised too
+    rng = np.random.default_rng(seed)
+    watts = np.clip(200 + np.cumsum(rng.normal(0, 5, samples)) % 150 + rng.normal(0, 30, samples), 0, None)
+    watts[rng.random(samples) < 0.001] = np.nan
+    return watts
+
+
+@click.command()
+@click.option(
+    "-h",
+    "--hours",
+    default="1,3,6,12,24",
+    help="Comma separated activity lengths in hours. Defaults to 1,3,6,12,24.",
+)
+@click.option(
+    "-g",
+    "--grid",
+    default="log",
+    type=click.Choice(["log", "full"]),
+    help="Duration grid to evaluate. 'log' is the grid stored at ingest, 'full' is every second.",
+)
+def main(hours, grid):
+    click.echo(f"{'hours':>6} {'samples':>8} {'durations':>10} {'seconds':>8} {'us/sample':>10}")
+    for h in [float(x) for x in hours.split(",")]:
+        samples = int(h * 3600)
+        watts = synthetic_stream(samples)
+        durations = duration_grid(samples, grid=grid)
+        start = time.perf_counter()
+        mean_max(watts, durations)
+        elapsed = time.perf_counter() - start
+        # On the log grid time per sample should only grow with the log of the length, on the full grid it grows
+        # linearly (quadratic overall)
+        click.echo(f"{h:>6g} {samples:>8} {len(durations):>10} {elapsed:>8.2f} {elapsed / samples * 1e6:>10.2f}")
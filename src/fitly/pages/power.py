@@ -6,14 +6,15 @@ import plotly.graph_objs as go
 import dash_daq as daq
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
-from ..api.sqlalchemy_declarative import stravaSummary, stravaSamples, stravaBestSamples, athlete, withings
+from ..api.sqlalchemy_declarative import stravaSummary, stravaSamples, athlete, withings
 from ..api.database import engine
 from ..app import app
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from ..utils import config, stryd_credentials_supplied
-from sqlalchemy import func, or_
-import math
+from ..api.mmp import log_durations
+from ..api.power_curves import load_power_curves, best_intervals, interval_values, best_power, max_duration, \
+    envelope_window, expire_power_envelopes
 from ..api.strydAPI import get_training_distribution
 
 # pre_style = {"backgroundColor": "#ddd", "fontSize": 20, "padding": "10px", "margin": "10px"}
@@ -104,12 +105,9 @@ def power_profiles(interval, activity_type='ride', power_unit='mmp', group='M'):
     activity_type = '%' + activity_type + '%'
 
     # Filter on interval passed
-    df_best_samples = pd.read_sql(
-        sql=app.session.query(stravaBestSamples).filter(stravaBestSamples.type.ilike(activity_type),
-                                                        stravaBestSamples.interval == interval).statement, con=engine,
-        index_col=['timestamp_local'])
+    df_best_samples = interval_values(load_power_curves(activity_type=activity_type), interval).set_index(
+        'timestamp_local')
 
-    app.session.remove()
     if len(df_best_samples) < 1:
         return {}
 
@@ -168,17 +166,9 @@ def stryd_training_distributions():
         stravaSummary.start_date_utc.desc()).first().ftp
 
     # Data points for Power Curve Training Disribution
-    TD_df_L90D = pd.read_sql(
-        sql=app.session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id, stravaBestSamples.ftp,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.type.ilike('run'),
-                                                      stravaBestSamples.timestamp_local >= (
-                                                              datetime.now() - timedelta(days=90))
-                                                      ).statement, con=engine)
-
     app.session.remove()
+    TD_df_L90D = best_intervals(
+        load_power_curves(activity_type='run', since=datetime.now() - timedelta(days=90))).reset_index()
 
     ### STRYD TRAINING DISTRIBUTION USES CURRENT WEIGHT WHEN CALCULATING W/KG ###
     ### TRAINING DIST BARS WILL DO THE SAME TO BETTER ALIGN WITH PERCENTILES ###
@@ -342,41 +332,36 @@ def stryd_training_distributions():
     return graphs
 
 
+def hide_overlapping_points(longer_df, shorter_df, power_unit):
+    # For intervals in both windows, only keep the point on the shorter window if it's at least as good
+    common = longer_df.index.intersection(shorter_df.index)
+    shorter_best = (shorter_df.loc[common, power_unit] >= longer_df.loc[common, power_unit]).values
+    longer_df.loc[common[shorter_best], power_unit] = None
+    shorter_df.loc[common[~shorter_best], power_unit] = None
+
+
 def power_curve(activity_type='ride', power_unit='mmp', last_id=None, height=400, time_comparison=None,
                 intensity='all'):
     # TODO: Add power curve model once sweatpy has been finished
     # https://sweatpy.gssns.io/features/Power%20duration%20modelling/#comparison-of-power-duration-models
-    activity_type = '%' + activity_type + '%'
-
-    max_interval = app.session.query(
-        func.max(stravaBestSamples.interval).label('interval')).filter(
-        stravaBestSamples.type.ilike(activity_type)).first()[0]
-
-    act_dict = pd.read_sql(
-        sql=app.session.query(stravaBestSamples.activity_id, stravaBestSamples.act_name).distinct().statement,
-        con=engine,
-        index_col='activity_id').to_dict()
+    if envelope_window(activity_type):
+        # Ride/run windows are read from the envelopes kept at ingest, rebuild any that have points aging out first
+        expire_power_envelopes(activity_type.lower())
+        curves = None
+    else:
+        # Every window is taken from one read of the activity type's curves
+        curves = load_power_curves(activity_type='%' + activity_type + '%')
+    max_interval = max_duration(activity_type, curves)
 
     # Data points for Power Curve Training Disribution
-    # Join in weight at the time of workout for calculating FTP_W/kg at point in time (of workout)
-    TD_df_L90D = pd.read_sql(
-        sql=app.session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id, stravaBestSamples.ftp,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-            stravaSummary.weight
-        ).join(stravaSummary, stravaBestSamples.activity_id == stravaSummary.activity_id, isouter=True).group_by(
-            stravaBestSamples.interval).filter(stravaBestSamples.type.ilike(activity_type),
-                                               stravaBestSamples.timestamp_local >= (
-                                                       datetime.now() - timedelta(days=90))
-                                               ).statement, con=engine, index_col='interval')
+    # Use weight at the time of workout for calculating FTP_W/kg at point in time (of workout)
+    TD_df_L90D = best_power(activity_type, days=90, curves=curves)
 
     # Don't show TD date when plotting a small chart ( <400 height)
     td_data_exists = len(TD_df_L90D) > 0 and height >= 400
     # If training distribution data exists
     if td_data_exists:
-        TD_df_L90D['act_name'] = TD_df_L90D['activity_id'].map(act_dict['act_name'])
-        TD_df_L90D['ftp_wkg'] = TD_df_L90D['ftp'] / (TD_df_L90D['weight'] * 0.453592)
+        TD_df_L90D['ftp_wkg'] = TD_df_L90D['ftp'] / TD_df_L90D['kg']
 
         ### Calculations for L90D workouts based on todays weights for stryd comparisons ###
         # Stryd uses "Current FTP" and "Current Weight" across all workouts for last 90 days for their power curve
@@ -393,138 +378,31 @@ def power_curve(activity_type='ride', power_unit='mmp', last_id=None, height=400
         # Muscle power is just best 10 second power
         muscle_power = TD_df_L90D.loc[10][power_unit]
 
-        TD_df_at = pd.read_sql(
-            sql=app.session.query(
-                func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id, stravaBestSamples.ftp,
-                stravaBestSamples.interval, stravaBestSamples.time_interval,
-                stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-            ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.type.ilike(activity_type),
-                                                          or_(stravaBestSamples.interval == 10,
-                                                              stravaBestSamples.interval == int(fatigue_df.name),
-                                                              stravaBestSamples.interval == int(endurance_df.name)),
-                                                          ).statement, con=engine, index_col='interval')
+        TD_df_at = best_power(activity_type, [10, int(fatigue_df.name), int(endurance_df.name)], curves=curves)
 
         muscle_power_best = True if TD_df_at.loc[10][power_unit] == muscle_power else False
         endurance_best = True if TD_df_at.loc[endurance_df.name][power_unit] == endurance_df[power_unit] else False
         fatigue_best = True if TD_df_at.loc[fatigue_df.name][power_unit] == fatigue_df[power_unit] else False
 
-    # 1 second intervals from 0-60 seconds
-    interval_lengths = [i for i in range(1, 61)]
-    # 5 second intervals from 1:15 - 20:00 mins
-    interval_lengths += [i for i in range(65, 1201, 5)]
-    # 30 second intervals for everything after 20 mins
-    interval_lengths += [i for i in range(1230, (int(math.floor(max_interval / 10.0)) * 10) + 1, 30)]
-
-    all_best_interval_df = pd.read_sql(
-        sql=app.session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'),
-            stravaBestSamples.activity_id, stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                      stravaBestSamples.type.ilike(activity_type)).statement,
-        con=engine, index_col='interval')
-    all_best_interval_df['act_name'] = all_best_interval_df['activity_id'].map(act_dict['act_name'])
-
-    L90D_best_interval_df = pd.read_sql(
-        sql=app.session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id, stravaBestSamples.ftp,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                      stravaBestSamples.type.ilike(activity_type),
-                                                      stravaBestSamples.timestamp_local >= (
-                                                              datetime.now() - timedelta(days=90))
-                                                      ).statement, con=engine, index_col='interval')
-
-    L90D_best_interval_df['act_name'] = L90D_best_interval_df['activity_id'].map(act_dict['act_name'])
-
-    L6W_best_interval_df = pd.read_sql(
-        sql=app.session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                      stravaBestSamples.type.ilike(activity_type),
-                                                      stravaBestSamples.timestamp_local >= (
-                                                              datetime.now() - timedelta(days=42))
-                                                      ).statement, con=engine, index_col='interval')
-    L6W_best_interval_df['act_name'] = L6W_best_interval_df['activity_id'].map(act_dict['act_name'])
-
-    L30D_best_interval_df = pd.read_sql(
-        sql=app.session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                      stravaBestSamples.type.ilike(activity_type),
-                                                      stravaBestSamples.timestamp_local >= (
-                                                              datetime.now() - timedelta(days=30))
-                                                      ).statement, con=engine, index_col='interval')
-    L30D_best_interval_df['act_name'] = L30D_best_interval_df['activity_id'].map(act_dict['act_name'])
+    # 1 second intervals up to 1 min, 5 seconds up to 20 mins, then 30 second intervals
+    interval_lengths = log_durations(max_interval)
+
+    all_best_interval_df = best_power(activity_type, interval_lengths, curves=curves)
+    L90D_best_interval_df = best_power(activity_type, interval_lengths, days=90, curves=curves)
+    L6W_best_interval_df = best_power(activity_type, interval_lengths, days=42, curves=curves)
+    L30D_best_interval_df = best_power(activity_type, interval_lengths, days=30, curves=curves)
 
     if last_id:
-        recent_best_interval_df = pd.read_sql(
-            sql=app.session.query(
-                func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id,
-                stravaBestSamples.interval, stravaBestSamples.time_interval,
-                stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-            ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.activity_id == last_id,
-                                                          stravaBestSamples.interval.in_(interval_lengths),
-                                                          ).statement, con=engine, index_col='interval')
-        recent_best_interval_df['act_name'] = recent_best_interval_df['activity_id'].map(act_dict['act_name'])
+        recent_best_interval_df = best_intervals(load_power_curves(activity_id=last_id), interval_lengths)
 
     if time_comparison:
-        if intensity == 'all':
-            time_comparison_best_interval_df = pd.read_sql(
-                sql=app.session.query(
-                    func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id, stravaBestSamples.ftp,
-                    stravaBestSamples.interval, stravaBestSamples.time_interval,
-                    stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-                ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                              stravaBestSamples.type.ilike(activity_type),
-                                                              stravaBestSamples.timestamp_local >= (
-                                                                      datetime.now() - timedelta(days=time_comparison))
-                                                              ).statement, con=engine, index_col='interval')
-            time_comparison_best_interval_df['act_name'] = time_comparison_best_interval_df['activity_id'].map(
-                act_dict['act_name'])
-        else:
-            # Join in intensity data from strava summary
-
-            pd.read_sql(
-                sql=app.session.query(stravaSummary.activity_id, stravaSummary.workout_intensity).statement,
-                con=engine)
-
-            time_comparison_best_interval_df = pd.read_sql(
-                sql=app.session.query(
-                    func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id, stravaBestSamples.ftp,
-                    stravaBestSamples.interval, stravaBestSamples.time_interval,
-                    stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-                ).join(stravaSummary, stravaBestSamples.activity_id == stravaSummary.activity_id,
-                       isouter=True).group_by(stravaBestSamples.interval).filter(
-                    stravaSummary.workout_intensity == intensity,
-                    stravaBestSamples.interval.in_(interval_lengths),
-                    stravaBestSamples.type.ilike(activity_type),
-                    stravaBestSamples.timestamp_local >= (
-                            datetime.now() - timedelta(days=time_comparison))
-                ).statement, con=engine, index_col='interval')
-            time_comparison_best_interval_df['act_name'] = time_comparison_best_interval_df['activity_id'].map(
-                act_dict['act_name'])
-
-            all_best_interval_df = pd.read_sql(
-                sql=app.session.query(
-                    func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id, stravaBestSamples.ftp,
-                    stravaBestSamples.interval, stravaBestSamples.time_interval,
-                    stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-                ).join(stravaSummary, stravaBestSamples.activity_id == stravaSummary.activity_id,
-                       isouter=True).group_by(stravaBestSamples.interval).filter(
-                    stravaSummary.workout_intensity == intensity,
-                    stravaBestSamples.interval.in_(interval_lengths),
-                    stravaBestSamples.type.ilike(activity_type)
-                ).statement, con=engine, index_col='interval')
-            all_best_interval_df['act_name'] = all_best_interval_df['activity_id'].map(
-                act_dict['act_name'])
+        if intensity != 'all':
+            # Only compare against workouts of the selected intensity (from strava summary)
+            curves = load_power_curves(activity_type='%' + activity_type + '%', intensity=intensity)
+            all_best_interval_df = best_intervals(curves, interval_lengths)
 
-    app.session.remove()
+        time_comparison_best_interval_df = best_power(activity_type, interval_lengths, days=time_comparison,
+                                                      curves=curves)
 
     if len(all_best_interval_df) < 1:
         return {}
@@ -555,26 +433,11 @@ def power_curve(activity_type='ride', power_unit='mmp', last_id=None, height=400
     # On Main chart, we only want to show 1 line with all different colors, so loop through each df and remove points where not max
     # Replace all_time with l90D
     if not time_comparison:
-        for i in all_best_interval_df.index:
-            if i in L90D_best_interval_df.index:
-                if L90D_best_interval_df.at[i, power_unit] >= all_best_interval_df.at[i, power_unit]:
-                    all_best_interval_df.at[i, power_unit] = None
-                else:
-                    L90D_best_interval_df.at[i, power_unit] = None
+        hide_overlapping_points(all_best_interval_df, L90D_best_interval_df, power_unit)
         # Replace L90D with L6W
-        for i in L90D_best_interval_df.index:
-            if i in L6W_best_interval_df.index:
-                if L6W_best_interval_df.at[i, power_unit] >= L90D_best_interval_df.at[i, power_unit]:
-                    L90D_best_interval_df.at[i, power_unit] = None
-                else:
-                    L6W_best_interval_df.at[i, power_unit] = None
+        hide_overlapping_points(L90D_best_interval_df, L6W_best_interval_df, power_unit)
         # Replace L6W with L30D
-        for i in L6W_best_interval_df.index:
-            if i in L30D_best_interval_df.index:
-                if L30D_best_interval_df.at[i, power_unit] >= L6W_best_interval_df.at[i, power_unit]:
-                    L6W_best_interval_df.at[i, power_unit] = None
-                else:
-                    L30D_best_interval_df.at[i, power_unit] = None
+        hide_overlapping_points(L6W_best_interval_df, L30D_best_interval_df, power_unit)
 
     tooltip = '''<b>{}</b><br>{}<br>{}<br>{:.2f} W/kg''' if power_unit == 'watts_per_kg' else '''<b>{}</b><br>{}<br>{}<br>{:.0f} W'''
     data = [
@@ -12,9 +12,12 @@ from ..api.spotifyAPI import spotify_connected, connect_spotify_link, save_spoti
 from ..api.pelotonApi import get_peloton_class_names
 from withings_api import WithingsAuth, AuthScope
 import tekore as tk
-from ..api.sqlalchemy_declarative import stravaSummary, ouraSleepSummary, athlete, workoutStepLog, dbRefreshStatus
+from ..api.sqlalchemy_declarative import stravaSummary, ouraSleepSummary, athlete, workoutStepLog
 from ..api.database import engine
 from ..api.datapull import refresh_database
+from ..api.reprocess import reprocess_activities
+from ..api.jobs import submit_job, latest_job, active_job
+from ..api.locks import locks_held
 from sqlalchemy import delete
 import pandas as pd
 from dateutil.relativedelta import relativedelta
@@ -569,12 +572,17 @@ def generate_settings_dashboard():
                             dbc.Button('Truncate After Date', color='primary', size='sm',
                                        id='truncate-date-db-button',
                                        n_clicks=0, disabled=True)]),
+                        html.Div(className='col-12 mb-2', children=[
+                            dbc.Button('Reprocess After Date', color='primary', size='sm',
+                                       id='reprocess-date-db-button',
+                                       n_clicks=0, disabled=True)]),
 
                         reset_hrv_plan_button,
                         html.Div(className='col-12 mb-2', children=[
                             dbc.Button('Truncate All', id='truncate-db-button', size='sm',
                                        color='primary',
                                        n_clicks=0, disabled=True)]),
+                        html.Div(id='job-status', className='col-12'),
                     ])
                 ])
             ]),
@@ -606,6 +614,7 @@ def generate_settings_dashboard():
                                  html.Div(id='truncate-refresh-status', style={'display': 'none'}),
                                  html.Div(id='refresh-status', style={'display': 'none'}),
                                  html.Div(id='truncate-hrv-status', style={'display': 'none'}),
+                                 html.Div(id='reprocess-status', style={'display': 'none'}),
                              ])
                          ])
                      ])
@@ -1057,11 +1066,42 @@ def update_api_connection_status(n_clicks):
 def refresh(n_clicks):
     if n_clicks > 0:
         app.server.logger.info('Manually refreshing database tables...')
-        refresh_database(refresh_method='manual')
-        return html.H6('Refresh Complete')
+        submit_job('Refresh', refresh_database, refresh_method='manual')
+        return html.H6('Refresh Queued')
     return ''
 
 
+def reset_hrv_workflow(latest, hrv_date):
+    try:
+        # If changing recovery metric, refresh entire workflow table
+        if latest == 'recovery-metric-dropdown-input-submit':
+            app.session.execute(delete(workoutStepLog))
+            app.session.commit()
+        # If using reset hrv plan, update based on date
+        if latest == 'truncate-hrv-button':
+            date = datetime.strptime(hrv_date, '%Y-%m-%d').date()
+            app.server.logger.info('Resetting HRV workout plan workflow to step 0 on {}'.format(date))
+            app.session.execute(delete(workoutStepLog).where(workoutStepLog.date > date))
+            query = app.session.query(workoutStepLog).filter(workoutStepLog.date == date).first()
+            query.workout_step = 0
+            query.workout_step_desc = 'Low'
+            query.rationale = 'You manually restarted the hrv workout plan workflow today'
+            query.athlete_id = 1
+            query.completed = 0
+            app.session.commit()
+        # Run the workflow
+        athlete_info = app.session.query(athlete).filter(
+            athlete.athlete_id == 1).first()
+        training_workflow(min_non_warmup_workout_time=athlete_info.min_non_warmup_workout_time,
+                          metric=athlete_info.recovery_metric)
+        app.session.remove()
+    except BaseException as e:
+        app.session.rollback()
+        app.server.logger.error('Error resetting hrv workout plan: {}'.format(e))
+        app.session.remove()
+        raise
+
+
 # Truncate workout_step_log (reset HRV Plan)
 @app.callback(Output('truncate-hrv-status', 'children'),
               [Input('truncate-hrv-button', 'n_clicks'),
@@ -1071,35 +1111,8 @@ def reset_hrv_plan(n_clicks, metric_n_clicks, hrv_date):
     ctx = dash.callback_context
     if ctx.triggered:
         latest = ctx.triggered[0]['prop_id'].split('.')[0]
-        try:
-            # If changing recovery metric, refresh entire workflow table
-            if latest == 'recovery-metric-dropdown-input-submit':
-                app.session.execute(delete(workoutStepLog))
-                app.session.commit()
-            # If using reset hrv plan, update based on date
-            if latest == 'truncate-hrv-button':
-                date = datetime.strptime(hrv_date, '%Y-%m-%d').date()
-                app.server.logger.info('Resetting HRV workout plan workflow to step 0 on {}'.format(date))
-                app.session.execute(delete(workoutStepLog).where(workoutStepLog.date > date))
-                query = app.session.query(workoutStepLog).filter(workoutStepLog.date == date).first()
-                query.workout_step = 0
-                query.workout_step_desc = 'Low'
-                query.rationale = 'You manually restarted the hrv workout plan workflow today'
-                query.athlete_id = 1
-                query.completed = 0
-                app.session.commit()
-            # Run the workflow
-            athlete_info = app.session.query(athlete).filter(
-                athlete.athlete_id == 1).first()
-            training_workflow(min_non_warmup_workout_time=athlete_info.min_non_warmup_workout_time,
-                              metric=athlete_info.recovery_metric)
-            app.session.remove()
-            return html.H6('HRV Plan Reset!')
-        except BaseException as e:
-            app.session.rollback()
-            app.server.logger.error('Error resetting hrv workout plan: {}'.format(e))
-            app.session.remove()
-            return html.H6('Error Resetting HRV Plan')
+        submit_job('Reset HRV Plan', reset_hrv_workflow, latest, hrv_date)
+        return html.H6('HRV Plan Reset Queued')
 
     return ''
 
@@ -1119,46 +1132,66 @@ def truncate_and_refresh(n_clicks, n_clicks_date, truncateDate):
             truncateDate = datetime.strptime(truncateDate, '%Y-%m-%d')
             app.server.logger.info(
                 'Manually truncating and refreshing database tables after {}...'.format(truncateDate))
-            try:
-                refresh_database(refresh_method='manual', truncateDate=truncateDate)
-                return html.H6('Truncate and Load Complete')
-            except:
-                return html.H6('Error with Truncate and Load')
+            submit_job('Truncate After {}'.format(truncateDate.date()), refresh_database, refresh_method='manual',
+                       truncateDate=truncateDate)
+            return html.H6('Truncate and Load Queued')
 
         elif latest == 'truncate-db-button':
             app.server.logger.info('Manually truncating and refreshing database tables...')
-            try:
-                refresh_database(refresh_method='manual', truncate=True)
-                return html.H6('Truncate and Load Complete')
-            except:
-                return html.H6('Error with Truncate and Load')
+            submit_job('Truncate All', refresh_database, refresh_method='manual', truncate=True)
+            return html.H6('Truncate and Load Queued')
     else:
         return ''
 
 
+# Recompute derived metrics from stored samples (after changing zones, ftp, etc.)
+@app.callback(Output('reprocess-status', 'children'),
+              [Input('reprocess-date-db-button', 'n_clicks')],
+              [State('truncate-date', 'value')])
+def reprocess(n_clicks, reprocessDate):
+    if n_clicks > 0:
+        reprocessDate = datetime.strptime(reprocessDate, '%Y-%m-%d').date()
+        app.server.logger.info('Manually reprocessing activities after {}...'.format(reprocessDate))
+        submit_job('Reprocess After {}'.format(reprocessDate), reprocess_activities, start_date=reprocessDate)
+        return html.H6('Reprocess Queued')
+    return ''
+
+
+# Show progress of the latest background job
+@app.callback(Output('job-status', 'children'),
+              [Input('db-interval', 'n_intervals')])
+def update_job_status(interval):
+    job = latest_job()
+    if not job:
+        return ''
+    if job['status'] == 'error':
+        return html.H6('{}: Error - {}'.format(job['name'], job['error']))
+    return html.H6('{}: {}'.format(job['name'], job['stage'] or job['status'].capitalize()))
+
+
 # Disable database buttons when processing
 # Truncate database
 @app.callback([
     Output('refresh-db-button', 'disabled'),
     Output('truncate-date-db-button', 'disabled'),
     Output('truncate-hrv-button', 'disabled'),
-    Output('truncate-db-button', 'disabled')],
+    Output('truncate-db-button', 'disabled'),
+    Output('reprocess-date-db-button', 'disabled')],
     [Input('refresh-db-button', 'n_clicks'),
      Input('truncate-date-db-button', 'n_clicks'),
      Input('truncate-hrv-button', 'n_clicks'),
      Input('truncate-db-button', 'n_clicks'),
+     Input('reprocess-date-db-button', 'n_clicks'),
      Input('db-interval', 'n_intervals')])
-def truncate_and_refresh(refresh_dummy, truncate_dummy, hrv_dummy, all_dummy, interval):
-    processing = app.session.query(dbRefreshStatus).filter(dbRefreshStatus.refresh_method == 'processing').first()
-
-    app.session.remove()
+def truncate_and_refresh(refresh_dummy, truncate_dummy, hrv_dummy, all_dummy, reprocess_dummy, interval):
+    processing = locks_held() or active_job()
     latest = dash.callback_context.triggered[0]['prop_id'].split('.')[0] if dash.callback_context.triggered else ''
 
     if latest in ['refresh-db-button', 'truncate-date-db-button', 'truncate-hrv-button',
-                  'truncate-db-button'] or processing:
-        return True, True, True, True
+                  'truncate-db-button', 'reprocess-date-db-button'] or processing:
+        return True, True, True, True, True
     else:
-        return False, False, False, False
+        return False, False, False, False, False
 
 
 # Refresh Logs Interval
@@ -0,0 +1,36 @@
+"""Click command line script for recomputing activity metrics from stored samples."""
+
+import click
+
+from .app import app
+from .api.reprocess import reprocess_activities
+
+
+@click.command()
+@click.option(
+    "-s",
+    "--start",
+    default=None,
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    help="First day (YYYY-MM-DD) to reprocess. Defaults to the first activity.",
+)
+@click.option(
+    "-e",
+    "--end",
+    default=None,
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    help="Last day (YYYY-MM-DD) to reprocess. Defaults to the latest activity.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    default=None,
+    type=int,
+    help="Number of worker processes. Defaults to the number of CPUs.",
+)
+def main(start, end, workers):
+    with app.server.app_context():
+        count = reprocess_activities(start_date=start.date() if start else None,
+                                     end_date=end.date() if end else None,
+                                     max_workers=workers)
+    click.echo(f"Reprocessed {count} activities")
@@ -0,0 +1,36 @@
+"""Click command line script for sending test strava webhook events to a running fitly server."""
+
+import json
+
+import click
+
+from .app import app
+from .api.strava_webhook import send_strava_event
+
+
+@click.command()
+@click.argument("activity_id", type=int)
+@click.option(
+    "-a",
+    "--aspect",
+    default="create",
+    type=click.Choice(["create", "update", "delete"]),
+    help="Event type to send. Defaults to create.",
+)
+@click.option(
+    "-t",
+    "--title",
+    default=None,
+    help="New activity title, sent as an update event's changes.",
+)
+@click.option(
+    "-u",
+    "--url",
+    default=None,
+    help="Webhook url. Defaults to the local development server.",
+)
+def main(activity_id, aspect, title, url):
+    updates = {"title": title} if title else {}
+    with app.server.app_context():
+        response = send_strava_event(activity_id, aspect_type=aspect, updates=updates, url=url)
+    click.echo(f"{response.status_code} {json.dumps(response.json()) if response.content else ''}")